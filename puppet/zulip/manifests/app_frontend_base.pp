@@ -80,9 +80,24 @@ class zulip::app_frontend_base {
 
   # This determines whether we run queue processors multithreaded or
   # multiprocess.  Multiprocess scales much better, but requires more
-  # RAM; we just auto-detect based on available system RAM.
+  # RAM; we just auto-detect based on available system RAM.  Even in
+  # multiprocess mode, the lightweight queues share a single
+  # multithreaded process, since a process per mostly-idle queue costs
+  # a full copy of Django's memory footprint.
   $queues_multiprocess = $zulip::base::total_memory_mb > 3500
   $queues = $zulip::base::normal_queues
+  if $queues_multiprocess {
+    $threaded_queues = $zulip::base::lightweight_queues
+  } else {
+    $threaded_queues = $queues
+  }
+  $isolated_queues = $queues - $threaded_queues
+  # Each queue processor process serves its metrics (see `manage.py
+  # process_queue --metrics_port`) on localhost, for
+  # check_queue_worker_metrics to scrape: the multithreaded process on
+  # queue_metrics_port, and the isolated queues' processes, in order,
+  # on the ports after it.  Setting it to 0 disables the metrics.
+  $queue_metrics_port = Integer(zulipconf('application_server', 'queue_metrics_port', 9900))
   if $queues_multiprocess {
     $uwsgi_default_processes = 6
   } else {
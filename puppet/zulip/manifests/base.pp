@@ -59,6 +59,7 @@ class zulip::base {
   $postgres_version = zulipconf('postgresql', 'version', undef)
 
   $normal_queues = [
+    'deferred_message_work',
     'deferred_work',
     'digest_emails',
     'email_mirror',
@@ -76,6 +77,20 @@ class zulip::base {
     'user_presence',
   ]
 
+  # The subset of normal_queues which are cheap to process, and so are
+  # always run as threads of a single queue processor process; see
+  # app_frontend_base.pp.
+  $lightweight_queues = [
+    'error_reports',
+    'invites',
+    'email_mirror',
+    'missedmessage_emails',
+    'signups',
+    'user_activity',
+    'user_activity_interval',
+    'user_presence',
+  ]
+
   $total_memory_mb = Integer($::memorysize_mb);
 
   group { 'zulip':
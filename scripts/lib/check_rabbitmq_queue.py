@@ -9,6 +9,7 @@ from typing import Any, DefaultDict, Dict, List
 ZULIP_PATH = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 normal_queues = [
+    'deferred_message_work',
     'deferred_work',
     'digest_emails',
     'email_mirror',
@@ -3,7 +3,7 @@ import json
 import os
 import subprocess
 import sys
-from typing import Any, Dict
+from typing import Any, Dict, List, Union
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 sys.path.append(BASE_DIR)
@@ -19,38 +19,80 @@ def write_realm_nginx_config_line(f: Any, host: str, port: str) -> None:
     set $tornado_server http://tornado{port};
 }}\n""")
 
+def get_user_shard_key_regex(host: str, ports: List[str]) -> str:
+    # Event queue IDs start with the port of the Tornado process
+    # holding the queue, and a colon; $arg_queue_id isn't decoded, and
+    # clients (e.g. jQuery's $.param) send the colon as %3A.
+    host_regex = host.replace('.', '\\.')
+    return f"^{host_regex}/({'|'.join(ports)})(:|%3[Aa])"
+
+def write_user_sharded_realm_nginx_config_lines(f: Any, host: str, ports: List[str]) -> None:
+    # Requests without a queue_id in the query string go to the first
+    # process; Django handles DELETE requests for the realm's queues,
+    # passing them on to the right process (see cleanup_event_queue).
+    write_realm_nginx_config_line(f, host, ports[0])
+    f.write(f"""if ($tornado_user_shard_key ~ "{get_user_shard_key_regex(host, ports)}") {{
+    set $tornado_server http://tornado$1;
+}}\n""")
+
 # Basic system to do Tornado sharding.  Writes two output .tmp files that need
 # to be renamed to the following files to finalize the changes:
 # * /etc/zulip/nginx_sharding.conf; nginx needs to be reloaded after changing.
 # * /etc/zulip/sharding.json; supervisor Django process needs to be reloaded
 # after changing.  TODO: We can probably make this live-reload by statting the file.
 #
+# Realms listed in the `tornado_sharding` section (as `port = realm
+# realm ...`) are served by a single Tornado process; realms listed
+# in the `tornado_user_sharding` section (as `realm = port port ...`)
+# have their users spread across those Tornado processes by user ID.
+#
 # TODO: Restructure this to automatically generate a sharding layout.
-with open('/etc/zulip/nginx_sharding.conf.tmp', 'w') as nginx_sharding_conf_f, \
-        open('/etc/zulip/sharding.json.tmp', 'w') as sharding_json_f:
-
-    config_file = get_config_file()
-    if not config_file.has_section("tornado_sharding"):
-        nginx_sharding_conf_f.write("set $tornado_server http://tornado;\n")
-        sharding_json_f.write('{}\n')
-        sys.exit(0)
-
-    nginx_sharding_conf_f.write("set $tornado_server http://tornado9800;\n")
-    shard_map: Dict[str, int] = {}
-    external_host = subprocess.check_output([os.path.join(BASE_DIR, 'scripts/get-django-setting'),
-                                             'EXTERNAL_HOST'],
-                                            universal_newlines=True).strip()
-    for port in config_file["tornado_sharding"]:
-        shards = config_file["tornado_sharding"][port].strip().split(' ')
-
-        for shard in shards:
+def main() -> None:
+    with open('/etc/zulip/nginx_sharding.conf.tmp', 'w') as nginx_sharding_conf_f, \
+            open('/etc/zulip/sharding.json.tmp', 'w') as sharding_json_f:
+
+        config_file = get_config_file()
+        if not config_file.has_section("tornado_sharding") and \
+                not config_file.has_section("tornado_user_sharding"):
+            nginx_sharding_conf_f.write("set $tornado_server http://tornado;\n")
+            sharding_json_f.write('{}\n')
+            return
+
+        nginx_sharding_conf_f.write("set $tornado_server http://tornado9800;\n")
+        shard_map: Dict[str, Union[int, List[int]]] = {}
+        external_host = subprocess.check_output([os.path.join(BASE_DIR, 'scripts/get-django-setting'),
+                                                 'EXTERNAL_HOST'],
+                                                universal_newlines=True).strip()
+
+        def get_shard_host(shard: str) -> str:
             if '.' in shard:
                 host = shard
             else:
                 host = f"{shard}.{external_host}"
             assert host not in shard_map, f"host {host} duplicated"
-            shard_map[host] = int(port)
-            write_realm_nginx_config_line(nginx_sharding_conf_f, host, port)
-        nginx_sharding_conf_f.write('\n')
+            return host
+
+        if config_file.has_section("tornado_sharding"):
+            for port in config_file["tornado_sharding"]:
+                shards = config_file["tornado_sharding"][port].strip().split(' ')
+
+                for shard in shards:
+                    host = get_shard_host(shard)
+                    shard_map[host] = int(port)
+                    write_realm_nginx_config_line(nginx_sharding_conf_f, host, port)
+                nginx_sharding_conf_f.write('\n')
+
+        if config_file.has_section("tornado_user_sharding"):
+            nginx_sharding_conf_f.write('set $tornado_user_shard_key "$host/$arg_queue_id";\n')
+            for shard in config_file["tornado_user_sharding"]:
+                host = get_shard_host(shard)
+                ports = config_file["tornado_user_sharding"][shard].strip().split()
+                assert all(port.isdigit() for port in ports), f"invalid ports for {host}"
+                shard_map[host] = [int(port) for port in ports]
+                write_user_sharded_realm_nginx_config_lines(nginx_sharding_conf_f, host, ports)
+                nginx_sharding_conf_f.write('\n')
+
+        sharding_json_f.write(json.dumps(shard_map) + '\n')
 
-    sharding_json_f.write(json.dumps(shard_map) + '\n')
+if __name__ == "__main__":
+    main()
@@ -70,6 +70,7 @@ from zerver.lib.cache import (
     delete_user_profile_caches,
     display_recipient_cache_key,
     flush_user_profile,
+    message_fragment_cache_keys,
     to_dict_cache_key_id,
     user_profile_by_api_key_cache_key,
     user_profile_by_email_cache_key,
@@ -105,7 +106,7 @@ from zerver.lib.message import (
     update_first_visible_message_id,
 )
 from zerver.lib.pysa import mark_sanitized
-from zerver.lib.queue import queue_json_publish
+from zerver.lib.queue import queue_json_publish, queue_publish_batch
 from zerver.lib.realm_icon import realm_icon_url
 from zerver.lib.realm_logo import get_realm_logo_data
 from zerver.lib.retention import move_messages_to_archive
@@ -152,6 +153,7 @@ from zerver.lib.topic import (
 )
 from zerver.lib.topic_mutes import add_topic_mute, get_topic_mutes, remove_topic_mute
 from zerver.lib.types import ProfileFieldData
+from zerver.lib.unread_index import flush_unread_index_for_realm, flush_unread_index_for_users
 from zerver.lib.upload import (
     claim_attachment,
     delete_avatar_image,
@@ -183,6 +185,7 @@ from zerver.models import (
     Message,
     MultiuseInvite,
     PreregistrationUser,
+    PresenceSequence,
     Reaction,
     Realm,
     RealmAuditLog,
@@ -1444,17 +1447,25 @@ def do_send_messages(messages_maybe_none: Sequence[Optional[MutableMapping[str,
         mentioned_bot_user_ids = default_bot_user_ids & mentioned_user_ids
         message['um_eligible_user_ids'] |= mentioned_bot_user_ids
 
+    # With DEFER_MESSAGE_SIDE_EFFECTS, only the database writes and the
+    # events for Tornado happen here; the rest of the work of sending
+    # the messages is done by the deferred_message_work queue
+    # processor (see do_deferred_message_work).
+    defer_side_effects = settings.DEFER_MESSAGE_SIDE_EFFECTS
+    deferred_work: List[Dict[str, Any]] = []
+
     # Save the message receipts in the database
     user_message_flags: Dict[int, Dict[int, List[str]]] = defaultdict(dict)
     with transaction.atomic():
         Message.objects.bulk_create([message['message'] for message in messages])
 
         # Claim attachments in message
-        for message in messages:
-            if do_claim_attachments(message['message'],
-                                    message['message'].potential_attachment_path_ids):
-                message['message'].has_attachment = True
-                message['message'].save(update_fields=['has_attachment'])
+        if not defer_side_effects:
+            for message in messages:
+                if do_claim_attachments(message['message'],
+                                        message['message'].potential_attachment_path_ids):
+                    message['message'].has_attachment = True
+                    message['message'].save(update_fields=['has_attachment'])
 
         ums: List[UserMessageLite] = []
         for message in messages:
@@ -1489,109 +1500,135 @@ def do_send_messages(messages_maybe_none: Sequence[Optional[MutableMapping[str,
         for message in messages:
             do_widget_post_save_actions(message)
 
-    for message in messages:
-        realm_id: Optional[int] = None
-        if message['message'].is_stream_message():
-            if message['stream'] is None:
-                stream_id = message['message'].recipient.type_id
-                message['stream'] = Stream.objects.select_related().get(id=stream_id)
-            assert message['stream'] is not None  # assert needed because stubs for django are missing
-            realm_id = message['stream'].realm_id
-
-        # Deliver events to the real-time push system, as well as
-        # enqueuing any additional processing triggered by the message.
-        wide_message_dict = MessageDict.wide_dict(message['message'], realm_id)
-
-        user_flags = user_message_flags.get(message['message'].id, {})
-        sender = message['message'].sender
-        message_type = wide_message_dict['type']
-
-        presence_idle_user_ids = get_active_presence_idle_user_ids(
-            realm=sender.realm,
-            sender_id=sender.id,
-            message_type=message_type,
-            active_user_ids=message['active_user_ids'],
-            user_flags=user_flags,
-        )
-
-        event = dict(
-            type='message',
-            message=message['message'].id,
-            message_dict=wide_message_dict,
-            presence_idle_user_ids=presence_idle_user_ids,
-        )
-
-        '''
-        TODO:  We may want to limit user_ids to only those users who have
-               UserMessage rows, if only for minor performance reasons.
-
-               For now we queue events for all subscribers/sendees of the
-               message, since downstream code may still do notifications
-               that don't require UserMessage rows.
+    # The events for Tornado and the queue processors below are
+    # published to RabbitMQ in a single batch.
+    with queue_publish_batch():
+        for message in messages:
+            realm_id: Optional[int] = None
+            if message['message'].is_stream_message():
+                if message['stream'] is None:
+                    stream_id = message['message'].recipient.type_id
+                    message['stream'] = Stream.objects.select_related().get(id=stream_id)
+                assert message['stream'] is not None  # assert needed because stubs for django are missing
+                realm_id = message['stream'].realm_id
+
+            # Deliver events to the real-time push system, as well as
+            # enqueuing any additional processing triggered by the message.
+            wide_message_dict = MessageDict.wide_dict(message['message'], realm_id)
+
+            user_flags = user_message_flags.get(message['message'].id, {})
+            sender = message['message'].sender
+            message_type = wide_message_dict['type']
+
+            presence_idle_user_ids = get_active_presence_idle_user_ids(
+                realm=sender.realm,
+                sender_id=sender.id,
+                message_type=message_type,
+                active_user_ids=message['active_user_ids'],
+                user_flags=user_flags,
+            )
 
-               Our automated tests have gotten better on this codepath,
-               but we may have coverage gaps, so we should be careful
-               about changing the next line.
-        '''
-        user_ids = message['active_user_ids'] | set(user_flags.keys())
-
-        users = [
-            dict(
-                id=user_id,
-                flags=user_flags.get(user_id, []),
-                always_push_notify=(user_id in message['push_notify_user_ids']),
-                stream_push_notify=(user_id in message['stream_push_user_ids']),
-                stream_email_notify=(user_id in message['stream_email_user_ids']),
-                wildcard_mention_notify=(user_id in message['wildcard_mention_user_ids']),
+            event = dict(
+                type='message',
+                message=message['message'].id,
+                message_dict=wide_message_dict,
+                presence_idle_user_ids=presence_idle_user_ids,
             )
-            for user_id in user_ids
-        ]
 
-        if message['message'].is_stream_message():
-            # Note: This is where authorization for single-stream
-            # get_updates happens! We only attach stream data to the
-            # notify new_message request if it's a public stream,
-            # ensuring that in the tornado server, non-public stream
-            # messages are only associated to their subscribed users.
-            assert message['stream'] is not None  # assert needed because stubs for django are missing
-            if message['stream'].is_public():
-                event['realm_id'] = message['stream'].realm_id
-                event['stream_name'] = message['stream'].name
-            if message['stream'].invite_only:
-                event['invite_only'] = True
-            if message['stream'].first_message_id is None:
-                message['stream'].first_message_id = message['message'].id
-                message['stream'].save(update_fields=["first_message_id"])
-        if message['local_id'] is not None:
-            event['local_id'] = message['local_id']
-        if message['sender_queue_id'] is not None:
-            event['sender_queue_id'] = message['sender_queue_id']
-        send_event(message['realm'], event, users)
-
-        if links_for_embed:
-            event_data = {
-                'message_id': message['message'].id,
-                'message_content': message['message'].content,
-                'message_realm_id': message['realm'].id,
-                'urls': links_for_embed}
-            queue_json_publish('embed_links', event_data)
-
-        if message['message'].recipient.type == Recipient.PERSONAL:
-            welcome_bot_id = get_system_bot(settings.WELCOME_BOT).id
-            if (welcome_bot_id in message['active_user_ids'] and
-                    welcome_bot_id != message['message'].sender_id):
+            '''
+            TODO:  We may want to limit user_ids to only those users who have
+                   UserMessage rows, if only for minor performance reasons.
+
+                   For now we queue events for all subscribers/sendees of the
+                   message, since downstream code may still do notifications
+                   that don't require UserMessage rows.
+
+                   Our automated tests have gotten better on this codepath,
+                   but we may have coverage gaps, so we should be careful
+                   about changing the next line.
+            '''
+            user_ids = message['active_user_ids'] | set(user_flags.keys())
+
+            users = [
+                dict(
+                    id=user_id,
+                    flags=user_flags.get(user_id, []),
+                    always_push_notify=(user_id in message['push_notify_user_ids']),
+                    stream_push_notify=(user_id in message['stream_push_user_ids']),
+                    stream_email_notify=(user_id in message['stream_email_user_ids']),
+                    wildcard_mention_notify=(user_id in message['wildcard_mention_user_ids']),
+                )
+                for user_id in user_ids
+            ]
+
+            if message['message'].is_stream_message():
+                # Note: This is where authorization for single-stream
+                # get_updates happens! We only attach stream data to the
+                # notify new_message request if it's a public stream,
+                # ensuring that in the tornado server, non-public stream
+                # messages are only associated to their subscribed users.
+                assert message['stream'] is not None  # assert needed because stubs for django are missing
+                if message['stream'].is_public():
+                    event['realm_id'] = message['stream'].realm_id
+                    event['stream_name'] = message['stream'].name
+                if message['stream'].invite_only:
+                    event['invite_only'] = True
+                if message['stream'].first_message_id is None:
+                    message['stream'].first_message_id = message['message'].id
+                    message['stream'].save(update_fields=["first_message_id"])
+            if message['local_id'] is not None:
+                event['local_id'] = message['local_id']
+            if message['sender_queue_id'] is not None:
+                event['sender_queue_id'] = message['sender_queue_id']
+            send_event(message['realm'], event, users)
+
+            queue_events: List[Tuple[str, Dict[str, Any]]] = []
+            if links_for_embed:
+                event_data = {
+                    'message_id': message['message'].id,
+                    'message_content': message['message'].content,
+                    'message_realm_id': message['realm'].id,
+                    'urls': list(links_for_embed)}
+                queue_events.append(('embed_links', event_data))
+
+            welcome_bot_response = False
+            if message['message'].recipient.type == Recipient.PERSONAL:
+                welcome_bot_id = get_system_bot(settings.WELCOME_BOT).id
+                if (welcome_bot_id in message['active_user_ids'] and
+                        welcome_bot_id != message['message'].sender_id):
+                    welcome_bot_response = True
+
+            for queue_name, events in message['message'].service_queue_events.items():
+                for event in events:
+                    queue_events.append((
+                        queue_name,
+                        {
+                            "message": wide_message_dict,
+                            "trigger": event['trigger'],
+                            "user_profile_id": event["user_profile_id"],
+                        },
+                    ))
+
+            if defer_side_effects:
+                deferred_work.append(dict(
+                    message_id=message['message'].id,
+                    attachment_path_ids=message['message'].potential_attachment_path_ids,
+                    welcome_bot_response=welcome_bot_response,
+                    queue_events=queue_events,
+                ))
+                continue
+
+            if welcome_bot_response:
                 send_welcome_bot_response(message)
+            for queue_name, queue_event in queue_events:
+                queue_json_publish(queue_name, queue_event)
 
-        for queue_name, events in message['message'].service_queue_events.items():
-            for event in events:
-                queue_json_publish(
-                    queue_name,
-                    {
-                        "message": wide_message_dict,
-                        "trigger": event['trigger'],
-                        "user_profile_id": event["user_profile_id"],
-                    },
-                )
+        if deferred_work:
+            # If we're inside a transaction, the queue processor
+            # mustn't look for the messages until it commits.
+            deferred_event = dict(messages=deferred_work)
+            transaction.on_commit(lambda: queue_json_publish('deferred_message_work',
+                                                             deferred_event))
 
     # Note that this does not preserve the order of message ids
     # returned.  In practice, this shouldn't matter, as we only
@@ -1599,6 +1636,31 @@ def do_send_messages(messages_maybe_none: Sequence[Optional[MutableMapping[str,
     # intermingle sending zephyr messages with other messages.
     return already_sent_ids + [message['message'].id for message in messages]
 
+def do_deferred_message_work(deferred_work: Sequence[Mapping[str, Any]]) -> None:
+    """The secondary work of sending messages, which do_send_messages
+    defers to the deferred_message_work queue processor when
+    DEFER_MESSAGE_SIDE_EFFECTS is set."""
+    messages = Message.objects.select_related(
+        'sender', 'sender__realm', 'recipient',
+    ).in_bulk([work['message_id'] for work in deferred_work])
+
+    with queue_publish_batch():
+        for work in deferred_work:
+            message = messages.get(work['message_id'])
+            if message is None:
+                # The message was deleted before we got to it.
+                continue
+
+            if do_claim_attachments(message, work['attachment_path_ids']):
+                message.has_attachment = True
+                message.save(update_fields=['has_attachment'])
+
+            if work['welcome_bot_response']:
+                send_welcome_bot_response(dict(message=message, realm=message.sender.realm))
+
+            for queue_name, event in work['queue_events']:
+                queue_json_publish(queue_name, event)
+
 class UserMessageLite:
     '''
     The Django ORM is too slow for bulk operations.  This class
@@ -3879,28 +3941,55 @@ def default_stream_groups_to_dicts_sorted(groups: List[DefaultStreamGroup]) -> L
 
 def do_update_user_activity_interval(user_profile: UserProfile,
                                      log_time: datetime.datetime) -> None:
-    effective_end = log_time + UserActivityInterval.MIN_INTERVAL_LENGTH
-    # This code isn't perfect, because with various races we might end
-    # up creating two overlapping intervals, but that shouldn't happen
-    # often, and can be corrected for in post-processing
-    try:
-        last = UserActivityInterval.objects.filter(user_profile=user_profile).order_by("-end")[0]
+    do_update_user_activity_intervals([(user_profile.id, log_time)])
+
+def do_update_user_activity_intervals(updates: Sequence[Tuple[int, datetime.datetime]]) -> None:
+    """Records activity by each (user_profile_id, log_time) in updates,
+    processed in order, with three queries for the whole batch: one to
+    fetch each user's latest interval, and bulk writes of the intervals
+    we extend and the ones we create."""
+    if not updates:
+        return
+
+    # The interval with the latest end for each user; these are the
+    # only intervals we can extend.
+    last_by_user: Dict[int, UserActivityInterval] = {
+        interval.user_profile_id: interval
+        for interval in UserActivityInterval.objects.filter(
+            user_profile_id__in={user_profile_id for user_profile_id, log_time in updates},
+        ).order_by('user_profile_id', '-end').distinct('user_profile_id')
+    }
+    created: List[UserActivityInterval] = []
+    # A dict used as an ordered set of existing intervals to save.
+    extended: Dict[int, UserActivityInterval] = {}
+
+    for user_profile_id, log_time in updates:
+        effective_end = log_time + UserActivityInterval.MIN_INTERVAL_LENGTH
+        # This code isn't perfect, because with various races we might end
+        # up creating two overlapping intervals, but that shouldn't happen
+        # often, and can be corrected for in post-processing
+        last = last_by_user.get(user_profile_id)
         # There are two ways our intervals could overlap:
         # (1) The start of the new interval could be inside the old interval
         # (2) The end of the new interval could be inside the old interval
         # In either case, we just extend the old interval to include the new interval.
-        if ((log_time <= last.end and log_time >= last.start) or
-                (effective_end <= last.end and effective_end >= last.start)):
+        if last is not None and ((log_time <= last.end and log_time >= last.start) or
+                                 (effective_end <= last.end and effective_end >= last.start)):
             last.end = max(last.end, effective_end)
             last.start = min(last.start, log_time)
-            last.save(update_fields=["start", "end"])
-            return
-    except IndexError:
-        pass
+            if last.id is not None:
+                extended[last.id] = last
+            continue
 
-    # Otherwise, the intervals don't overlap, so we should make a new one
-    UserActivityInterval.objects.create(user_profile=user_profile, start=log_time,
+        # Otherwise, the intervals don't overlap, so we should make a new one
+        interval = UserActivityInterval(user_profile_id=user_profile_id, start=log_time,
                                         end=effective_end)
+        created.append(interval)
+        if last is None or effective_end > last.end:
+            last_by_user[user_profile_id] = interval
+
+    UserActivityInterval.objects.bulk_update(list(extended.values()), ['start', 'end'])
+    UserActivityInterval.objects.bulk_create(created)
 
 @statsd_increment('user_activity')
 def do_update_user_activity(user_profile_id: int,
@@ -3908,16 +3997,34 @@ def do_update_user_activity(user_profile_id: int,
                             query: str,
                             count: int,
                             log_time: datetime.datetime) -> None:
-    (activity, created) = UserActivity.objects.get_or_create(
-        user_profile_id = user_profile_id,
-        client_id = client_id,
-        query = query,
-        defaults={'last_visit': log_time, 'count': count})
+    do_update_user_activities({(user_profile_id, client_id, query): (count, log_time)})
+
+def do_update_user_activities(
+        activities: Mapping[Tuple[int, int, str], Tuple[int, datetime.datetime]]) -> None:
+    """Adds the counts in activities, a map from (user_profile_id,
+    client_id, query) to (count, last_visit), to the UserActivity
+    rows, creating any that don't exist yet, with a single upsert
+    query per thousand rows."""
+    if not activities:
+        return
 
-    if not created:
-        activity.count += count
-        activity.last_visit = log_time
-        activity.save(update_fields=["last_visit", "count"])
+    # Sorting the rows makes concurrent upserts lock them in the
+    # same order, so they can't deadlock.
+    vals = sorted(
+        (user_profile_id, client_id, query, count, log_time)
+        for (user_profile_id, client_id, query), (count, log_time) in activities.items()
+    )
+    upsert_query = SQL('''
+        INSERT INTO
+            zerver_useractivity (user_profile_id, client_id, query, count, last_visit)
+        VALUES %s
+        ON CONFLICT (user_profile_id, client_id, query) DO UPDATE SET
+            count = zerver_useractivity.count + EXCLUDED.count,
+            last_visit = EXCLUDED.last_visit
+    ''')
+
+    with connection.cursor() as cursor:
+        execute_values(cursor.cursor, upsert_query, vals, page_size=1000)
 
 def send_presence_changed(user_profile: UserProfile, presence: UserPresence) -> None:
     presence_dict = presence.to_dict()
@@ -3940,49 +4047,68 @@ def consolidate_client(client: Client) -> Client:
     else:
         return client
 
+PresenceUpdate = Tuple[UserProfile, Client, datetime.datetime, int]
+
 @statsd_increment('user_presence')
 def do_update_user_presence(user_profile: UserProfile,
                             client: Client,
                             log_time: datetime.datetime,
                             status: int) -> None:
-    client = consolidate_client(client)
-
-    defaults = dict(
-        timestamp=log_time,
-        status=status,
-        realm_id=user_profile.realm_id,
-    )
-
-    (presence, created) = UserPresence.objects.get_or_create(
-        user_profile = user_profile,
-        client = client,
-        defaults = defaults,
-    )
+    do_update_user_presences([(user_profile, client, log_time, status)])
+
+def do_update_user_presences(updates: Sequence[PresenceUpdate]) -> None:
+    """Applies a batch of presence updates, in order.  The batch is
+    coalesced in memory, so that each UserPresence row it touches is
+    written at most once, with a few bulk queries, and each user who
+    comes online is announced with a single event."""
+    updates = [(user_profile, consolidate_client(client), log_time, status)
+               for (user_profile, client, log_time, status) in updates]
+    presences: Dict[Tuple[int, int], UserPresence] = {
+        (presence.user_profile_id, presence.client_id): presence
+        for presence in UserPresence.objects.filter(
+            user_profile_id__in={update[0].id for update in updates},
+            client_id__in={update[1].id for update in updates},
+        )
+    }
+    created_keys: Set[Tuple[int, int]] = set()
+    # Dicts used as ordered sets, keyed by (user_profile_id, client_id).
+    changed_keys: Dict[Tuple[int, int], None] = {}
+    announced_keys: Dict[Tuple[int, int], UserProfile] = {}
+
+    for (user_profile, client, log_time, status) in updates:
+        key = (user_profile.id, client.id)
+        created = key not in presences
+        if created:
+            presences[key] = UserPresence(
+                user_profile=user_profile,
+                client=client,
+                realm_id=user_profile.realm_id,
+                timestamp=log_time,
+                status=status,
+            )
+            created_keys.add(key)
+            changed_keys[key] = None
+        presence = presences[key]
+
+        stale_status = (log_time - presence.timestamp) > datetime.timedelta(minutes=1, seconds=10)
+        was_idle = presence.status == UserPresence.IDLE
+        became_online = (status == UserPresence.ACTIVE) and (stale_status or was_idle)
+
+        # We suppress changes from ACTIVE to IDLE before stale_status is reached;
+        # this protects us from the user having two clients open: one active, the
+        # other idle. Without this check, we would constantly toggle their status
+        # between the two states.
+        if not created and stale_status or was_idle or status == presence.status:
+            presence.timestamp = log_time
+            presence.status = status
+            changed_keys[key] = None
 
-    stale_status = (log_time - presence.timestamp) > datetime.timedelta(minutes=1, seconds=10)
-    was_idle = presence.status == UserPresence.IDLE
-    became_online = (status == UserPresence.ACTIVE) and (stale_status or was_idle)
+        if not user_profile.realm.presence_disabled and (created or became_online):
+            announced_keys[key] = user_profile
 
-    # If an object was created, it has already been saved.
-    #
-    # We suppress changes from ACTIVE to IDLE before stale_status is reached;
-    # this protects us from the user having two clients open: one active, the
-    # other idle. Without this check, we would constantly toggle their status
-    # between the two states.
-    if not created and stale_status or was_idle or status == presence.status:
-        # The following block attempts to only update the "status"
-        # field in the event that it actually changed.  This is
-        # important to avoid flushing the UserPresence cache when the
-        # data it would return to a client hasn't actually changed
-        # (see the UserPresence post_save hook for details).
-        presence.timestamp = log_time
-        update_fields = ["timestamp"]
-        if presence.status != status:
-            presence.status = status
-            update_fields.append("status")
-        presence.save(update_fields=update_fields)
+    save_user_presences([presences[key] for key in changed_keys], created_keys)
 
-    if not user_profile.realm.presence_disabled and (created or became_online):
+    for key, user_profile in announced_keys.items():
         # Push event to all users in the realm so they see the new user
         # appear in the presence list immediately, or the newly online
         # user without delay.  Note that we won't send an update here for a
@@ -3993,7 +4119,40 @@ def do_update_user_presence(user_profile: UserProfile,
         # sending timestamp updates, we could eliminate the ping responses, but
         # that's not a high priority for now, considering that most of our non-MIT
         # realms are pretty small.
-        send_presence_changed(user_profile, presence)
+        send_presence_changed(user_profile, presences[key])
+
+def save_user_presences(presences: List[UserPresence],
+                        created_keys: Set[Tuple[int, int]]) -> None:
+    if not presences:
+        return
+    realm_ids = sorted({presence.realm_id for presence in presences})
+    with transaction.atomic():
+        # Holding the lock on each realm's PresenceSequence until we
+        # commit ensures that clients never see a row with a given
+        # last_update_id before all rows with smaller IDs.
+        PresenceSequence.objects.bulk_create(
+            [PresenceSequence(realm_id=realm_id) for realm_id in realm_ids],
+            ignore_conflicts=True,
+        )
+        sequences = list(PresenceSequence.objects.select_for_update().filter(
+            realm_id__in=realm_ids).order_by('realm_id'))
+        sequence_by_realm = {sequence.realm_id: sequence for sequence in sequences}
+        for presence in presences:
+            sequence = sequence_by_realm[presence.realm_id]
+            sequence.last_update_id += 1
+            presence.last_update_id = sequence.last_update_id
+        PresenceSequence.objects.bulk_update(sequences, ['last_update_id'])
+
+        new_presences = [presence for presence in presences
+                         if (presence.user_profile_id, presence.client_id) in created_keys]
+        # A row created concurrently by another writer is fine to
+        # drop; the client's next ping will update it.
+        UserPresence.objects.bulk_create(new_presences, ignore_conflicts=True)
+        UserPresence.objects.bulk_update(
+            [presence for presence in presences
+             if (presence.user_profile_id, presence.client_id) not in created_keys],
+            ['timestamp', 'status', 'last_update_id'],
+        )
 
 def update_user_activity_interval(user_profile: UserProfile, log_time: datetime.datetime) -> None:
     event = {'user_profile_id': user_profile.id,
@@ -4350,6 +4509,7 @@ def update_user_message_flags(message: Message, ums: Iterable[UserMessage]) -> N
 
     for um in changed_ums:
         um.save(update_fields=['flags'])
+    flush_unread_index_for_users(um.user_profile_id for um in changed_ums)
 
 def update_to_dict_cache(changed_messages: List[Message], realm_id: Optional[int]=None) -> List[int]:
     """Updates the message as stored in the to_dict cache (for serving
@@ -4363,6 +4523,10 @@ def update_to_dict_cache(changed_messages: List[Message], realm_id: Optional[int
         items_for_remote_cache[key] = (msg,)
 
     cache_set_many(items_for_remote_cache)
+    # The encoded message fragments are rebuilt from the new to_dict
+    # cache entries when next fetched.
+    cache_delete_many([key for msg_id in message_ids
+                       for key in message_fragment_cache_keys(msg_id)])
     return message_ids
 
 # We use transaction.atomic to support select_for_update in the attachment codepath.
@@ -4614,6 +4778,11 @@ def do_update_message(user_profile: UserProfile, message: Message,
     # This does message.save(update_fields=[...])
     save_message_for_edit_use_case(message=message)
 
+    if topic_name is not None or new_stream is not None:
+        # Users' unread indexes record the stream and topic of their
+        # unread messages.
+        flush_unread_index_for_realm(user_profile.realm_id)
+
     realm_id: Optional[int] = None
     if stream_being_edited is not None:
         realm_id = stream_being_edited.realm_id
@@ -1,15 +1,45 @@
-from typing import Dict, Iterable, List
+# Rendering a message finds the alert words in it using an
+# Aho-Corasick automaton of all the alert words in the realm.  For
+# realms with many alert words, that automaton is large, so rather
+# than sharing it via memcached (where every render would have to
+# fetch and unpickle it), each process builds it from the realm's
+# alert words and keeps it, for recently used realms, in memory.
+#
+# Each realm's alert words have a version, an integer in memcached.
+# When a user's alert words change, publish_alert_word_change
+# (called by AlertWord's post_save and post_delete signal handlers, and
+# by add_user_alert_words, since bulk_create doesn't send signals)
+# increments the version and saves the change (the words added and
+# removed) under the new version.  A process whose automaton is a few
+# versions behind then applies the changes it missed to its copy of
+# the realm's words, and only fetches all of the realm's alert words
+# if a change (or the version) has been evicted from memcached.
+import secrets
+import threading
+from collections import OrderedDict
+from typing import Dict, FrozenSet, Iterable, List, Optional, Tuple
 
 import ahocorasick
 from django.db import transaction
 
 from zerver.lib.cache import (
+    cache_get_many,
+    cache_incr,
+    cache_set_many,
     cache_with_key,
-    realm_alert_words_automaton_cache_key,
     realm_alert_words_cache_key,
+    realm_alert_words_change_cache_key,
+    realm_alert_words_version_cache_key,
 )
 from zerver.models import AlertWord, Realm, UserProfile, flush_realm_alert_words
 
+ALERT_WORDS_CACHE_TIMEOUT = 3600 * 24
+ALERT_WORDS_MAX_CHANGES = 100
+ALERT_WORDS_LOCAL_SIZE = 100
+
+# A change to a user's alert words: the user's ID, and the
+# (lowercased) words added and removed.
+AlertWordChange = Tuple[int, List[str], List[str]]
 
 @cache_with_key(realm_alert_words_cache_key, timeout=3600*24)
 def alert_words_in_realm(realm: Realm) -> Dict[int, List[str]]:
@@ -21,26 +51,110 @@ def alert_words_in_realm(realm: Realm) -> Dict[int, List[str]]:
         user_ids_with_words[id_and_word["user_profile_id"]].append(id_and_word["word"])
     return user_ids_with_words
 
-@cache_with_key(realm_alert_words_automaton_cache_key, timeout=3600*24)
-def get_alert_word_automaton(realm: Realm) -> ahocorasick.Automaton:
-    user_id_with_words = alert_words_in_realm(realm)
-    alert_word_automaton  = ahocorasick.Automaton()
-    for (user_id, alert_words) in user_id_with_words.items():
-        for alert_word in alert_words:
-            alert_word_lower = alert_word.lower()
-            if alert_word_automaton.exists(alert_word_lower):
-                (key, user_ids_for_alert_word) = alert_word_automaton.get(alert_word_lower)
-                user_ids_for_alert_word.add(user_id)
-            else:
-                alert_word_automaton.add_word(alert_word_lower, (alert_word_lower, {user_id}))
-    alert_word_automaton.make_automaton()
-    # If the kind is not AHOCORASICK after calling make_automaton, it means there is no key present
-    # and hence we cannot call items on the automaton yet. To avoid it we return None for such cases
-    # where there is no alert-words in the realm.
-    # https://pyahocorasick.readthedocs.io/en/latest/index.html?highlight=Automaton.kind#module-constants
-    if alert_word_automaton.kind != ahocorasick.AHOCORASICK:
-        return None
-    return alert_word_automaton
+class RealmAlertWords:
+    def __init__(self, version: int, user_ids_by_word: Dict[str, FrozenSet[int]]) -> None:
+        self.version = version
+        self.user_ids_by_word = user_ids_by_word
+        # We build a new automaton rather than modifying the old one,
+        # since it may be in use by a render in another thread, and
+        # pyahocorasick has to redo make_automaton after adding or
+        # removing words anyway.
+        automaton = ahocorasick.Automaton()
+        for word, user_ids in user_ids_by_word.items():
+            automaton.add_word(word, (word, user_ids))
+        automaton.make_automaton()
+        # If the kind is not AHOCORASICK after calling make_automaton, it means there is no key present
+        # and hence we cannot call items on the automaton yet. To avoid it we use None for such cases
+        # where there is no alert-words in the realm.
+        # https://pyahocorasick.readthedocs.io/en/latest/index.html?highlight=Automaton.kind#module-constants
+        self.automaton: Optional[ahocorasick.Automaton] = None
+        if automaton.kind == ahocorasick.AHOCORASICK:
+            self.automaton = automaton
+
+    @staticmethod
+    def from_realm(realm: Realm, version: int) -> 'RealmAlertWords':
+        user_ids_by_word: Dict[str, FrozenSet[int]] = {}
+        for (user_id, alert_words) in alert_words_in_realm(realm).items():
+            for alert_word in alert_words:
+                alert_word_lower = alert_word.lower()
+                user_ids_by_word[alert_word_lower] = \
+                    user_ids_by_word.get(alert_word_lower, frozenset()) | {user_id}
+        return RealmAlertWords(version, user_ids_by_word)
+
+    def updated_to(self, realm_id: int, version: int) -> Optional['RealmAlertWords']:
+        """Applies the changes since our version, if they're all still
+        in memcached."""
+        if not (self.version < version <= self.version + ALERT_WORDS_MAX_CHANGES):
+            return None
+        keys = [realm_alert_words_change_cache_key(realm_id, change_version)
+                for change_version in range(self.version + 1, version + 1)]
+        changes = cache_get_many(keys)
+        if len(changes) != len(keys):
+            return None
+
+        user_ids_by_word = dict(self.user_ids_by_word)
+        for key in keys:
+            user_id, added, removed = changes[key]
+            for word in added:
+                user_ids_by_word[word] = user_ids_by_word.get(word, frozenset()) | {user_id}
+            for word in removed:
+                user_ids = user_ids_by_word.get(word, frozenset()) - {user_id}
+                if user_ids:
+                    user_ids_by_word[word] = user_ids
+                else:
+                    user_ids_by_word.pop(word, None)
+        return RealmAlertWords(version, user_ids_by_word)
+
+# Maps realm IDs to their alert words, most recently used last.
+# Messages can be rendered from several threads at once, so this is
+# only accessed while holding local_alert_words_lock.
+local_alert_words: 'OrderedDict[int, RealmAlertWords]' = OrderedDict()
+local_alert_words_lock = threading.Lock()
+
+def get_alert_word_automaton(realm: Realm) -> Optional[ahocorasick.Automaton]:
+    version_key = realm_alert_words_version_cache_key(realm.id)
+    version = cache_get_many([version_key]).get(version_key)
+    if version is None:
+        # Start from a random version, so that no process's automaton
+        # from before the version was evicted can look current.
+        version = secrets.randbelow(2**48)
+        cache_set_many({version_key: version}, timeout=ALERT_WORDS_CACHE_TIMEOUT)
+
+    with local_alert_words_lock:
+        alert_words = local_alert_words.get(realm.id)
+    if alert_words is not None and alert_words.version != version:
+        alert_words = alert_words.updated_to(realm.id, version)
+    if alert_words is None:
+        alert_words = RealmAlertWords.from_realm(realm, version)
+
+    with local_alert_words_lock:
+        local_alert_words[realm.id] = alert_words
+        local_alert_words.move_to_end(realm.id)
+        while len(local_alert_words) > ALERT_WORDS_LOCAL_SIZE:
+            local_alert_words.popitem(last=False)
+    return alert_words.automaton
+
+def publish_alert_word_change(realm: Realm, change: Optional[AlertWordChange]) -> None:
+    """Publishes a change to the realm's alert words.  If `change` is
+    None (we don't know what changed), processes rebuild the realm's
+    automaton from the database."""
+    def publish() -> None:
+        # Django bulk operations don't flush caches, so we need to do this ourselves.
+        flush_realm_alert_words(realm)
+        version = cache_incr(realm_alert_words_version_cache_key(realm.id))
+        if version is not None and change is not None:
+            cache_set_many({realm_alert_words_change_cache_key(realm.id, version): change},
+                           timeout=ALERT_WORDS_CACHE_TIMEOUT)
+
+    if change is not None:
+        user_id, added, removed = change
+        if not added and not removed:
+            return
+    publish()
+    # A process which rebuilds its automaton from the database before
+    # the transaction commits would miss the change, so we publish it
+    # again once it's visible; applying a change twice is harmless.
+    transaction.on_commit(publish)
 
 def user_alert_words(user_profile: UserProfile) -> List[str]:
     return list(AlertWord.objects.filter(user_profile=user_profile).values_list("word", flat=True))
@@ -61,8 +175,7 @@ def add_user_alert_words(user_profile: UserProfile, new_words: Iterable[str]) ->
         AlertWord(user_profile=user_profile, word=word, realm=user_profile.realm)
         for word in word_dict.values()
     )
-    # Django bulk_create operations don't flush caches, so we need to do this ourselves.
-    flush_realm_alert_words(user_profile.realm)
+    publish_alert_word_change(user_profile.realm, (user_profile.id, list(word_dict), []))
 
     return user_alert_words(user_profile)
 
@@ -70,7 +183,7 @@ def add_user_alert_words(user_profile: UserProfile, new_words: Iterable[str]) ->
 def remove_user_alert_words(user_profile: UserProfile, delete_words: Iterable[str]) -> List[str]:
     # TODO: Ideally, this would be a bulk query, but Django doesn't have a `__iexact`.
     # We can clean this up if/when Postgres has more native support for case-insensitive fields.
-    # If we turn this into a bulk operation, we will need to call flush_realm_alert_words() here.
+    # AlertWord's post_delete signal handler publishes the changes.
     for delete_word in delete_words:
         AlertWord.objects.filter(user_profile=user_profile, word__iexact=delete_word).delete()
     return user_alert_words(user_profile)
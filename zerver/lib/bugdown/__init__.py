@@ -1,15 +1,17 @@
 # Zulip's main markdown implementation.  See docs/subsystems/markdown.md for
 # detailed documentation on our markdown syntax.
+import copy
 import datetime
 import functools
 import html
 import logging
 import os
 import re
+import threading
 import time
 import urllib
 import urllib.parse
-from collections import defaultdict, deque
+from collections import OrderedDict, defaultdict, deque
 from dataclasses import dataclass
 from io import StringIO
 from typing import (
@@ -20,6 +22,7 @@ from typing import (
     Iterable,
     List,
     Optional,
+    Sequence,
     Set,
     Tuple,
     TypeVar,
@@ -34,6 +37,7 @@ import dateutil.parser
 import dateutil.tz
 import markdown
 import requests
+import ujson
 from django.conf import settings
 from django.db.models import Q
 from hyperlink import parse
@@ -43,7 +47,7 @@ from typing_extensions import TypedDict
 from zerver.lib import mention as mention
 from zerver.lib.bugdown import fenced_code
 from zerver.lib.bugdown.fenced_code import FENCE_RE
-from zerver.lib.cache import NotFoundInCache, cache_with_key
+from zerver.lib.cache import NotFoundInCache, cache_get, cache_set, cache_with_key
 from zerver.lib.camo import get_camo_url
 from zerver.lib.emoji import (
     codepoint_to_name,
@@ -59,6 +63,7 @@ from zerver.lib.timeout import TimeoutExpired, timeout
 from zerver.lib.timezone import get_common_timezones
 from zerver.lib.url_encoding import encode_stream, hash_util_encode
 from zerver.lib.url_preview import preview as link_preview
+from zerver.lib.utils import make_safe_digest
 from zerver.models import (
     MAX_MESSAGE_LENGTH,
     Message,
@@ -2167,7 +2172,23 @@ def get_possible_mentions_info(realm_id: int, mention_texts: Set[str]) -> List[F
 
 class MentionData:
     def __init__(self, realm_id: int, content: str) -> None:
-        mention_texts, has_wildcards = possible_mentions(content)
+        self.init_mention_data(realm_id, [content])
+
+    @classmethod
+    def for_contents(cls, realm_id: int, contents: Sequence[str]) -> 'MentionData':
+        """Mention data covering all of the given contents, fetched with
+        the same number of queries as for a single message."""
+        mention_data = cls.__new__(cls)
+        mention_data.init_mention_data(realm_id, contents)
+        return mention_data
+
+    def init_mention_data(self, realm_id: int, contents: Sequence[str]) -> None:
+        mention_texts: Set[str] = set()
+        has_wildcards = False
+        for content in contents:
+            content_mention_texts, content_has_wildcards = possible_mentions(content)
+            mention_texts |= content_mention_texts
+            has_wildcards = has_wildcards or content_has_wildcards
         possible_mentions_info = get_possible_mentions_info(realm_id, mention_texts)
         self.full_name_info = {
             row['full_name'].lower(): row
@@ -2177,7 +2198,7 @@ class MentionData:
             row['id']: row
             for row in possible_mentions_info
         }
-        self.init_user_group_data(realm_id=realm_id, content=content)
+        self.init_user_group_data(realm_id=realm_id, contents=contents)
         self.has_wildcards = has_wildcards
 
     def message_has_wildcards(self) -> bool:
@@ -2185,8 +2206,10 @@ class MentionData:
 
     def init_user_group_data(self,
                              realm_id: int,
-                             content: str) -> None:
-        user_group_names = possible_user_group_mentions(content)
+                             contents: Sequence[str]) -> None:
+        user_group_names: Set[str] = set()
+        for content in contents:
+            user_group_names |= possible_user_group_mentions(content)
         self.user_group_name_info = get_user_group_name_info(realm_id, user_group_names)
         self.user_group_members: Dict[int, List[int]] = defaultdict(list)
         group_ids = [group.id for group in self.user_group_name_info.values()]
@@ -2259,6 +2282,136 @@ def get_stream_name_info(realm: Realm, stream_names: Set[str]) -> Dict[str, Full
     }
     return dct
 
+class BatchRenderData:
+    """The data do_convert fetches from the database, fetched just once
+    for rendering a batch of messages in a realm; see
+    render_markdown_batch in zerver/lib/message.py."""
+
+    def __init__(self, realm: Realm, contents: Sequence[str]) -> None:
+        self.mention_data = MentionData.for_contents(realm.id, contents)
+
+        emails: Set[str] = set()
+        stream_names: Set[str] = set()
+        has_emoji_syntax = False
+        for content in contents:
+            emails |= possible_avatar_emails(content)
+            stream_names |= possible_linked_stream_names(content)
+            has_emoji_syntax = has_emoji_syntax or content_has_emoji_syntax(content)
+        self.email_info = get_email_info(realm.id, emails)
+        self.stream_name_info = get_stream_name_info(realm, stream_names)
+        if has_emoji_syntax:
+            self.active_realm_emoji = realm.get_active_emoji()
+        else:
+            self.active_realm_emoji = dict()
+
+# Rendering the same content with the same inputs always produces the
+# same result, and some content (e.g. from CI or monitoring bots) is
+# sent thousands of times, so we cache rendered content in memcached,
+# with a small per-process LRU cache in front of it.  The cache key is
+# a digest of the content and of everything else rendering depends on
+# (the realm's filters, and the users, user groups, streams and emoji
+# which the content could refer to), so changes to any of those
+# naturally invalidate the cached results they affect.
+RENDER_CACHE_TIMEOUT = 3600 * 24
+RENDER_CACHE_LOCAL_SIZE = 1000
+render_cache: 'OrderedDict[str, Dict[str, Any]]' = OrderedDict()
+# Messages can be rendered from several threads at once (rendering
+# runs in a thread for its timeout, and `process_queue --multi_threaded`
+# runs each queue's worker in a thread), so render_cache is only
+# accessed while holding this lock.
+render_cache_lock = threading.Lock()
+
+# The attributes rendering sets on the message being rendered, which
+# we need to restore when using a cached result.
+MESSAGE_RENDER_ATTRIBUTES = [
+    'mentions_wildcard',
+    'mentions_user_ids',
+    'mentions_user_group_ids',
+    'has_link',
+    'has_image',
+    'potential_attachment_path_ids',
+]
+
+def render_cache_key(content: str, engine: markdown.Markdown,
+                     realm_filters_key: int, email_gateway: bool) -> str:
+    key_data: List[Any] = [
+        version,
+        content,
+        realm_filters_key,
+        email_gateway,
+        realm_filter_data.get(realm_filters_key),
+        engine.zulip_message is not None,
+        engine.image_preview_enabled,
+        engine.url_embed_preview_enabled,
+    ]
+    db_data = engine.zulip_db_data
+    if db_data is not None:
+        mention_data = db_data['mention_data']
+        key_data += [
+            db_data['realm_uri'],
+            db_data['sent_by_bot'],
+            db_data['translate_emoticons'],
+            mention_data.full_name_info,
+            mention_data.user_id_info,
+            {name: [group.id, sorted(mention_data.user_group_members.get(group.id, []))]
+             for name, group in mention_data.user_group_name_info.items()},
+            mention_data.has_wildcards,
+            db_data['email_info'],
+            db_data['stream_names'],
+            db_data['active_realm_emoji'],
+        ]
+    return 'bugdown_render:' + make_safe_digest(ujson.dumps(key_data, sort_keys=True))
+
+def get_cached_render(key: str) -> Optional[Dict[str, Any]]:
+    with render_cache_lock:
+        result = render_cache.get(key)
+        if result is not None:
+            render_cache.move_to_end(key)
+            return result
+    cached = cache_get(key)
+    if cached is None:
+        return None
+    result = cached[0]
+    save_local_render(key, result)
+    return result
+
+def save_local_render(key: str, result: Dict[str, Any]) -> None:
+    with render_cache_lock:
+        render_cache[key] = result
+        if len(render_cache) > RENDER_CACHE_LOCAL_SIZE:
+            render_cache.popitem(last=False)
+
+def save_render(key: str, engine: markdown.Markdown, rendered_content: str) -> None:
+    result: Dict[str, Any] = {'rendered_content': rendered_content}
+    message = engine.zulip_message
+    if message is not None:
+        if getattr(message, 'links_for_preview', None):
+            # The message will be re-rendered once the previews for
+            # these links have been fetched, and needs to render
+            # differently then.
+            return
+        result['message'] = {
+            attr: copy.copy(getattr(message, attr))
+            for attr in MESSAGE_RENDER_ATTRIBUTES if hasattr(message, attr)
+        }
+    save_local_render(key, result)
+    cache_set(key, result, timeout=RENDER_CACHE_TIMEOUT)
+
+def apply_cached_render(engine: markdown.Markdown, content: str, result: Dict[str, Any]) -> str:
+    message = engine.zulip_message
+    if message is not None:
+        for attr, value in result['message'].items():
+            setattr(message, attr, copy.copy(value))
+
+        db_data = engine.zulip_db_data
+        if db_data is not None and db_data['realm_alert_words_automaton'] is not None:
+            # Which users' alert words the content matches isn't part
+            # of the cache key, so we find out by running just the
+            # preprocessors (which include AlertWordNotificationProcessor).
+            lines = content.split("\n")
+            for preprocessor in engine.preprocessors:
+                lines = preprocessor.run(lines)
+    return result['rendered_content']
 
 def do_convert(content: str,
                realm_alert_words_automaton: Optional[ahocorasick.Automaton] = None,
@@ -2268,7 +2421,8 @@ def do_convert(content: str,
                translate_emoticons: bool=False,
                mention_data: Optional[MentionData]=None,
                email_gateway: bool=False,
-               no_previews: bool=False) -> str:
+               no_previews: bool=False,
+               batch_data: Optional[BatchRenderData]=None) -> str:
     """Convert Markdown to HTML, with Zulip-specific settings and hacks."""
     # This logic is a bit convoluted, but the overall goal is to support a range of use cases:
     # * Nothing is passed in other than content -> just run default options (e.g. for docs)
@@ -2296,10 +2450,14 @@ def do_convert(content: str,
 
     maybe_update_markdown_engines(realm_filters_key, email_gateway)
     md_engine_key = (realm_filters_key, email_gateway)
+    # Batch renders skip the render cache; their contents are mostly
+    # distinct, so it would just add a round trip per message.
+    use_render_cache = settings.BUGDOWN_RENDER_CACHE and batch_data is None
 
     if md_engine_key in md_engines:
         _md_engine = md_engines[md_engine_key]
     else:
+        use_render_cache = False
         if DEFAULT_BUGDOWN_KEY not in md_engines:
             maybe_update_markdown_engines(realm_filters_key=None, email_gateway=False)
 
@@ -2325,19 +2483,26 @@ def do_convert(content: str,
         # the fetches are somewhat expensive and these types of syntax
         # are uncommon enough that it's a useful optimization.
 
-        if mention_data is None:
-            mention_data = MentionData(message_realm.id, content)
+        if batch_data is not None:
+            if mention_data is None:
+                mention_data = batch_data.mention_data
+            email_info = batch_data.email_info
+            stream_name_info = batch_data.stream_name_info
+            active_realm_emoji = batch_data.active_realm_emoji
+        else:
+            if mention_data is None:
+                mention_data = MentionData(message_realm.id, content)
 
-        emails = possible_avatar_emails(content)
-        email_info = get_email_info(message_realm.id, emails)
+            emails = possible_avatar_emails(content)
+            email_info = get_email_info(message_realm.id, emails)
 
-        stream_names = possible_linked_stream_names(content)
-        stream_name_info = get_stream_name_info(message_realm, stream_names)
+            stream_names = possible_linked_stream_names(content)
+            stream_name_info = get_stream_name_info(message_realm, stream_names)
 
-        if content_has_emoji_syntax(content):
-            active_realm_emoji = message_realm.get_active_emoji()
-        else:
-            active_realm_emoji = dict()
+            if content_has_emoji_syntax(content):
+                active_realm_emoji = message_realm.get_active_emoji()
+            else:
+                active_realm_emoji = dict()
 
         _md_engine.zulip_db_data = {
             'realm_alert_words_automaton': realm_alert_words_automaton,
@@ -2356,6 +2521,12 @@ def do_convert(content: str,
         # extremely inefficient in corner cases) as well as user
         # errors (e.g. a realm filter that makes some syntax
         # infinite-loop).
+        if use_render_cache:
+            cache_key = render_cache_key(content, _md_engine, realm_filters_key, email_gateway)
+            cached_result = get_cached_render(cache_key)
+            if cached_result is not None:
+                return apply_cached_render(_md_engine, content, cached_result)
+
         rendered_content = timeout(5, _md_engine.convert, content)
 
         # Throw an exception if the content is huge; this protects the
@@ -2365,6 +2536,8 @@ def do_convert(content: str,
             raise BugdownRenderingException(
                 f'Rendered content exceeds {MAX_MESSAGE_LENGTH * 10} characters (message {logging_message_id})'
             )
+        if use_render_cache:
+            save_render(cache_key, _md_engine, rendered_content)
         return rendered_content
     except Exception:
         cleaned = privacy_clean_markdown(content)
@@ -2415,11 +2588,12 @@ def convert(content: str,
             translate_emoticons: bool=False,
             mention_data: Optional[MentionData]=None,
             email_gateway: bool=False,
-            no_previews: bool=False) -> str:
+            no_previews: bool=False,
+            batch_data: Optional[BatchRenderData]=None) -> str:
     bugdown_stats_start()
     ret = do_convert(content, realm_alert_words_automaton,
                      message, message_realm, sent_by_bot,
                      translate_emoticons, mention_data, email_gateway,
-                     no_previews=no_previews)
+                     no_previews=no_previews, batch_data=batch_data)
     bugdown_stats_finish()
     return ret
@@ -26,6 +26,7 @@ from django.conf import settings
 from django.core.cache import cache as djcache
 from django.core.cache import caches
 from django.core.cache.backends.base import BaseCache
+from django.db import connection, transaction
 from django.db.models import Q
 from django.http import HttpRequest
 from django.utils.lru_cache import lru_cache
@@ -302,6 +303,20 @@ def safe_cache_set_many(items: Dict[str, Any], cache_name: Optional[str]=None,
         good_items = {key: items[key] for key in good_keys}
         return cache_set_many(good_items, cache_name, timeout)
 
+def cache_incr(key: str, cache_name: Optional[str]=None) -> Optional[int]:
+    """Atomically increments an integer saved with cache_set_many,
+    returning the new value, or None if the key isn't in the cache."""
+    final_key = KEY_PREFIX + key
+    validate_cache_key(final_key)
+
+    remote_cache_stats_start()
+    try:
+        return get_cache_backend(cache_name).incr(final_key)
+    except ValueError:
+        return None
+    finally:
+        remote_cache_stats_finish()
+
 def cache_delete(key: str, cache_name: Optional[str]=None) -> None:
     final_key = KEY_PREFIX + key
     validate_cache_key(final_key)
@@ -318,6 +333,17 @@ def cache_delete_many(items: Iterable[str], cache_name: Optional[str]=None) -> N
     get_cache_backend(cache_name).delete_many(keys)
     remote_cache_stats_finish()
 
+def cache_delete_many_now_and_on_commit(items: Iterable[str]) -> None:
+    """Deletes the keys, and if we're in a transaction, deletes them
+    again once it commits, since a request which runs before then
+    could cache a value computed from the old data under them."""
+    keys = list(items)
+    if not keys:
+        return
+    cache_delete_many(keys)
+    if connection.in_atomic_block:
+        transaction.on_commit(lambda: cache_delete_many(keys))
+
 def filter_good_and_bad_keys(keys: List[str]) -> Tuple[List[str], List[str]]:
     good_keys = []
     bad_keys = []
@@ -460,6 +486,27 @@ realm_user_dict_fields: List[str] = [
 def realm_user_dicts_cache_key(realm_id: int) -> str:
     return f"realm_user_dicts:{realm_id}"
 
+def realm_snapshot_version_cache_key(realm_id: int, section: str) -> str:
+    return f"realm_snapshot_version:{realm_id}:{section}"
+
+def realm_snapshot_cache_key(realm_id: int, section: str, variant: str, version: str) -> str:
+    return f"realm_snapshot:{realm_id}:{section}:{variant}:{version}"
+
+def message_fetch_plan_cache_key(plan_id: str) -> str:
+    return f"message_fetch_plan:{plan_id}"
+
+def unread_index_cache_key(user_profile_id: int) -> str:
+    return f"unread_index:{user_profile_id}"
+
+def unread_index_epoch_cache_key(realm_id: int) -> str:
+    return f"unread_index_epoch:{realm_id}"
+
+def narrow_result_cache_key(user_profile_id: int, narrow_digest: str) -> str:
+    return f"narrow_result:{user_profile_id}:{narrow_digest}"
+
+def narrow_result_epoch_cache_key(name: str) -> str:
+    return f"narrow_result_epoch:{name}"
+
 def get_realm_used_upload_space_cache_key(realm: 'Realm') -> str:
     return f'realm_used_upload_space:{realm.id}'
 
@@ -539,6 +586,10 @@ def flush_user_profile(sender: Any, **kwargs: Any) -> None:
     # the fields in the dict or become (in)active
     if changed(kwargs, realm_user_dict_fields):
         cache_delete(realm_user_dicts_cache_key(user_profile.realm_id))
+        # Not every change to these fields sends an event (e.g. soft
+        # deactivation); see zerver/lib/realm_snapshot.py.
+        if settings.REALM_SNAPSHOT_CACHE:
+            cache_delete(realm_snapshot_version_cache_key(user_profile.realm_id, 'realm_users'))
 
     if changed(kwargs, ['is_active']):
         cache_delete(active_user_ids_cache_key(user_profile.realm_id))
@@ -569,7 +620,7 @@ def flush_realm(sender: Any, **kwargs: Any) -> None:
         cache_delete(active_user_ids_cache_key(realm.id))
         cache_delete(bot_dicts_in_realm_cache_key(realm))
         cache_delete(realm_alert_words_cache_key(realm))
-        cache_delete(realm_alert_words_automaton_cache_key(realm))
+        cache_delete(realm_alert_words_version_cache_key(realm.id))
         cache_delete(active_non_guest_user_ids_cache_key(realm.id))
         cache_delete(realm_rendered_description_cache_key(realm))
         cache_delete(realm_text_description_cache_key(realm))
@@ -581,8 +632,11 @@ def flush_realm(sender: Any, **kwargs: Any) -> None:
 def realm_alert_words_cache_key(realm: 'Realm') -> str:
     return f"realm_alert_words:{realm.string_id}"
 
-def realm_alert_words_automaton_cache_key(realm: 'Realm') -> str:
-    return f"realm_alert_words_automaton:{realm.string_id}"
+def realm_alert_words_version_cache_key(realm_id: int) -> str:
+    return f"realm_alert_words_version:{realm_id}"
+
+def realm_alert_words_change_cache_key(realm_id: int, version: int) -> str:
+    return f"realm_alert_words_change:{realm_id}:{version}"
 
 def realm_rendered_description_cache_key(realm: 'Realm') -> str:
     return f"realm_rendered_description:{realm.string_id}"
@@ -617,19 +671,35 @@ def to_dict_cache_key_id(message_id: int) -> str:
 def to_dict_cache_key(message: 'Message', realm_id: Optional[int]=None) -> str:
     return to_dict_cache_key_id(message.id)
 
+def message_fragment_cache_key(message_id: int, apply_markdown: bool,
+                               allow_edit_history: bool) -> str:
+    return f'message_fragment:{message_id}:{int(apply_markdown)}:{int(allow_edit_history)}'
+
+def message_fragment_cache_keys(message_id: int) -> List[str]:
+    return [
+        message_fragment_cache_key(message_id, apply_markdown, allow_edit_history)
+        for apply_markdown in [True, False]
+        for allow_edit_history in [True, False]
+    ]
+
+def message_cache_keys(message_id: int) -> List[str]:
+    """All the cache keys for data derived from the message (and its
+    reactions and submessages), which must be flushed when it changes."""
+    return [to_dict_cache_key_id(message_id)] + message_fragment_cache_keys(message_id)
+
 def open_graph_description_cache_key(content: Any, request: HttpRequest) -> str:
     return 'open_graph_description_path:{}'.format(make_safe_digest(request.META['PATH_INFO']))
 
 def flush_message(sender: Any, **kwargs: Any) -> None:
     message = kwargs['instance']
-    cache_delete(to_dict_cache_key_id(message.id))
+    cache_delete_many(message_cache_keys(message.id))
 
 def flush_submessage(sender: Any, **kwargs: Any) -> None:
     submessage = kwargs['instance']
     # submessages are not cached directly, they are part of their
     # parent messages
     message_id = submessage.message_id
-    cache_delete(to_dict_cache_key_id(message_id))
+    cache_delete_many(message_cache_keys(message_id))
 
 DECORATOR = Callable[[Callable[..., Any]], Callable[..., Any]]
 
@@ -2,7 +2,7 @@
 # high-level documentation on how this system works.
 import copy
 from importlib import import_module
-from typing import Any, Callable, Dict, Iterable, Optional, Sequence, Set
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Set
 
 from django.conf import settings
 from django.utils.translation import ugettext as _
@@ -39,6 +39,7 @@ from zerver.lib.presence import get_presence_for_user, get_presences_for_realm
 from zerver.lib.push_notifications import push_notifications_enabled
 from zerver.lib.realm_icon import realm_icon_url
 from zerver.lib.realm_logo import get_realm_logo_source, get_realm_logo_url
+from zerver.lib.realm_snapshot import SnapshotSection, get_realm_snapshot
 from zerver.lib.request import JsonableError
 from zerver.lib.soft_deactivation import reactivate_user_if_soft_deactivated
 from zerver.lib.stream_subscription import handle_stream_notifications_compatibility
@@ -46,7 +47,12 @@ from zerver.lib.topic import TOPIC_NAME
 from zerver.lib.topic_mutes import get_topic_mutes
 from zerver.lib.user_groups import user_groups_in_realm_serialized
 from zerver.lib.user_status import get_user_info_dict
-from zerver.lib.users import get_cross_realm_dicts, get_raw_user_data, is_administrator_role
+from zerver.lib.users import (
+    can_access_delivery_emails,
+    get_cross_realm_dicts,
+    get_raw_user_data,
+    is_administrator_role,
+)
 from zerver.models import (
     Client,
     CustomProfileField,
@@ -104,12 +110,50 @@ def fetch_initial_state_data(user_profile: UserProfile,
     state['zulip_version'] = ZULIP_VERSION
     state['zulip_feature_level'] = API_FEATURE_LEVEL
 
+    # The realm-wide sections of the state are shared between the
+    # realm's users; see zerver/lib/realm_snapshot.py.
+    snapshot_sections: List[SnapshotSection] = []
+    if want('custom_profile_fields'):
+        snapshot_sections.append((
+            'custom_profile_fields', '',
+            lambda: [f.as_dict() for f in custom_profile_fields_for_realm(realm.id)],
+        ))
+    if want('presence'):
+        snapshot_sections.append((
+            'presences', 'slim' if slim_presence else 'full',
+            lambda: get_presences_for_realm(realm, slim_presence),
+        ))
+    if want('realm_user_groups'):
+        snapshot_sections.append((
+            'realm_user_groups', '',
+            lambda: user_groups_in_realm_serialized(realm),
+        ))
+    if want('realm_user'):
+        # These are the only properties of the user which affect
+        # the data get_raw_user_data returns.
+        variant = '-'.join(str(int(flag)) for flag in [
+            client_gravatar,
+            user_avatar_url_field_optional,
+            can_access_delivery_emails(realm, user_profile),
+        ])
+        snapshot_sections.append((
+            'realm_users', variant,
+            lambda: get_raw_user_data(realm, user_profile,
+                                      client_gravatar=client_gravatar,
+                                      user_avatar_url_field_optional=user_avatar_url_field_optional),
+        ))
+    if want('user_status'):
+        snapshot_sections.append((
+            'user_status', '',
+            lambda: get_user_info_dict(realm_id=realm.id),
+        ))
+    snapshot = get_realm_snapshot(realm.id, snapshot_sections)
+
     if want('alert_words'):
         state['alert_words'] = user_alert_words(user_profile)
 
     if want('custom_profile_fields'):
-        fields = custom_profile_fields_for_realm(realm.id)
-        state['custom_profile_fields'] = [f.as_dict() for f in fields]
+        state['custom_profile_fields'] = snapshot['custom_profile_fields']
         state['custom_profile_field_types'] = CustomProfileField.FIELD_TYPE_CHOICES_DICT
 
     if want('hotspots'):
@@ -135,7 +179,7 @@ def fetch_initial_state_data(user_profile: UserProfile,
         state['pointer'] = user_profile.pointer
 
     if want('presence'):
-        state['presences'] = get_presences_for_realm(realm, slim_presence)
+        state['presences'] = snapshot['presences']
 
     if want('realm'):
         for property_name in Realm.property_types:
@@ -205,12 +249,10 @@ def fetch_initial_state_data(user_profile: UserProfile,
         state['realm_filters'] = realm_filters_for_realm(realm.id)
 
     if want('realm_user_groups'):
-        state['realm_user_groups'] = user_groups_in_realm_serialized(realm)
+        state['realm_user_groups'] = snapshot['realm_user_groups']
 
     if want('realm_user'):
-        state['raw_users'] = get_raw_user_data(realm, user_profile,
-                                               client_gravatar=client_gravatar,
-                                               user_avatar_url_field_optional=user_avatar_url_field_optional)
+        state['raw_users'] = snapshot['realm_users']
 
         # For the user's own avatar URL, we force
         # client_gravatar=False, since that saves some unnecessary
@@ -326,7 +368,7 @@ def fetch_initial_state_data(user_profile: UserProfile,
         state['available_notification_sounds'] = get_available_notification_sounds()
 
     if want('user_status'):
-        state['user_status'] = get_user_info_dict(realm_id=realm.id)
+        state['user_status'] = snapshot['user_status']
 
     if want('video_calls'):
         state['has_zoom_token'] = user_profile.zoom_token is not None
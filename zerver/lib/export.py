@@ -13,13 +13,15 @@ import os
 import shutil
 import subprocess
 import tempfile
-from typing import Any, Callable, Dict, List, Optional, Set, Tuple, Union
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
 
 import boto3
 import ujson
 from boto3.resources.base import ServiceResource
 from django.apps import apps
 from django.conf import settings
+from django.db import connection
 from django.forms.models import model_to_dict
 from django.utils.timezone import is_naive as timezone_is_naive
 from django.utils.timezone import make_aware as timezone_make_aware
@@ -90,6 +92,10 @@ MessageOutput = Dict[str, Union[List[Record], List[int], int]]
 
 MESSAGE_BATCH_CHUNK_SIZE = 1000
 
+# While this file exists in the export directory, the
+# export_usermessage_batch workers wait for more .partial files.
+MESSAGE_PARTIALS_IN_PROGRESS_FILE = 'messages.in-progress'
+
 ALL_ZULIP_TABLES = {
     'analytics_fillstate',
     'analytics_installationcount',
@@ -131,6 +137,7 @@ ALL_ZULIP_TABLES = {
     'zerver_multiuseinvite_streams',
     'zerver_preregistrationuser',
     'zerver_preregistrationuser_streams',
+    'zerver_presencesequence',
     'zerver_pushdevicetoken',
     'zerver_reaction',
     'zerver_realm',
@@ -183,6 +190,10 @@ NON_EXPORTED_TABLES = {
     # reregister for push notifications anyway.
     'zerver_pushdevicetoken',
 
+    # Presence update IDs are only meaningful to clients of the old
+    # server; the import starts the realm's sequence over.
+    'zerver_presencesequence',
+
     # We don't use these generated Django tables
     'zerver_userprofile_groups',
     'zerver_userprofile_user_permissions',
@@ -291,7 +302,17 @@ DATE_FIELDS: Dict[TableName, List[Field]] = {
     'analytics_streamcount': ['end_time'],
 }
 
-def sanity_check_output(data: TableData) -> None:
+# Tables which do_export_realm still needs after exporting the realm
+# config, to choose which messages to export.
+RETAINED_REALM_TABLES = {
+    'zerver_realm',
+    'zerver_recipient',
+    'zerver_userprofile',
+    'zerver_userprofile_crossrealm',
+    'zerver_userprofile_mirrordummy',
+}
+
+def sanity_check_output(exported_tables: Set[TableName]) -> None:
     # First, we verify that the export tool has a declared
     # configuration for every table declared in the `models.py` files.
     target_models = (
@@ -328,14 +349,99 @@ def sanity_check_output(data: TableData) -> None:
     tables -= ANALYTICS_TABLES
 
     for table in tables:
-        if table not in data:
+        if table not in exported_tables:
             logging.warning('??? NO DATA EXPORTED FOR TABLE %s!!!', table)
 
 def write_data_to_file(output_file: Path, data: Any) -> None:
     with open(output_file, "w") as f:
         f.write(ujson.dumps(data, indent=4))
 
-def make_raw(query: Any, exclude: Optional[List[Field]]=None) -> List[Record]:
+class TableDataWriter:
+    '''Writes a JSON file of TableData incrementally, one table (and one
+    row) at a time, so that we never need to hold all of the tables
+    of a large export, or the encoding of the whole file, in memory.
+
+    export_from_config writes each table (and removes it from the
+    response) as soon as no remaining config needs it; tables in
+    retained_tables stay in the response until write_tables.
+    '''
+
+    def __init__(self, output_file: Path, retained_tables: Optional[Set[TableName]]=None) -> None:
+        self.output_file = output_file
+        self.retained_tables = retained_tables or set()
+        self.table_counts: Dict[TableName, int] = {}
+        self.file = open(output_file, "w")
+        self.file.write("{")
+
+    def write_table(self, table: TableName, rows: Iterable[Record]) -> None:
+        assert table not in self.table_counts
+        if self.table_counts:
+            self.file.write(",")
+        self.file.write(f"\n{ujson.dumps(table)}:[")
+        count = 0
+        for row in rows:
+            if count > 0:
+                self.file.write(",")
+            self.file.write("\n" + ujson.dumps(row))
+            count += 1
+        self.file.write("\n]")
+        self.table_counts[table] = count
+
+    def flush_tables(self, response: TableData, tables: List[TableName]) -> None:
+        for table in tables:
+            if table in response and table not in self.retained_tables:
+                self.write_table(table, response.pop(table))
+
+    def write_tables(self, response: TableData) -> None:
+        for table, rows in response.items():
+            self.write_table(table, rows)
+
+    def close(self) -> None:
+        self.file.write("\n}\n")
+        self.file.close()
+
+def write_table_data_to_file(output_file: Path, data: TableData) -> None:
+    writer = TableDataWriter(output_file)
+    writer.write_tables(data)
+    writer.close()
+
+class ExportWorkerPool:
+    '''Runs independent parts of an export (e.g. downloading uploaded
+    files) on worker threads, alongside the main export.
+
+    With no threads (as in tests), jobs just run immediately.
+    '''
+
+    def __init__(self, threads: int) -> None:
+        self.executor: Optional[ThreadPoolExecutor] = None
+        if threads >= 1:
+            self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.futures: List['Future[None]'] = []
+
+    def submit(self, job: Callable[[], None]) -> None:
+        if self.executor is None:
+            job()
+            return
+
+        def run_job() -> None:
+            try:
+                job()
+            finally:
+                # Each thread has its own database connection.
+                connection.close()
+
+        self.futures.append(self.executor.submit(run_job))
+
+    def wait(self) -> None:
+        """Waits for all the jobs, re-raising the first exception."""
+        try:
+            for future in self.futures:
+                future.result()
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+
+def make_raw(query: Iterable[Any], exclude: Optional[List[Field]]=None) -> List[Record]:
     '''
     Takes a Django query and returns a JSONable list
     of dictionaries corresponding to the database rows.
@@ -457,8 +563,24 @@ class Config:
                     may be deeper issues going on.''')
 
 
+def get_referenced_tables(config: Config) -> Set[TableName]:
+    """Returns the tables that configs in the tree rooted at config read
+    from the response: their parents' tables, id sources and temporary
+    tables."""
+    tables: Set[TableName] = set()
+    if config.normal_parent is not None and config.normal_parent.table is not None:
+        tables.add(config.normal_parent.table)
+    if config.id_source is not None:
+        tables.add(config.id_source[0])
+    if config.concat_and_destroy is not None:
+        tables.update(config.concat_and_destroy)
+    for child_config in config.children:
+        tables |= get_referenced_tables(child_config)
+    return tables
+
 def export_from_config(response: TableData, config: Config, seed_object: Optional[Any]=None,
-                       context: Optional[Context]=None) -> None:
+                       context: Optional[Context]=None,
+                       writer: Optional[TableDataWriter]=None) -> None:
     table = config.table
     parent = config.parent
     model = config.model
@@ -478,7 +600,7 @@ def export_from_config(response: TableData, config: Config, seed_object: Optiona
     for t in exported_tables:
         logging.info('Exporting via export_from_config:  %s', t)
 
-    rows = None
+    rows: Optional[Iterable[Any]] = None
     if config.is_seeded:
         rows = [seed_object]
 
@@ -508,7 +630,7 @@ def export_from_config(response: TableData, config: Config, seed_object: Optiona
     elif config.use_all:
         assert model is not None
         query = model.objects.all()
-        rows = list(query)
+        rows = query.iterator()
 
     elif config.normal_parent:
         # In this mode, our current model is figuratively Article,
@@ -525,7 +647,7 @@ def export_from_config(response: TableData, config: Config, seed_object: Optiona
             filter_parms.update(config.filter_args)
         assert model is not None
         query = model.objects.filter(**filter_parms)
-        rows = list(query)
+        rows = query.iterator()
 
     elif config.id_source:
         # In this mode, we are the figurative Blog, and we now
@@ -543,7 +665,7 @@ def export_from_config(response: TableData, config: Config, seed_object: Optiona
         if config.filter_args:
             filter_parms.update(config.filter_args)
         query = model.objects.filter(**filter_parms)
-        rows = list(query)
+        rows = query.iterator()
 
     # Post-process rows (which won't apply to custom fetches/concats)
     if rows is not None:
@@ -566,8 +688,12 @@ def export_from_config(response: TableData, config: Config, seed_object: Optiona
             response=response,
             config=child_config,
             context=context,
+            writer=writer,
         )
 
+    if writer is not None:
+        writer.flush_tables(response, exported_tables)
+
 def get_realm_config() -> Config:
     # This function generates the main Config object that defines how
     # to do a full-realm export of a single realm from a Zulip server.
@@ -910,9 +1036,12 @@ def fetch_attachment_data(response: TableData, realm_id: int, message_ids: Set[i
         row for row in response['zerver_attachment']
         if row['messages']]
 
-def fetch_reaction_data(response: TableData, message_ids: Set[int]) -> None:
-    query = Reaction.objects.filter(message_id__in=list(message_ids))
-    response['zerver_reaction'] = make_raw(list(query))
+def fetch_reaction_rows(message_ids: Set[int]) -> Iterator[Record]:
+    sorted_message_ids = sorted(message_ids)
+    for i in range(0, len(sorted_message_ids), MESSAGE_BATCH_CHUNK_SIZE):
+        query = Reaction.objects.filter(
+            message_id__in=sorted_message_ids[i:i + MESSAGE_BATCH_CHUNK_SIZE])
+        yield from make_raw(query)
 
 def fetch_huddle_objects(response: TableData, config: Config, context: Context) -> None:
 
@@ -992,7 +1121,11 @@ def export_usermessages_batch(input_path: Path, output_path: Path,
     os.unlink(input_path)
 
 def write_message_export(message_filename: Path, output: MessageOutput) -> None:
-    write_data_to_file(output_file=message_filename, data=output)
+    # The export_usermessage_batch workers claim .partial files as soon
+    # as they appear, so we write under a temporary name and rename.
+    temp_filename = message_filename + '.tmp'
+    write_data_to_file(output_file=temp_filename, data=output)
+    os.rename(temp_filename, message_filename)
     logging.info("Dumped to %s", message_filename)
 
 def export_partial_message_files(realm: Realm,
@@ -1154,7 +1287,7 @@ def write_message_partial_for_query(realm: Realm, message_query: Any, dump_file_
 
     return dump_file_id
 
-def export_uploads_and_avatars(realm: Realm, output_dir: Path) -> None:
+def export_uploads_and_avatars(realm: Realm, output_dir: Path, pool: ExportWorkerPool) -> None:
     uploads_output_dir = os.path.join(output_dir, 'uploads')
     avatars_output_dir = os.path.join(output_dir, 'avatars')
     realm_icons_output_dir = os.path.join(output_dir, 'realm_icons')
@@ -1166,35 +1299,43 @@ def export_uploads_and_avatars(realm: Realm, output_dir: Path) -> None:
 
     if settings.LOCAL_UPLOADS_DIR:
         # Small installations and developers will usually just store files locally.
-        export_uploads_from_local(realm,
-                                  local_dir=os.path.join(settings.LOCAL_UPLOADS_DIR, "files"),
-                                  output_dir=uploads_output_dir)
-        export_avatars_from_local(realm,
-                                  local_dir=os.path.join(settings.LOCAL_UPLOADS_DIR, "avatars"),
-                                  output_dir=avatars_output_dir)
-        export_emoji_from_local(realm,
-                                local_dir=os.path.join(settings.LOCAL_UPLOADS_DIR, "avatars"),
-                                output_dir=emoji_output_dir)
-        export_realm_icons(realm,
-                           local_dir=os.path.join(settings.LOCAL_UPLOADS_DIR),
-                           output_dir=realm_icons_output_dir)
+        pool.submit(lambda: export_uploads_from_local(
+            realm,
+            local_dir=os.path.join(settings.LOCAL_UPLOADS_DIR, "files"),
+            output_dir=uploads_output_dir))
+        pool.submit(lambda: export_avatars_from_local(
+            realm,
+            local_dir=os.path.join(settings.LOCAL_UPLOADS_DIR, "avatars"),
+            output_dir=avatars_output_dir))
+        pool.submit(lambda: export_emoji_from_local(
+            realm,
+            local_dir=os.path.join(settings.LOCAL_UPLOADS_DIR, "avatars"),
+            output_dir=emoji_output_dir))
+        pool.submit(lambda: export_realm_icons(
+            realm,
+            local_dir=os.path.join(settings.LOCAL_UPLOADS_DIR),
+            output_dir=realm_icons_output_dir))
     else:
         # Some bigger installations will have their data stored on S3.
-        export_files_from_s3(realm,
-                             settings.S3_AVATAR_BUCKET,
-                             output_dir=avatars_output_dir,
-                             processing_avatars=True)
-        export_files_from_s3(realm,
-                             settings.S3_AUTH_UPLOADS_BUCKET,
-                             output_dir=uploads_output_dir)
-        export_files_from_s3(realm,
-                             settings.S3_AVATAR_BUCKET,
-                             output_dir=emoji_output_dir,
-                             processing_emoji=True)
-        export_files_from_s3(realm,
-                             settings.S3_AVATAR_BUCKET,
-                             output_dir=realm_icons_output_dir,
-                             processing_realm_icon_and_logo=True)
+        pool.submit(lambda: export_files_from_s3(
+            realm,
+            settings.S3_AVATAR_BUCKET,
+            output_dir=avatars_output_dir,
+            processing_avatars=True))
+        pool.submit(lambda: export_files_from_s3(
+            realm,
+            settings.S3_AUTH_UPLOADS_BUCKET,
+            output_dir=uploads_output_dir))
+        pool.submit(lambda: export_files_from_s3(
+            realm,
+            settings.S3_AVATAR_BUCKET,
+            output_dir=emoji_output_dir,
+            processing_emoji=True))
+        pool.submit(lambda: export_files_from_s3(
+            realm,
+            settings.S3_AVATAR_BUCKET,
+            output_dir=realm_icons_output_dir,
+            processing_realm_icon_and_logo=True))
 
 def _check_key_metadata(email_gateway_bot: Optional[UserProfile],
                         key: ServiceResource, processing_avatars: bool,
@@ -1464,7 +1605,8 @@ def export_emoji_from_local(realm: Realm, local_dir: Path, output_dir: Path) ->
     with open(os.path.join(output_dir, "records.json"), "w") as records_file:
         ujson.dump(records, records_file, indent=4)
 
-def do_write_stats_file_for_realm_export(output_dir: Path) -> None:
+def do_write_stats_file_for_realm_export(output_dir: Path,
+                                         realm_table_counts: Dict[TableName, int]) -> None:
     stats_file = os.path.join(output_dir, 'stats.txt')
     realm_file = os.path.join(output_dir, 'realm.json')
     attachment_file = os.path.join(output_dir, 'attachment.json')
@@ -1476,10 +1618,16 @@ def do_write_stats_file_for_realm_export(output_dir: Path) -> None:
     with open(stats_file, 'w') as f:
         for fn in fns:
             f.write(os.path.basename(fn) + '\n')
-            with open(fn) as filename:
-                data = ujson.load(filename)
-            for k in sorted(data):
-                f.write(f'{len(data[k]):5} {k}\n')
+            if fn == realm_file:
+                # We have the counts from writing realm.json, which
+                # can be too large to comfortably load again.
+                table_counts = realm_table_counts
+            else:
+                with open(fn) as filename:
+                    data = ujson.load(filename)
+                table_counts = {k: len(v) for k, v in data.items()}
+            for k in sorted(table_counts):
+                f.write(f'{table_counts[k]:5} {k}\n')
             f.write('\n')
 
         avatar_file = os.path.join(output_dir, 'avatars/records.json')
@@ -1508,55 +1656,78 @@ def do_export_realm(realm: Realm, output_dir: Path, threads: int,
 
     create_soft_link(source=output_dir, in_progress=True)
 
-    logging.info("Exporting data from get_realm_config()...")
-    export_from_config(
-        response=response,
-        config=realm_config,
-        seed_object=realm,
-        context=dict(realm=realm, exportable_user_ids=exportable_user_ids),
-    )
-    logging.info('...DONE with get_realm_config() data')
-
-    sanity_check_output(response)
-
-    logging.info("Exporting uploaded files and avatars")
-    export_uploads_and_avatars(realm, output_dir)
-
-    # We (sort of) export zerver_message rows here.  We write
-    # them to .partial files that are subsequently fleshed out
-    # by parallel processes to add in zerver_usermessage data.
-    # This is for performance reasons, of course.  Some installations
-    # have millions of messages.
-    logging.info("Exporting .partial files messages")
-    message_ids = export_partial_message_files(realm, response, output_dir=output_dir,
-                                               public_only=public_only,
-                                               consent_message_id=consent_message_id)
-    logging.info('%d messages were exported', len(message_ids))
-
-    # zerver_reaction
-    zerver_reaction: TableData = {}
-    fetch_reaction_data(response=zerver_reaction, message_ids=message_ids)
-    response.update(zerver_reaction)
-
-    # Write realm data
-    export_file = os.path.join(output_dir, "realm.json")
-    write_data_to_file(output_file=export_file, data=response)
-    logging.info('Writing realm data to %s', export_file)
-
-    # Write analytics data
-    export_analytics_tables(realm=realm, output_dir=output_dir)
-
-    # zerver_attachment
-    export_attachment_table(realm=realm, output_dir=output_dir, message_ids=message_ids)
+    # Uploaded files and analytics tables are independent of the rest
+    # of the export, so we export them on worker threads while we
+    # export the realm's tables and messages.
+    pool = ExportWorkerPool(threads)
+    pids: Dict[int, int] = {}
+    try:
+        logging.info("Exporting uploaded files and avatars")
+        export_uploads_and_avatars(realm, output_dir, pool)
+        pool.submit(lambda: export_analytics_tables(realm=realm, output_dir=output_dir))
+
+        # We write realm.json incrementally; each table is written (and
+        # freed) as soon as we're done with it.
+        export_file = os.path.join(output_dir, "realm.json")
+        logging.info('Writing realm data to %s', export_file)
+        writer = TableDataWriter(
+            export_file,
+            retained_tables=get_referenced_tables(realm_config) | RETAINED_REALM_TABLES,
+        )
 
-    # Start parallel jobs to export the UserMessage objects.
-    launch_user_message_subprocesses(threads=threads, output_dir=output_dir,
-                                     consent_message_id=consent_message_id)
+        logging.info("Exporting data from get_realm_config()...")
+        export_from_config(
+            response=response,
+            config=realm_config,
+            seed_object=realm,
+            context=dict(realm=realm, exportable_user_ids=exportable_user_ids),
+            writer=writer,
+        )
+        writer.write_tables(response)
+        logging.info('...DONE with get_realm_config() data')
+
+        sanity_check_output(set(writer.table_counts))
+
+        # We (sort of) export zerver_message rows here.  We write
+        # them to .partial files that are subsequently fleshed out
+        # by parallel processes to add in zerver_usermessage data.
+        # This is for performance reasons, of course.  Some installations
+        # have millions of messages.
+        #
+        # The UserMessage processes start right away, and process each
+        # .partial file as soon as it's written, until we remove the
+        # in-progress file.
+        in_progress_file = os.path.join(output_dir, MESSAGE_PARTIALS_IN_PROGRESS_FILE)
+        open(in_progress_file, 'w').close()
+        try:
+            pids = launch_user_message_subprocesses(threads=threads, output_dir=output_dir,
+                                                    consent_message_id=consent_message_id)
+            logging.info("Exporting .partial files messages")
+            message_ids = export_partial_message_files(realm, response, output_dir=output_dir,
+                                                       public_only=public_only,
+                                                       consent_message_id=consent_message_id)
+            logging.info('%d messages were exported', len(message_ids))
+        finally:
+            os.unlink(in_progress_file)
+        response.clear()
+
+        # zerver_reaction
+        writer.write_table('zerver_reaction', fetch_reaction_rows(message_ids))
+        writer.close()
+
+        # zerver_attachment
+        export_attachment_table(realm=realm, output_dir=output_dir, message_ids=message_ids)
+    finally:
+        # Even if the export failed, we wait for the worker threads,
+        # and for the UserMessage processes (which exit once the
+        # in-progress file is removed), so as not to leave them behind.
+        wait_for_user_message_subprocesses(pids)
+        pool.wait()
 
     logging.info("Finished exporting %s", realm.string_id)
     create_soft_link(source=output_dir, in_progress=False)
 
-    do_write_stats_file_for_realm_export(output_dir)
+    do_write_stats_file_for_realm_export(output_dir, writer.table_counts)
 
     # We need to change back to the current working directory after writing
     # the tarball to the output directory, otherwise the state is compromised
@@ -1573,7 +1744,7 @@ def export_attachment_table(realm: Realm, output_dir: Path, message_ids: Set[int
     fetch_attachment_data(response=response, realm_id=realm.id, message_ids=message_ids)
     output_file = os.path.join(output_dir, "attachment.json")
     logging.info('Writing attachment table data to %s', output_file)
-    write_data_to_file(output_file=output_file, data=response)
+    write_table_data_to_file(output_file=output_file, data=response)
 
 def create_soft_link(source: Path, in_progress: bool=True) -> None:
     is_done = not in_progress
@@ -1598,7 +1769,7 @@ def create_soft_link(source: Path, in_progress: bool=True) -> None:
         logging.info('See %s for output files', new_target)
 
 def launch_user_message_subprocesses(threads: int, output_dir: Path,
-                                     consent_message_id: Optional[int]=None) -> None:
+                                     consent_message_id: Optional[int]=None) -> Dict[int, int]:
     logging.info('Launching %d PARALLEL subprocesses to export UserMessage rows', threads)
     pids = {}
 
@@ -1614,7 +1785,9 @@ def launch_user_message_subprocesses(threads: int, output_dir: Path,
 
         process = subprocess.Popen(arguments)
         pids[process.pid] = shard_id
+    return pids
 
+def wait_for_user_message_subprocesses(pids: Dict[int, int]) -> None:
     while pids:
         pid, status = os.wait()
         shard = pids.pop(pid)
@@ -1729,12 +1902,15 @@ def export_analytics_tables(realm: Realm, output_dir: Path) -> None:
     export_file = os.path.join(output_dir, "analytics.json")
     logging.info("Writing analytics table data to %s", (export_file))
     config = get_analytics_config()
+    writer = TableDataWriter(export_file, retained_tables=get_referenced_tables(config))
     export_from_config(
         response=response,
         config=config,
         seed_object=realm,
+        writer=writer,
     )
-    write_data_to_file(output_file=export_file, data=response)
+    writer.write_tables(response)
+    writer.close()
 
 def get_analytics_config() -> Config:
     # The Config function defines what data to export for the
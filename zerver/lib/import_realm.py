@@ -1,37 +1,35 @@
 import datetime
+import io
+import json
 import logging
 import os
 import shutil
-from typing import Any, Dict, Iterable, List, Optional, Tuple
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
 
 import boto3
 import ujson
 from bs4 import BeautifulSoup
 from django.conf import settings
-from django.db import connection
+from django.contrib.postgres.fields import JSONField
+from django.db import connection, transaction
 from django.db.models import Max
 from django.utils.timezone import now as timezone_now
 from psycopg2.extras import execute_values
 from psycopg2.sql import SQL, Identifier
 
 from analytics.models import RealmCount, StreamCount, UserCount
-from zerver.lib import bugdown
-from zerver.lib.actions import (
-    UserMessageLite,
-    bulk_insert_ums,
-    do_change_avatar_fields,
-    do_change_plan_type,
-)
+from zerver.lib.actions import do_change_avatar_fields, do_change_plan_type
 from zerver.lib.avatar_hash import user_avatar_path_from_ids
 from zerver.lib.bugdown import version as bugdown_version
 from zerver.lib.bulk_create import bulk_create_users, bulk_set_users_or_streams_recipient_fields
 from zerver.lib.export import DATE_FIELDS, Field, Path, Record, TableData, TableName
+from zerver.lib.message import render_markdown_batch
 from zerver.lib.parallel import run_parallel
 from zerver.lib.server_initialization import create_internal_realm, server_initialized
 from zerver.lib.streams import render_stream_description
 from zerver.lib.timestamp import datetime_to_timestamp
 from zerver.lib.upload import BadImageError, guess_type, random_name, sanitize_name
-from zerver.lib.utils import generate_api_key, process_list_in_batches
+from zerver.lib.utils import generate_api_key
 from zerver.models import (
     Attachment,
     BotConfigData,
@@ -125,6 +123,99 @@ path_maps: Dict[str, Dict[str, str]] = {
     'attachment_path': {},
 }
 
+IMPORT_CHECKPOINT_FILENAME = 'import-checkpoint.json'
+IMPORT_ID_MAPS_FILENAME = 'import-id-maps.json'
+
+class ImportCheckpoint:
+    '''A manifest, saved in the import directory, of the steps of an
+    import which have completed (and the ID maps as of then), so
+    that if the import fails, rerunning it with resume=True continues
+    from the last completed step, rather than starting again.
+
+    Steps are either idempotent (e.g. importing uploaded files) or run
+    in a transaction; message files are each imported in their own
+    transaction, and recorded individually.
+    '''
+
+    def __init__(self, import_dir: Path, subdomain: str) -> None:
+        self.import_dir = import_dir
+        self.subdomain = subdomain
+        self.realm_id: Optional[int] = None
+        self.done_steps: List[str] = []
+        self.done_message_files: Set[str] = set()
+
+    @staticmethod
+    def load(import_dir: Path, subdomain: str) -> Optional['ImportCheckpoint']:
+        """Returns the saved checkpoint of an import of import_dir into
+        the subdomain, restoring the ID maps."""
+        checkpoint_filename = os.path.join(import_dir, IMPORT_CHECKPOINT_FILENAME)
+        if not os.path.exists(checkpoint_filename):
+            return None
+        with open(checkpoint_filename) as f:
+            manifest = ujson.load(f)
+        if manifest['subdomain'] != subdomain:
+            return None
+        if not Realm.objects.filter(id=manifest['realm_id'], string_id=subdomain).exists():
+            # The realm from the failed import has been deleted.
+            return None
+
+        checkpoint = ImportCheckpoint(import_dir, subdomain)
+        checkpoint.realm_id = manifest['realm_id']
+        checkpoint.done_steps = manifest['done_steps']
+        checkpoint.done_message_files = set(manifest['done_message_files'])
+
+        with open(os.path.join(import_dir, IMPORT_ID_MAPS_FILENAME)) as f:
+            id_maps = ujson.load(f)
+        # JSON object keys are strings.
+        for table, id_map in id_maps['ID_MAP'].items():
+            ID_MAP[table] = {int(old_id): new_id for old_id, new_id in id_map.items()}
+        for table, id_list_map in id_maps['id_map_to_list'].items():
+            id_map_to_list[table] = {int(old_id): id_list for old_id, id_list in id_list_map.items()}
+        path_maps.update(id_maps['path_maps'])
+        return checkpoint
+
+    def write_file(self, filename: str, data: Any) -> None:
+        # Write and rename, so that the file is never incomplete.
+        path = os.path.join(self.import_dir, filename)
+        with open(path + '.tmp', 'w') as f:
+            ujson.dump(data, f)
+        os.rename(path + '.tmp', path)
+
+    def save(self) -> None:
+        self.write_file(IMPORT_CHECKPOINT_FILENAME, dict(
+            subdomain=self.subdomain,
+            realm_id=self.realm_id,
+            done_steps=self.done_steps,
+            done_message_files=sorted(self.done_message_files),
+        ))
+
+    def save_id_maps(self) -> None:
+        self.write_file(IMPORT_ID_MAPS_FILENAME, dict(
+            ID_MAP=ID_MAP,
+            id_map_to_list=id_map_to_list,
+            path_maps=path_maps,
+        ))
+
+    def is_done(self, step: str) -> bool:
+        return step in self.done_steps
+
+    def mark_done(self, step: str) -> None:
+        self.done_steps.append(step)
+        self.save()
+
+    def is_message_file_done(self, message_filename: Path) -> bool:
+        return os.path.basename(message_filename) in self.done_message_files
+
+    def mark_message_file_done(self, message_filename: Path) -> None:
+        self.done_message_files.add(os.path.basename(message_filename))
+        self.save()
+
+    def delete(self) -> None:
+        for filename in [IMPORT_CHECKPOINT_FILENAME, IMPORT_ID_MAPS_FILENAME]:
+            path = os.path.join(self.import_dir, filename)
+            if os.path.exists(path):
+                os.remove(path)
+
 def update_id_map(table: TableName, old_id: int, new_id: int) -> None:
     if table not in ID_MAP:
         raise Exception(f'''
@@ -249,12 +340,12 @@ def fix_customprofilefield(data: TableData) -> None:
             item['value'] = ujson.dumps(new_id_list)
 
 def fix_message_rendered_content(realm: Realm,
-                                 sender_map: Dict[int, Record],
                                  messages: List[Record]) -> None:
     """
     This function sets the rendered_content of all the messages
     after the messages have been imported from a non-Zulip platform.
     """
+    messages_to_render = []
     for message in messages:
         if message['rendered_content'] is not None:
             # For Zulip->Zulip imports, we use the original rendered
@@ -303,36 +394,22 @@ def fix_message_rendered_content(realm: Realm,
                 message['rendered_content'] = str(soup)
             continue
 
-        try:
-            content = message['content']
-
-            sender_id = message['sender_id']
-            sender = sender_map[sender_id]
-            sent_by_bot = sender['is_bot']
-            translate_emoticons = sender['translate_emoticons']
-
-            # We don't handle alert words on import from third-party
-            # platforms, since they generally don't have an "alert
-            # words" type feature, and notifications aren't important anyway.
-            realm_alert_words_automaton = None
-
-            rendered_content = bugdown.convert(
-                content=content,
-                realm_alert_words_automaton=realm_alert_words_automaton,
-                message_realm=realm,
-                sent_by_bot=sent_by_bot,
-                translate_emoticons=translate_emoticons,
-            )
-
-            message['rendered_content'] = rendered_content
-            message['rendered_content_version'] = bugdown_version
-        except Exception:
-            # This generally happens with two possible causes:
-            # * rendering markdown throwing an uncaught exception
-            # * rendering markdown failing with the exception being
-            #   caught in bugdown (which then returns None, causing the the
-            #   rendered_content assert above to fire).
+        messages_to_render.append(message)
+
+    # We don't handle alert words on import from third-party
+    # platforms, since they generally don't have an "alert words"
+    # type feature, and notifications aren't important anyway.
+    rendered = render_markdown_batch(
+        realm,
+        [Message(id=message['id'], sender_id=message['sender_id'], content=message['content'])
+         for message in messages_to_render],
+    )
+    for message, rendered_content in zip(messages_to_render, rendered):
+        if rendered_content is None:
             logging.warning("Error in markdown rendering for message ID %s; continuing", message['id'])
+            continue
+        message['rendered_content'] = rendered_content
+        message['rendered_content_version'] = bugdown_version
 
 def current_table_ids(data: TableData, table: TableName) -> List[int]:
     """
@@ -418,6 +495,21 @@ def re_map_foreign_keys_internal(data_table: List[Record],
     the re-mapping.  (It also appends `_id` to the field.)
     '''
     lookup_table = ID_MAP[related_table]
+    if not (verbose or recipient_field or reaction_field):
+        # The common case, which for messages runs over millions of
+        # rows: just one lookup per row, without the special cases.
+        get_new_id = lookup_table.get
+        if id_field:
+            for item in data_table:
+                old_id = item[field_name]
+                item[field_name] = get_new_id(old_id, old_id)
+        else:
+            new_field_name = field_name + "_id"
+            for item in data_table:
+                old_id = item.pop(field_name)
+                item[new_field_name] = get_new_id(old_id, old_id)
+        return
+
     for item in data_table:
         old_id = item[field_name]
         if recipient_field:
@@ -546,34 +638,105 @@ def update_model_ids(model: Any, data: TableData, related_table: TableName) -> N
         update_id_map(related_table, old_id_list[item], allocated_id_list[item])
     re_map_foreign_keys(data, table, 'id', related_table=related_table, id_field=True)
 
+# Escapes for PostgreSQL's COPY text format; see copy_value.
+COPY_TEXT_ESCAPES = str.maketrans({
+    '\\': '\\\\',
+    '\t': '\\t',
+    '\n': '\\n',
+    '\r': '\\r',
+})
+
+# The internal types of the fields whose prepared values copy_value
+# can encode; see bulk_import_objects.
+COPY_FIELD_TYPES = {
+    'AutoField',
+    'BigAutoField',
+    'BigIntegerField',
+    'BooleanField',
+    'CharField',
+    'DateField',
+    'DateTimeField',
+    'ForeignKey',
+    'IntegerField',
+    'JSONField',
+    'OneToOneField',
+    'PositiveIntegerField',
+    'PositiveSmallIntegerField',
+    'SmallIntegerField',
+    'TextField',
+}
+
+def copy_value(value: Any) -> str:
+    """Encodes a value, as prepared for the database by Django, for
+    PostgreSQL's COPY text format."""
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    assert isinstance(value, (int, float, str))
+    return str(value).translate(COPY_TEXT_ESCAPES)
+
+def copy_field_value(field: Any, obj: Any) -> Any:
+    value = field.pre_save(obj, add=True)
+    if isinstance(field, JSONField):
+        # get_db_prep_save wraps the value in psycopg2's Json adapter,
+        # which only knows how to quote it as an SQL literal.
+        return None if value is None else json.dumps(value)
+    return field.get_db_prep_save(value, connection=connection)
+
+def copy_rows(table: TableName, columns: List[str], rows: Iterable[Iterable[Any]],
+              chunk_size: int=10000) -> None:
+    """Inserts the rows into the table with COPY, which is much faster
+    than INSERT statements for the large tables of an import.  Rows
+    are encoded into a buffer of chunk_size rows at a time."""
+    query = SQL("COPY {table} ({columns}) FROM STDIN").format(
+        table=Identifier(table),
+        columns=SQL(', ').join(Identifier(column) for column in columns),
+    )
+    with connection.cursor() as cursor:
+        buffer = io.StringIO()
+        count = 0
+        for row in rows:
+            buffer.write('\t'.join(copy_value(value) for value in row) + '\n')
+            count += 1
+            if count % chunk_size == 0:
+                buffer.seek(0)
+                cursor.cursor.copy_expert(query, buffer)
+                buffer = io.StringIO()
+        if count % chunk_size != 0:
+            buffer.seek(0)
+            cursor.cursor.copy_expert(query, buffer)
+
+def bulk_import_objects(model: Any, objs: Iterable[Any]) -> None:
+    """Equivalent to model.objects.bulk_create(objs) for objects with
+    IDs (which we allocate with allocate_ids), using COPY for models
+    whose fields copy_value can encode."""
+    fields = model._meta.concrete_fields
+    if any(field.get_internal_type() not in COPY_FIELD_TYPES for field in fields):
+        model.objects.bulk_create(objs)
+        return
+    rows = (
+        [copy_field_value(field, obj) for field in fields]
+        for obj in objs
+    )
+    copy_rows(get_db_table(model), [field.column for field in fields], rows)
+
 def bulk_import_user_message_data(data: TableData, dump_file_id: int) -> None:
     model = UserMessage
     table = 'zerver_usermessage'
-    lst = data[table]
 
     # IMPORTANT NOTE: We do not use any primary id
     # data from either the import itself or ID_MAP.
     # We let the DB itself generate ids.  Note that
     # no tables use user_message.id as a foreign key,
     # so we can safely avoid all re-mapping complexity.
-
-    def process_batch(items: List[Dict[str, Any]]) -> None:
-        ums = [
-            UserMessageLite(
-                user_profile_id = item['user_profile_id'],
-                message_id = item['message_id'],
-                flags=item['flags'],
-            )
-            for item in items
-        ]
-        bulk_insert_ums(ums)
-
-    chunk_size = 10000
-
-    process_list_in_batches(
-        lst=lst,
-        chunk_size=chunk_size,
-        process_batch=process_batch,
+    copy_rows(
+        table,
+        ['user_profile_id', 'message_id', 'flags'],
+        ((item['user_profile_id'], item['message_id'], item['flags'])
+         for item in data[table]),
     )
 
     logging.info("Successfully imported %s from %s[%s].", model, table, dump_file_id)
@@ -581,7 +744,7 @@ def bulk_import_user_message_data(data: TableData, dump_file_id: int) -> None:
 def bulk_import_model(data: TableData, model: Any, dump_file_id: Optional[str]=None) -> None:
     table = get_db_table(model)
     # TODO, deprecate dump_file_id
-    model.objects.bulk_create(model(**item) for item in data[table])
+    bulk_import_objects(model, (model(**item) for item in data[table]))
     if dump_file_id is None:
         logging.info("Successfully imported %s from %s.", model, table)
     else:
@@ -781,7 +944,8 @@ def import_uploads(realm: Realm, import_dir: Path, processes: int, processing_av
 # Because the Python object => JSON conversion process is not fully
 # faithful, we have to use a set of fixers (e.g. on DateTime objects
 # and Foreign Keys) to do the import correctly.
-def do_import_realm(import_dir: Path, subdomain: str, processes: int=1) -> Realm:
+def do_import_realm(import_dir: Path, subdomain: str, processes: int=1,
+                    resume: bool=False) -> Realm:
     logging.info("Importing realm dump %s", import_dir)
     if not os.path.exists(import_dir):
         raise Exception("Missing import directory!")
@@ -793,6 +957,132 @@ def do_import_realm(import_dir: Path, subdomain: str, processes: int=1) -> Realm
     if not server_initialized():
         create_internal_realm()
 
+    # Each step below is either idempotent or runs in a transaction,
+    # and we record the completed steps in a checkpoint; with resume,
+    # we skip the steps an earlier, failed run of the import completed.
+    checkpoint = None
+    if resume:
+        checkpoint = ImportCheckpoint.load(import_dir, subdomain)
+    if checkpoint is None:
+        checkpoint = ImportCheckpoint(import_dir, subdomain)
+
+    data: Optional[TableData] = None
+    if checkpoint.is_done('realm_tables'):
+        logging.info("Resuming import of %s into realm %s", import_dir, checkpoint.realm_id)
+        realm = Realm.objects.get(id=checkpoint.realm_id)
+    else:
+        with transaction.atomic():
+            realm, data = import_realm_tables(import_dir, subdomain)
+        checkpoint.realm_id = realm.id
+        checkpoint.save_id_maps()
+        checkpoint.mark_done('realm_tables')
+
+    if not checkpoint.is_done('uploads'):
+        # Import uploaded files and avatars
+        import_uploads(realm, os.path.join(import_dir, "avatars"), processes, processing_avatars=True)
+        import_uploads(realm, os.path.join(import_dir, "uploads"), processes)
+
+        # We need to have this check as the emoji files are only present in the data
+        # importer from slack
+        # For Zulip export, this doesn't exist
+        if os.path.exists(os.path.join(import_dir, "emoji")):
+            import_uploads(realm, os.path.join(import_dir, "emoji"), processes, processing_emojis=True)
+
+        if os.path.exists(os.path.join(import_dir, "realm_icons")):
+            import_uploads(realm, os.path.join(import_dir, "realm_icons"), processes,
+                           processing_realm_icons=True)
+        # import_uploads computes the new attachment paths.
+        checkpoint.save_id_maps()
+        checkpoint.mark_done('uploads')
+
+    # Import zerver_message and zerver_usermessage
+    import_message_data(realm=realm, import_dir=import_dir, processes=processes,
+                        checkpoint=checkpoint)
+
+    if not checkpoint.is_done('reactions'):
+        if data is None:
+            with open(realm_data_filename) as f:
+                data = {'zerver_reaction': ujson.load(f)['zerver_reaction']}
+        with transaction.atomic():
+            re_map_foreign_keys(data, 'zerver_reaction', 'message', related_table="message")
+            re_map_foreign_keys(data, 'zerver_reaction', 'user_profile', related_table="user_profile")
+            re_map_foreign_keys(data, 'zerver_reaction', 'emoji_code', related_table="realmemoji",
+                                id_field=True, reaction_field=True)
+            update_model_ids(Reaction, data, 'reaction')
+            bulk_import_model(data, Reaction)
+        checkpoint.mark_done('reactions')
+    # realm.json's data can be quite large, and we're done with it.
+    del data
+
+    for user_profile in UserProfile.objects.filter(is_bot=False, realm=realm):
+        # Since we now unconditionally renumbers message IDs, we need
+        # to reset the user's pointer to what will be a valid value.
+        #
+        # For zulip->zulip imports, we could do something clever, but
+        # it should always be safe to reset to first unread message.
+        #
+        # Longer-term, the plan is to eliminate pointer as a concept.
+        first_unread_message = UserMessage.objects.filter(user_profile=user_profile).extra(
+            where=[UserMessage.where_unread()],
+        ).order_by("message_id").first()
+        if first_unread_message is not None:
+            user_profile.pointer = first_unread_message.message_id
+        else:
+            last_message = UserMessage.objects.filter(
+                user_profile=user_profile).order_by("message_id").last()
+            if last_message is not None:
+                user_profile.pointer = last_message.message_id
+            else:
+                # -1 is the guard value for new user accounts with no messages.
+                user_profile.pointer = -1
+
+        user_profile.save(update_fields=["pointer"])
+
+    # Similarly, we need to recalculate the first_message_id for stream objects.
+    for stream in Stream.objects.filter(realm=realm):
+        recipient = Recipient.objects.get(type=Recipient.STREAM, type_id=stream.id)
+        first_message = Message.objects.filter(recipient=recipient).first()
+        if first_message is None:
+            stream.first_message_id = None
+        else:
+            stream.first_message_id = first_message.id
+        stream.save(update_fields=["first_message_id"])
+
+    # Do attachments AFTER message data is loaded.
+    # TODO: de-dup how we read these json files.
+    if not checkpoint.is_done('attachments'):
+        fn = os.path.join(import_dir, "attachment.json")
+        if not os.path.exists(fn):
+            raise Exception("Missing attachment.json file!")
+
+        logging.info("Importing attachment data from %s", fn)
+        with open(fn) as f:
+            attachment_data = ujson.load(f)
+
+        with transaction.atomic():
+            import_attachments(attachment_data)
+        checkpoint.mark_done('attachments')
+
+    # Import the analytics file.
+    if not checkpoint.is_done('analytics'):
+        with transaction.atomic():
+            import_analytics_data(realm=realm, import_dir=import_dir)
+        checkpoint.mark_done('analytics')
+
+    if settings.BILLING_ENABLED:
+        do_change_plan_type(realm, Realm.LIMITED)
+    else:
+        do_change_plan_type(realm, Realm.SELF_HOSTED)
+
+    checkpoint.delete()
+    return realm
+
+def import_realm_tables(import_dir: Path, subdomain: str) -> Tuple[Realm, TableData]:
+    """Imports the realm and the tables in realm.json, other than
+    zerver_reaction (which we import after the messages).  Returns the
+    realm and the (remapped) data from realm.json."""
+    realm_data_filename = os.path.join(import_dir, "realm.json")
+
     logging.info("Importing realm data from %s", realm_data_filename)
     with open(realm_data_filename) as f:
         data = ujson.load(f)
@@ -882,7 +1172,7 @@ def do_import_realm(import_dir: Path, subdomain: str, processes: int=1) -> Realm
     user_profiles = [UserProfile(**item) for item in data['zerver_userprofile']]
     for user_profile in user_profiles:
         user_profile.set_unusable_password()
-    UserProfile.objects.bulk_create(user_profiles)
+    bulk_import_objects(UserProfile, user_profiles)
 
     re_map_foreign_keys(data, 'zerver_defaultstream', 'stream', related_table="stream")
     re_map_foreign_keys(data, 'zerver_realmemoji', 'author', related_table="user_profile")
@@ -991,6 +1281,9 @@ def do_import_realm(import_dir: Path, subdomain: str, processes: int=1) -> Realm
     re_map_foreign_keys(data, 'zerver_userpresence', 'client', related_table='client')
     re_map_foreign_keys(data, 'zerver_userpresence', 'realm', related_table="realm")
     update_model_ids(UserPresence, data, 'user_presence')
+    for item in data['zerver_userpresence']:
+        # The realm's PresenceSequence starts over on this server.
+        item['last_update_id'] = 0
     bulk_import_model(data, UserPresence)
 
     fix_datetime_fields(data, 'zerver_useractivity')
@@ -1016,89 +1309,7 @@ def do_import_realm(import_dir: Path, subdomain: str, processes: int=1) -> Realm
     update_model_ids(CustomProfileFieldValue, data, related_table="customprofilefieldvalue")
     bulk_import_model(data, CustomProfileFieldValue)
 
-    # Import uploaded files and avatars
-    import_uploads(realm, os.path.join(import_dir, "avatars"), processes, processing_avatars=True)
-    import_uploads(realm, os.path.join(import_dir, "uploads"), processes)
-
-    # We need to have this check as the emoji files are only present in the data
-    # importer from slack
-    # For Zulip export, this doesn't exist
-    if os.path.exists(os.path.join(import_dir, "emoji")):
-        import_uploads(realm, os.path.join(import_dir, "emoji"), processes, processing_emojis=True)
-
-    if os.path.exists(os.path.join(import_dir, "realm_icons")):
-        import_uploads(realm, os.path.join(import_dir, "realm_icons"), processes,
-                       processing_realm_icons=True)
-
-    sender_map = {
-        user['id']: user
-        for user in data['zerver_userprofile']
-    }
-
-    # Import zerver_message and zerver_usermessage
-    import_message_data(realm=realm, sender_map=sender_map, import_dir=import_dir)
-
-    re_map_foreign_keys(data, 'zerver_reaction', 'message', related_table="message")
-    re_map_foreign_keys(data, 'zerver_reaction', 'user_profile', related_table="user_profile")
-    re_map_foreign_keys(data, 'zerver_reaction', 'emoji_code', related_table="realmemoji", id_field=True,
-                        reaction_field=True)
-    update_model_ids(Reaction, data, 'reaction')
-    bulk_import_model(data, Reaction)
-
-    for user_profile in UserProfile.objects.filter(is_bot=False, realm=realm):
-        # Since we now unconditionally renumbers message IDs, we need
-        # to reset the user's pointer to what will be a valid value.
-        #
-        # For zulip->zulip imports, we could do something clever, but
-        # it should always be safe to reset to first unread message.
-        #
-        # Longer-term, the plan is to eliminate pointer as a concept.
-        first_unread_message = UserMessage.objects.filter(user_profile=user_profile).extra(
-            where=[UserMessage.where_unread()],
-        ).order_by("message_id").first()
-        if first_unread_message is not None:
-            user_profile.pointer = first_unread_message.message_id
-        else:
-            last_message = UserMessage.objects.filter(
-                user_profile=user_profile).order_by("message_id").last()
-            if last_message is not None:
-                user_profile.pointer = last_message.message_id
-            else:
-                # -1 is the guard value for new user accounts with no messages.
-                user_profile.pointer = -1
-
-        user_profile.save(update_fields=["pointer"])
-
-    # Similarly, we need to recalculate the first_message_id for stream objects.
-    for stream in Stream.objects.filter(realm=realm):
-        recipient = Recipient.objects.get(type=Recipient.STREAM, type_id=stream.id)
-        first_message = Message.objects.filter(recipient=recipient).first()
-        if first_message is None:
-            stream.first_message_id = None
-        else:
-            stream.first_message_id = first_message.id
-        stream.save(update_fields=["first_message_id"])
-
-    # Do attachments AFTER message data is loaded.
-    # TODO: de-dup how we read these json files.
-    fn = os.path.join(import_dir, "attachment.json")
-    if not os.path.exists(fn):
-        raise Exception("Missing attachment.json file!")
-
-    logging.info("Importing attachment data from %s", fn)
-    with open(fn) as f:
-        data = ujson.load(f)
-
-    import_attachments(data)
-
-    # Import the analytics file.
-    import_analytics_data(realm=realm, import_dir=import_dir)
-
-    if settings.BILLING_ENABLED:
-        do_change_plan_type(realm, Realm.LIMITED)
-    else:
-        do_change_plan_type(realm, Realm.SELF_HOSTED)
-    return realm
+    return realm, data
 
 # create_users and do_import_system_bots differ from their equivalent
 # in zerver/lib/server_initialization.py because here we check if the
@@ -1198,55 +1409,99 @@ def get_incoming_message_ids(import_dir: Path,
     return message_ids
 
 def import_message_data(realm: Realm,
-                        sender_map: Dict[int, Record],
-                        import_dir: Path) -> None:
+                        import_dir: Path,
+                        processes: int=1,
+                        checkpoint: Optional[ImportCheckpoint]=None) -> None:
+    message_filenames = []
     dump_file_id = 1
     while True:
         message_filename = os.path.join(import_dir, f"messages-{dump_file_id:06}.json")
         if not os.path.exists(message_filename):
             break
+        if checkpoint is None or not checkpoint.is_message_file_done(message_filename):
+            message_filenames.append((dump_file_id, message_filename))
+        dump_file_id += 1
 
-        with open(message_filename) as f:
-            data = ujson.load(f)
-
-        logging.info("Importing message dump %s", message_filename)
-        re_map_foreign_keys(data, 'zerver_message', 'sender', related_table="user_profile")
-        re_map_foreign_keys(data, 'zerver_message', 'recipient', related_table="recipient")
-        re_map_foreign_keys(data, 'zerver_message', 'sending_client', related_table='client')
-        fix_datetime_fields(data, 'zerver_message')
-        # Parser to update message content with the updated attachment urls
-        fix_upload_links(data, 'zerver_message')
-
-        # We already create mappings for zerver_message ids
-        # in update_message_foreign_keys(), so here we simply
-        # apply them.
-        message_id_map = ID_MAP['message']
-        for row in data['zerver_message']:
-            row['id'] = message_id_map[row['id']]
+    if processes == 1:
+        for dump_file_id, message_filename in message_filenames:
+            import_message_file(realm, message_filename, dump_file_id)
+            if checkpoint is not None:
+                checkpoint.mark_message_file_done(message_filename)
+        return
 
-        for row in data['zerver_usermessage']:
-            assert(row['message'] in message_id_map)
+    # The message files are independent, since we've already
+    # allocated the new IDs of all the messages (in
+    # update_message_foreign_keys), so we import them in parallel,
+    # one file per process.
+    def import_file(job: Tuple[int, Path]) -> int:
+        dump_file_id, message_filename = job
+        try:
+            import_message_file(realm, message_filename, dump_file_id)
+        except Exception:
+            logging.exception("Error importing message dump %s", message_filename)
+            return 1
+        finally:
+            connection.close()
+        return 0
+
+    connection.close()
+    for (status, job) in run_parallel(import_file, message_filenames, processes):
+        if status != 0:
+            raise Exception(f"Error importing message dump {job[1]}")
+        if checkpoint is not None:
+            checkpoint.mark_message_file_done(job[1])
+
+def import_message_file(realm: Realm,
+                        message_filename: Path,
+                        dump_file_id: int) -> None:
+    with open(message_filename) as f:
+        data = ujson.load(f)
 
-        fix_message_rendered_content(
-            realm=realm,
-            sender_map=sender_map,
-            messages=data['zerver_message'],
-        )
-        logging.info("Successfully rendered markdown for message batch")
+    message_id_map = ID_MAP['message']
+    if data['zerver_message'] and Message.objects.filter(
+            id=message_id_map[data['zerver_message'][0]['id']]).exists():
+        # An earlier, interrupted run of a resumed import imported
+        # this file, but didn't get to record it in the checkpoint.
+        logging.info("Skipping message dump %s, which was already imported", message_filename)
+        return
 
-        # A LOT HAPPENS HERE.
-        # This is where we actually import the message data.
+    logging.info("Importing message dump %s", message_filename)
+    re_map_foreign_keys(data, 'zerver_message', 'sender', related_table="user_profile")
+    re_map_foreign_keys(data, 'zerver_message', 'recipient', related_table="recipient")
+    re_map_foreign_keys(data, 'zerver_message', 'sending_client', related_table='client')
+    fix_datetime_fields(data, 'zerver_message')
+    # Parser to update message content with the updated attachment urls
+    fix_upload_links(data, 'zerver_message')
+
+    # We already create mappings for zerver_message ids
+    # in update_message_foreign_keys(), so here we simply
+    # apply them.
+    for row in data['zerver_message']:
+        row['id'] = message_id_map[row['id']]
+
+    for row in data['zerver_usermessage']:
+        assert(row['message'] in message_id_map)
+
+    fix_message_rendered_content(
+        realm=realm,
+        messages=data['zerver_message'],
+    )
+    logging.info("Successfully rendered markdown for message batch")
+
+    # Due to the structure of these message chunks, we're
+    # guaranteed to have already imported all the Message objects
+    # for this batch of UserMessage objects.
+    re_map_foreign_keys(data, 'zerver_usermessage', 'message', related_table="message")
+    re_map_foreign_keys(data, 'zerver_usermessage', 'user_profile', related_table="user_profile")
+    fix_bitfield_keys(data, 'zerver_usermessage', 'flags')
+
+    # A LOT HAPPENS HERE.
+    # This is where we actually import the message data.  Each file
+    # is imported in a transaction, so that a resumed import can
+    # just skip the files which were imported.
+    with transaction.atomic():
         bulk_import_model(data, Message)
-
-        # Due to the structure of these message chunks, we're
-        # guaranteed to have already imported all the Message objects
-        # for this batch of UserMessage objects.
-        re_map_foreign_keys(data, 'zerver_usermessage', 'message', related_table="message")
-        re_map_foreign_keys(data, 'zerver_usermessage', 'user_profile', related_table="user_profile")
-        fix_bitfield_keys(data, 'zerver_usermessage', 'flags')
-
         bulk_import_user_message_data(data, dump_file_id)
-        dump_file_id += 1
 
 def import_attachments(data: TableData) -> None:
 
@@ -16,8 +16,11 @@ from analytics.lib.counts import COUNT_STATS, RealmCount
 from zerver.lib import bugdown as bugdown
 from zerver.lib.avatar import get_avatar_field
 from zerver.lib.cache import (
+    cache_get_many,
+    cache_set_many,
     cache_with_key,
     generic_bulk_cached_fetch,
+    message_fragment_cache_key,
     to_dict_cache_key,
     to_dict_cache_key_id,
 )
@@ -26,11 +29,13 @@ from zerver.lib.display_recipient import (
     UserDisplayRecipient,
     bulk_fetch_display_recipients,
 )
+from zerver.lib.exceptions import BugdownRenderingException
 from zerver.lib.request import JsonableError
 from zerver.lib.stream_subscription import get_stream_subscriptions_for_user
 from zerver.lib.timestamp import datetime_to_timestamp
 from zerver.lib.topic import DB_TOPIC_NAME, MESSAGE__TOPIC, TOPIC_LINKS, TOPIC_NAME
 from zerver.lib.topic_mutes import build_topic_mute_checker, topic_is_muted
+from zerver.lib.unread_index import get_unread_message_rows
 from zerver.models import (
     MAX_MESSAGE_LENGTH,
     MAX_TOPIC_NAME_LENGTH,
@@ -51,6 +56,11 @@ from zerver.models import (
 
 RealmAlertWord = Dict[int, List[str]]
 
+# The sender ID, recipient ID, recipient type and recipient type ID
+# of a message, and the JSON encoding (without the enclosing braces)
+# of the rest of its final payload; see encoded_messages_for_ids.
+MessageFragment = Tuple[int, int, int, int, str]
+
 class RawUnreadMessagesResult(TypedDict):
     pm_dict: Dict[int, Any]
     stream_dict: Dict[int, Any]
@@ -119,6 +129,82 @@ def messages_for_ids(message_ids: List[int],
 
     return message_list
 
+def encoded_messages_for_ids(message_ids: List[int],
+                             user_message_flags: Dict[int, List[str]],
+                             search_fields: Dict[int, Dict[str, str]],
+                             apply_markdown: bool,
+                             client_gravatar: bool,
+                             allow_edit_history: bool) -> List[str]:
+    """Equivalent to messages_for_ids, but returns the JSON encoding of
+    each message, for use with json_success_with_messages.
+
+    Decoding each message's dictionary from the cache, finalizing it,
+    and encoding the result again is most of the cost of fetching
+    many messages.  So we cache the encoding of the parts of each
+    message's final payload which only change when the message does
+    (its content, reactions, etc.), as a MessageFragment, and just
+    splice in the sender and recipient fields (encoded once per
+    sender and conversation) and the user's flags.
+    """
+    fragment_keys = {
+        message_id: message_fragment_cache_key(message_id, apply_markdown, allow_edit_history)
+        for message_id in message_ids
+    }
+    cached = cache_get_many(list(fragment_keys.values()))
+    fragments: Dict[int, MessageFragment] = {}
+    missing_ids = []
+    for message_id, key in fragment_keys.items():
+        if key in cached:
+            fragments[message_id] = cached[key]
+        else:
+            missing_ids.append(message_id)
+
+    if missing_ids:
+        message_dicts = generic_bulk_cached_fetch(
+            to_dict_cache_key_id,
+            MessageDict.get_raw_db_rows,
+            missing_ids,
+            id_fetcher=lambda row: row['id'],
+            cache_transformer=MessageDict.build_dict_from_raw_db_row,
+            extractor=extract_message_dict,
+            setter=stringify_message_dict)
+        new_fragments = {}
+        for message_id in missing_ids:
+            fragment = MessageDict.build_message_fragment(
+                message_dicts[message_id], apply_markdown, allow_edit_history)
+            fragments[message_id] = fragment
+            new_fragments[fragment_keys[message_id]] = fragment
+        cache_set_many(new_fragments, timeout=3600*24)
+
+    sender_rows = MessageDict.get_sender_rows({fragment[0] for fragment in fragments.values()})
+    display_recipients = bulk_fetch_display_recipients({
+        (recipient_id, recipient_type, recipient_type_id)
+        for (sender_id, recipient_id, recipient_type, recipient_type_id, body)
+        in fragments.values()
+    })
+    encoded_senders = {
+        sender_id: ujson.dumps(fields)[1:-1]
+        for sender_id, fields in MessageDict.get_sender_fields(sender_rows, client_gravatar).items()
+    }
+    # Maps (recipient_id, sender_id) to the encoded recipient fields.
+    encoded_recipients: Dict[Tuple[int, int], str] = {}
+
+    encoded_messages = []
+    for message_id in message_ids:
+        sender_id, recipient_id, recipient_type, recipient_type_id, body = fragments[message_id]
+        key = (recipient_id, sender_id)
+        if key not in encoded_recipients:
+            encoded_recipients[key] = ujson.dumps(MessageDict.get_recipient_fields(
+                recipient_id, recipient_type, recipient_type_id,
+                display_recipients[recipient_id], sender_rows[sender_id],
+            ))[1:-1]
+        user_fields: Dict[str, Any] = {"flags": user_message_flags[message_id]}
+        if message_id in search_fields:
+            user_fields.update(search_fields[message_id])
+        encoded_messages.append("{" + body + "," + encoded_senders[sender_id] + "," +
+                                encoded_recipients[key] + "," + ujson.dumps(user_fields)[1:-1] + "}")
+    return encoded_messages
+
 def sew_messages_and_reactions(messages: List[Dict[str, Any]],
                                reactions: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
     """Given a iterable of messages and reactions stitch reactions
@@ -201,11 +287,119 @@ class MessageDict:
               is somewhat important here, as we are
               often fetching several messages.
         '''
-        MessageDict.bulk_hydrate_sender_info(objs)
-        MessageDict.bulk_hydrate_recipient_info(objs)
+        # This produces the same dictionaries as hydrating each
+        # message with bulk_hydrate_sender_info and
+        # bulk_hydrate_recipient_info and then calling
+        # _finalize_payload (as we do for message events), but
+        # everything that depends only on the sender (like avatar
+        # URLs) or the conversation is computed once, rather than once
+        # per message, which matters when fetching 1000s of messages.
+        sender_rows = MessageDict.get_sender_rows({obj['sender_id'] for obj in objs})
+        display_recipients = bulk_fetch_display_recipients({
+            (obj['recipient_id'], obj['recipient_type'], obj['recipient_type_id'])
+            for obj in objs
+        })
+        sender_fields = MessageDict.get_sender_fields(sender_rows, client_gravatar)
 
+        # Maps (recipient_id, sender_id) to the recipient fields.
+        recipient_fields: Dict[Tuple[int, int], Dict[str, Any]] = {}
         for obj in objs:
-            MessageDict._finalize_payload(obj, apply_markdown, client_gravatar)
+            sender_id = obj['sender_id']
+            obj.update(sender_fields[sender_id])
+
+            recipient_id = obj['recipient_id']
+            recipient_type = obj.pop('recipient_type')
+            recipient_type_id = obj.pop('recipient_type_id')
+            key = (recipient_id, sender_id)
+            if key not in recipient_fields:
+                recipient_fields[key] = MessageDict.get_recipient_fields(
+                    recipient_id, recipient_type, recipient_type_id,
+                    display_recipients[recipient_id], sender_rows[sender_id],
+                )
+            obj.update(recipient_fields[key])
+
+            MessageDict.finalize_content(obj, apply_markdown)
+
+    @staticmethod
+    def get_sender_fields(sender_rows: Dict[int, Dict[str, Any]],
+                          client_gravatar: bool) -> Dict[int, Dict[str, Any]]:
+        """Returns the sender fields of the final message payload for each
+        sender, given rows from get_sender_rows."""
+        sender_fields: Dict[int, Dict[str, Any]] = {}
+        for sender_id, user_row in sender_rows.items():
+            sender_fields[sender_id] = dict(
+                sender_full_name=user_row['full_name'],
+                sender_short_name=user_row['short_name'],
+                sender_email=user_row['email'],
+                sender_realm_str=user_row['realm__string_id'],
+                avatar_url=get_avatar_field(
+                    user_id=sender_id,
+                    realm_id=user_row['realm_id'],
+                    email=user_row['delivery_email'],
+                    avatar_source=user_row['avatar_source'],
+                    avatar_version=user_row['avatar_version'],
+                    medium=False,
+                    client_gravatar=client_gravatar,
+                ),
+            )
+        return sender_fields
+
+    @staticmethod
+    def get_recipient_fields(recipient_id: int, recipient_type: int, recipient_type_id: int,
+                             display_recipient: DisplayRecipientT,
+                             user_row: Dict[str, Any]) -> Dict[str, Any]:
+        """Returns the recipient fields of the final message payload for
+        messages to the recipient from the sender (whose row from
+        get_sender_rows is user_row)."""
+        if recipient_type == Recipient.STREAM:
+            return dict(
+                recipient_id=recipient_id,
+                display_recipient=display_recipient,
+                type='stream',
+                stream_id=recipient_type_id,
+            )
+        elif recipient_type in (Recipient.HUDDLE, Recipient.PERSONAL):
+            return dict(
+                recipient_id=recipient_id,
+                display_recipient=MessageDict.private_display_recipient(
+                    display_recipient,
+                    sender_id=user_row['id'],
+                    sender_email=user_row['email'],
+                    sender_full_name=user_row['full_name'],
+                    sender_short_name=user_row['short_name'],
+                    sender_is_mirror_dummy=user_row['is_mirror_dummy'],
+                ),
+                type='private',
+            )
+        else:
+            raise AssertionError(f"Invalid recipient type {recipient_type}")
+
+    @staticmethod
+    def finalize_content(obj: Dict[str, Any], apply_markdown: bool) -> None:
+        if apply_markdown:
+            obj['content_type'] = 'text/html'
+            obj['content'] = obj.pop('rendered_content')
+        else:
+            obj['content_type'] = 'text/x-markdown'
+            del obj['rendered_content']
+        del obj['sender_realm_id']
+
+    @staticmethod
+    def build_message_fragment(obj: Dict[str, Any], apply_markdown: bool,
+                               allow_edit_history: bool) -> MessageFragment:
+        """Encodes the parts of the final payload for a message (as
+        returned by build_message_dict) that don't depend on the sender,
+        recipient or user; see encoded_messages_for_ids."""
+        sender_id = obj['sender_id']
+        recipient_id = obj.pop('recipient_id')
+        recipient_type = obj.pop('recipient_type')
+        recipient_type_id = obj.pop('recipient_type_id')
+        if not allow_edit_history:
+            obj.pop('edit_history', None)
+        MessageDict.finalize_content(obj, apply_markdown)
+        # Messages always have an ID, so the encoding is nonempty.
+        return (sender_id, recipient_id, recipient_type, recipient_type_id,
+                ujson.dumps(obj)[1:-1])
 
     @staticmethod
     def finalize_payload(obj: Dict[str, Any],
@@ -431,15 +625,9 @@ class MessageDict:
         return obj
 
     @staticmethod
-    def bulk_hydrate_sender_info(objs: List[Dict[str, Any]]) -> None:
-
-        sender_ids = list({
-            obj['sender_id']
-            for obj in objs
-        })
-
+    def get_sender_rows(sender_ids: Set[int]) -> Dict[int, Dict[str, Any]]:
         if not sender_ids:
-            return
+            return {}
 
         query = UserProfile.objects.values(
             'id',
@@ -447,19 +635,24 @@ class MessageDict:
             'short_name',
             'delivery_email',
             'email',
+            'realm_id',
             'realm__string_id',
             'avatar_source',
             'avatar_version',
             'is_mirror_dummy',
         )
 
-        rows = query_for_ids(query, sender_ids, 'zerver_userprofile.id')
+        rows = query_for_ids(query, list(sender_ids), 'zerver_userprofile.id')
 
-        sender_dict = {
+        return {
             row['id']: row
             for row in rows
         }
 
+    @staticmethod
+    def bulk_hydrate_sender_info(objs: List[Dict[str, Any]]) -> None:
+        sender_dict = MessageDict.get_sender_rows({obj['sender_id'] for obj in objs})
+
         for obj in objs:
             sender_id = obj['sender_id']
             user_row = sender_dict[sender_id]
@@ -483,31 +676,19 @@ class MessageDict:
 
         recipient_type = obj['recipient_type']
         recipient_type_id = obj['recipient_type_id']
-        sender_is_mirror_dummy = obj['sender_is_mirror_dummy']
-        sender_email = obj['sender_email']
-        sender_full_name = obj['sender_full_name']
-        sender_short_name = obj['sender_short_name']
-        sender_id = obj['sender_id']
 
         if recipient_type == Recipient.STREAM:
             display_type = "stream"
         elif recipient_type in (Recipient.HUDDLE, Recipient.PERSONAL):
-            assert not isinstance(display_recipient, str)
             display_type = "private"
-            if len(display_recipient) == 1:
-                # add the sender in if this isn't a message between
-                # someone and themself, preserving ordering
-                recip: UserDisplayRecipient = {
-                    'email': sender_email,
-                    'full_name': sender_full_name,
-                    'short_name': sender_short_name,
-                    'id': sender_id,
-                    'is_mirror_dummy': sender_is_mirror_dummy,
-                }
-                if recip['email'] < display_recipient[0]['email']:
-                    display_recipient = [recip, display_recipient[0]]
-                elif recip['email'] > display_recipient[0]['email']:
-                    display_recipient = [display_recipient[0], recip]
+            display_recipient = MessageDict.private_display_recipient(
+                display_recipient,
+                sender_id=obj['sender_id'],
+                sender_email=obj['sender_email'],
+                sender_full_name=obj['sender_full_name'],
+                sender_short_name=obj['sender_short_name'],
+                sender_is_mirror_dummy=obj['sender_is_mirror_dummy'],
+            )
         else:
             raise AssertionError(f"Invalid recipient type {recipient_type}")
 
@@ -516,6 +697,30 @@ class MessageDict:
         if obj['type'] == 'stream':
             obj['stream_id'] = recipient_type_id
 
+    @staticmethod
+    def private_display_recipient(display_recipient: DisplayRecipientT,
+                                  sender_id: int,
+                                  sender_email: str,
+                                  sender_full_name: str,
+                                  sender_short_name: str,
+                                  sender_is_mirror_dummy: bool) -> DisplayRecipientT:
+        assert not isinstance(display_recipient, str)
+        if len(display_recipient) == 1:
+            # add the sender in if this isn't a message between
+            # someone and themself, preserving ordering
+            recip: UserDisplayRecipient = {
+                'email': sender_email,
+                'full_name': sender_full_name,
+                'short_name': sender_short_name,
+                'id': sender_id,
+                'is_mirror_dummy': sender_is_mirror_dummy,
+            }
+            if recip['email'] < display_recipient[0]['email']:
+                display_recipient = [recip, display_recipient[0]]
+            elif recip['email'] > display_recipient[0]['email']:
+                display_recipient = [display_recipient[0], recip]
+        return display_recipient
+
     @staticmethod
     def bulk_hydrate_recipient_info(objs: List[Dict[str, Any]]) -> None:
         recipient_tuples = {  # We use set to eliminate duplicate tuples.
@@ -691,7 +896,8 @@ def do_render_markdown(message: Message,
                        translate_emoticons: bool,
                        realm_alert_words_automaton: Optional[ahocorasick.Automaton]=None,
                        mention_data: Optional[bugdown.MentionData]=None,
-                       email_gateway: bool=False) -> str:
+                       email_gateway: bool=False,
+                       batch_data: Optional[bugdown.BatchRenderData]=None) -> str:
     """Return HTML for given markdown. Bugdown may add properties to the
     message object such as `mentions_user_ids`, `mentions_user_group_ids`, and
     `mentions_wildcard`.  These are only on this Django object and are not
@@ -715,9 +921,48 @@ def do_render_markdown(message: Message,
         translate_emoticons=translate_emoticons,
         mention_data=mention_data,
         email_gateway=email_gateway,
+        batch_data=batch_data,
     )
     return rendered_content
 
+def render_markdown_batch(realm: Realm, messages: Sequence[Message]) -> List[Optional[str]]:
+    """Renders the content of many messages from one realm, e.g. when
+    importing a realm or re-rendering messages after a change to our
+    markdown processor, returning the rendered content of each message
+    (or None, if rendering it failed).
+
+    Rather than fetching each message's mention, user group, stream
+    and emoji data separately, we fetch it for the whole batch with a
+    few queries up front.  The messages don't need to have been saved,
+    and nothing is saved to the database.
+    """
+    if not messages:
+        return []
+
+    sender_ids = {message.sender_id for message in messages}
+    senders = {
+        row['id']: row
+        for row in UserProfile.objects.filter(id__in=sender_ids).values(
+            'id', 'is_bot', 'translate_emoticons')
+    }
+    batch_data = bugdown.BatchRenderData(realm, [message.content for message in messages])
+    results: List[Optional[str]] = []
+    for message in messages:
+        sender = senders[message.sender_id]
+        try:
+            results.append(do_render_markdown(
+                message=message,
+                content=message.content,
+                realm=realm,
+                sent_by_bot=sender['is_bot'],
+                translate_emoticons=sender['translate_emoticons'],
+                batch_data=batch_data,
+            ))
+        except BugdownRenderingException:
+            # bugdown has already logged the problem.
+            results.append(None)
+    return results
+
 def huddle_users(recipient_id: int) -> str:
     display_recipient: DisplayRecipientT = get_display_recipient_by_id(
         recipient_id, Recipient.HUDDLE, None,
@@ -828,24 +1073,9 @@ def get_raw_unread_data(user_profile: UserProfile) -> RawUnreadMessagesResult:
 
     excluded_recipient_ids = get_inactive_recipient_ids(user_profile)
 
-    user_msgs = UserMessage.objects.filter(
-        user_profile=user_profile,
-    ).exclude(
-        message__recipient_id__in=excluded_recipient_ids,
-    ).extra(
-        where=[UserMessage.where_unread()],
-    ).values(
-        'message_id',
-        'message__sender_id',
-        MESSAGE__TOPIC,
-        'message__recipient_id',
-        'message__recipient__type',
-        'message__recipient__type_id',
-        'flags',
-    ).order_by("-message_id")
-
     # Limit unread messages for performance reasons.
-    user_msgs = list(user_msgs[:MAX_UNREAD_MESSAGES])
+    user_msgs = get_unread_message_rows(user_profile, excluded_recipient_ids,
+                                        limit=MAX_UNREAD_MESSAGES)
 
     rows = list(reversed(user_msgs))
 
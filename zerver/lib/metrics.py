@@ -0,0 +1,204 @@
+# A small, dependency-free implementation of in-process metrics
+# (counters, gauges and histograms, with labels), which can be served
+# over HTTP in the Prometheus text exposition format.  We use this to
+# monitor the queue processors; see QueueProcessingWorker.
+#
+# Updating a metric only takes an in-memory lock, so it's cheap enough
+# to do on hot paths; the work of formatting the metrics is done by the
+# exporter thread, when monitoring scrapes it.
+import bisect
+import logging
+import math
+import threading
+from abc import ABC, abstractmethod
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from typing import Dict, List, Optional, Sequence, Tuple
+
+LabelValues = Tuple[str, ...]
+
+# Suitable for timing things which take between a millisecond and a
+# minute, which covers everything our queue processors do.
+DEFAULT_SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                           1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value))
+
+def format_labels(label_names: Sequence[str], label_values: Sequence[str]) -> str:
+    if not label_names:
+        return ''
+    pairs = []
+    for name, value in zip(label_names, label_values):
+        escaped = value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+        pairs.append(f'{name}="{escaped}"')
+    return '{' + ','.join(pairs) + '}'
+
+class Metric(ABC):
+    metric_type = ''
+
+    def __init__(self, name: str, documentation: str,
+                 label_names: Sequence[str]=()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.lock = threading.Lock()
+
+    def check_labels(self, label_values: LabelValues) -> None:
+        if len(label_values) != len(self.label_names):
+            raise ValueError(f"{self.name} expects labels {self.label_names}, got {label_values}")
+
+    @abstractmethod
+    def samples(self) -> List[Tuple[str, str, float]]:
+        """Returns (name suffix, formatted labels, value) triples."""
+
+    def render(self) -> str:
+        lines = [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} {self.metric_type}',
+        ]
+        for suffix, labels, value in self.samples():
+            lines.append(f'{self.name}{suffix}{labels} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+class Counter(Metric):
+    metric_type = 'counter'
+
+    def __init__(self, name: str, documentation: str,
+                 label_names: Sequence[str]=()) -> None:
+        super().__init__(name, documentation, label_names)
+        self.values: Dict[LabelValues, float] = {}
+
+    def inc(self, *label_values: str, amount: float=1) -> None:
+        self.check_labels(label_values)
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def get(self, *label_values: str) -> float:
+        with self.lock:
+            return self.values.get(label_values, 0)
+
+    def samples(self) -> List[Tuple[str, str, float]]:
+        with self.lock:
+            return [('', format_labels(self.label_names, label_values), value)
+                    for label_values, value in sorted(self.values.items())]
+
+class Gauge(Counter):
+    metric_type = 'gauge'
+
+    def set(self, *label_values: str, value: float) -> None:
+        self.check_labels(label_values)
+        with self.lock:
+            self.values[label_values] = value
+
+class Histogram(Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, name: str, documentation: str,
+                 label_names: Sequence[str]=(),
+                 buckets: Sequence[float]=DEFAULT_SECONDS_BUCKETS) -> None:
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets))
+        # For each set of labels: the (non-cumulative) count in each
+        # bucket, with a final bucket for +Inf, and the sum.
+        self.counts: Dict[LabelValues, List[int]] = {}
+        self.sums: Dict[LabelValues, float] = {}
+
+    def observe(self, *label_values: str, value: float) -> None:
+        self.check_labels(label_values)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.counts.get(label_values)
+            if counts is None:
+                counts = self.counts[label_values] = [0] * (len(self.buckets) + 1)
+                self.sums[label_values] = 0.0
+            counts[index] += 1
+            self.sums[label_values] += value
+
+    def get_count(self, *label_values: str) -> int:
+        with self.lock:
+            return sum(self.counts.get(label_values, []))
+
+    def samples(self) -> List[Tuple[str, str, float]]:
+        samples = []
+        label_names = self.label_names + ('le',)
+        with self.lock:
+            for label_values, counts in sorted(self.counts.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (math.inf,), counts):
+                    cumulative += count
+                    samples.append(('_bucket',
+                                    format_labels(label_names, label_values + (format_value(bound),)),
+                                    cumulative))
+                labels = format_labels(self.label_names, label_values)
+                samples.append(('_sum', labels, self.sums[label_values]))
+                samples.append(('_count', labels, cumulative))
+        return samples
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        self.metrics: Dict[str, Metric] = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric: Metric) -> None:
+        with self.lock:
+            if metric.name in self.metrics:
+                raise ValueError(f"Duplicate metric {metric.name}")
+            self.metrics[metric.name] = metric
+
+    def render(self) -> str:
+        with self.lock:
+            metrics = sorted(self.metrics.values(), key=lambda metric: metric.name)
+        return ''.join(metric.render() for metric in metrics)
+
+registry = MetricsRegistry()
+
+def counter(name: str, documentation: str, label_names: Sequence[str]=()) -> Counter:
+    metric = Counter(name, documentation, label_names)
+    registry.register(metric)
+    return metric
+
+def gauge(name: str, documentation: str, label_names: Sequence[str]=()) -> Gauge:
+    metric = Gauge(name, documentation, label_names)
+    registry.register(metric)
+    return metric
+
+def histogram(name: str, documentation: str, label_names: Sequence[str]=(),
+              buckets: Sequence[float]=DEFAULT_SECONDS_BUCKETS) -> Histogram:
+    metric = Histogram(name, documentation, label_names, buckets)
+    registry.register(metric)
+    return metric
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: object) -> None:
+        # Don't log every scrape.
+        pass
+
+class ThreadingMetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def start_metrics_server(port: int, address: str='127.0.0.1') -> Optional[HTTPServer]:
+    """Serves the registry's metrics at http://address:port/metrics from
+    a daemon thread.  Failing to bind the port is logged rather than
+    fatal, since the metrics aren't essential to the caller's work."""
+    try:
+        server = ThreadingMetricsServer((address, port), MetricsRequestHandler)
+    except OSError:
+        logging.exception("Could not start metrics server on %s:%d", address, port)
+        return None
+    thread = threading.Thread(target=server.serve_forever, name='metrics_server', daemon=True)
+    thread.start()
+    return server
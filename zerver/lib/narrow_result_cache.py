@@ -0,0 +1,196 @@
+# Clients repeatedly fetch the newest messages in the same popular
+# narrows (a busy stream, a private conversation), often just to check
+# whether there's anything newer than what they already have.  Each of
+# those requests would otherwise run the full narrow query.
+#
+# So get_messages_backend keeps a short-lived cache, per user and
+# narrow, of the newest page of the narrow's query results (the
+# message IDs, and flags unless the narrow includes history), and
+# answers any request whose results are contained in that page from
+# the cache; see rows_from_page.  Only narrows limited to one stream,
+# or to private messages, are cached.
+#
+# A cached page is valid as long as the epochs it was computed under
+# are current: that of the messages the narrow is limited to (the
+# stream's, or the user's private messages'), the user's own and the
+# realm's.  send_event deletes the epochs that each event could
+# invalidate (see flush_narrow_result_cache_for_event), so that a new
+# message only deletes the epoch of its stream, or of the private
+# messages of each of its (few) recipients; events changing the flags,
+# subscriptions or muted topics of a user delete the user's epoch; and
+# message edits, moves and deletions delete the realm's.
+import hashlib
+import secrets
+from typing import Any, Callable, Dict, Iterable, List, Mapping, Optional, Tuple, Union
+
+import ujson
+from django.conf import settings
+
+from zerver.lib.cache import (
+    cache_delete_many_now_and_on_commit,
+    cache_get_many,
+    cache_set,
+    cache_set_many,
+    narrow_result_cache_key,
+    narrow_result_epoch_cache_key,
+)
+
+NARROW_RESULT_CACHE_TIMEOUT = 60
+NARROW_RESULT_EPOCH_TIMEOUT = 3600
+NARROW_RESULT_PAGE_SIZE = 200
+
+# Event types which can change the flags, or which messages are in
+# the narrows, of just the users receiving them.
+USER_EVENT_TYPES = {'muted_topics', 'subscription', 'update_message_flags'}
+
+class NarrowResultPage:
+    def __init__(self, rows: List[Tuple[Any, ...]], complete: bool) -> None:
+        # The newest rows of the narrow query, in ascending order of
+        # message ID; if `complete`, these are all of the rows.
+        self.rows = rows
+        self.complete = complete
+
+    def covers(self, message_id: int) -> bool:
+        """Whether the page has every row of the narrow with an ID of at
+        least message_id."""
+        return self.complete or (len(self.rows) > 0 and message_id >= self.rows[0][0])
+
+def stream_epoch_name(stream_id: int) -> str:
+    return f'stream:{stream_id}'
+
+def private_epoch_name(user_profile_id: int) -> str:
+    return f'private:{user_profile_id}'
+
+def narrow_result_epoch_names(user_profile_id: int, realm_id: int, messages_epoch: str) -> List[str]:
+    return [messages_epoch, f'user:{user_profile_id}', f'realm:{realm_id}']
+
+def get_narrow_result_page_key(user_profile_id: int, narrow: Optional[List[Dict[str, Any]]],
+                               include_history: bool) -> str:
+    digest = hashlib.sha256(ujson.dumps(
+        [narrow, include_history], sort_keys=True,
+    ).encode()).hexdigest()[:32]
+    return narrow_result_cache_key(user_profile_id, digest)
+
+def get_narrow_result_epochs(names: List[str], found: Mapping[str, Any]) -> Dict[str, str]:
+    epochs = {}
+    new_epochs = {}
+    for name in names:
+        key = narrow_result_epoch_cache_key(name)
+        if key in found:
+            epochs[name] = found[key]
+        else:
+            epochs[name] = new_epochs[key] = secrets.token_hex(8)
+    if new_epochs:
+        cache_set_many(new_epochs, timeout=NARROW_RESULT_EPOCH_TIMEOUT)
+    return epochs
+
+def get_narrow_result_page(
+        user_profile_id: int, realm_id: int, messages_epoch: str,
+        narrow: Optional[List[Dict[str, Any]]], include_history: bool,
+        fetch: Optional[Callable[[], NarrowResultPage]]) -> Optional[NarrowResultPage]:
+    """Returns the cached page of the narrow's results, if it's current.
+    Otherwise, if `fetch` is given, saves and returns the page it
+    fetches.  `messages_epoch` is the epoch of the messages the narrow
+    is limited to; see stream_epoch_name and private_epoch_name."""
+    page_key = get_narrow_result_page_key(user_profile_id, narrow, include_history)
+    names = narrow_result_epoch_names(user_profile_id, realm_id, messages_epoch)
+    found = cache_get_many([page_key] + [narrow_result_epoch_cache_key(name) for name in names])
+    epochs = get_narrow_result_epochs(names, found)
+    if page_key in found:
+        # cache_set stores values as 1-tuples.
+        cached_epochs, page = found[page_key][0]
+        if cached_epochs == epochs:
+            return page
+
+    if fetch is None:
+        return None
+    page = fetch()
+    cache_set(page_key, (epochs, page), timeout=NARROW_RESULT_CACHE_TIMEOUT)
+    return page
+
+def rows_from_page(page: NarrowResultPage,
+                   num_before: int,
+                   num_after: int,
+                   anchor: int,
+                   anchored_to_left: bool,
+                   anchored_to_right: bool,
+                   first_visible_message_id: int) -> Optional[List[Tuple[Any, ...]]]:
+    """Returns the rows that the query built by limit_query_to_range
+    would return, or None if they aren't all in the page."""
+    need_before_query = (not anchored_to_left) and (num_before > 0)
+    need_after_query = (not anchored_to_right) and (num_after > 0)
+    rows = page.rows
+
+    if not need_before_query and not need_after_query:
+        if not page.covers(anchor):
+            return None
+        return [row for row in rows if row[0] == anchor]
+
+    # These limits and anchors match limit_query_to_range.
+    if need_before_query and need_after_query:
+        before_anchor = anchor - 1
+        before_limit = num_before
+    elif need_before_query:
+        before_anchor = anchor
+        before_limit = num_before
+        if not anchored_to_right:
+            before_limit += 1
+    after_anchor = max(anchor, first_visible_message_id)
+    after_limit = num_after + 1
+
+    result: List[Tuple[Any, ...]] = []
+    if need_before_query:
+        if anchored_to_right:
+            before_rows = rows[-before_limit:]
+        else:
+            before_rows = [row for row in rows if row[0] <= before_anchor][-before_limit:]
+        # The page is the newest rows of the narrow, so if it has
+        # enough rows before the anchor, they're the right ones.
+        if len(before_rows) < before_limit and not page.complete:
+            return None
+        result += before_rows
+
+    if need_after_query:
+        if anchored_to_left:
+            # The oldest rows of the narrow.
+            if not page.complete:
+                return None
+            result += rows[:after_limit]
+        else:
+            if not page.covers(after_anchor):
+                return None
+            result += [row for row in rows if row[0] >= after_anchor][:after_limit]
+
+    return sorted(result, key=lambda row: row[0])
+
+def flush_narrow_result_epochs(names: List[str]) -> None:
+    cache_delete_many_now_and_on_commit(narrow_result_epoch_cache_key(name) for name in names)
+
+def flush_narrow_result_cache_for_users(user_ids: Iterable[int]) -> None:
+    if not settings.NARROW_RESULT_CACHE:
+        return
+    flush_narrow_result_epochs([f'user:{user_id}' for user_id in user_ids])
+
+def flush_narrow_result_cache_for_event(realm_id: int, event: Mapping[str, Any],
+                                        users: Iterable[Union[int, Mapping[str, Any]]]) -> None:
+    if not settings.NARROW_RESULT_CACHE:
+        return
+    names = []
+    event_type = event['type']
+    user_ids = [user['id'] if isinstance(user, dict) else user for user in users]
+    if event_type == 'message':
+        if 'stream_id' in event['message_dict']:
+            names.append(stream_epoch_name(event['message_dict']['stream_id']))
+        else:
+            # A private message's recipients are just the participants
+            # in the conversation.
+            names += [private_epoch_name(user_id) for user_id in user_ids]
+    elif event_type in USER_EVENT_TYPES:
+        if event_type != 'subscription' or event['op'] not in ('peer_add', 'peer_remove'):
+            names += [f'user:{user_id}' for user_id in user_ids]
+    elif event_type in ('delete_message', 'stream', 'update_message'):
+        # Edits can change the messages' flags and which narrows
+        # they're in; they're rare enough compared to new messages
+        # that we don't bother finding which streams they're in.
+        names.append(f'realm:{realm_id}')
+    flush_narrow_result_epochs(names)
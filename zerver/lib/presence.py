@@ -2,12 +2,19 @@ import datetime
 import itertools
 import time
 from collections import defaultdict
-from typing import Any, Dict, List, Set
+from typing import Any, Dict, List, Optional, Set
 
 from django.utils.timezone import now as timezone_now
 
 from zerver.lib.timestamp import datetime_to_timestamp
-from zerver.models import PushDeviceToken, Realm, UserPresence, UserProfile, query_for_ids
+from zerver.models import (
+    PresenceSequence,
+    PushDeviceToken,
+    Realm,
+    UserPresence,
+    UserProfile,
+    query_for_ids,
+)
 
 
 def get_status_dicts_for_rows(all_rows: List[Dict[str, Any]],
@@ -138,14 +145,25 @@ def get_presence_for_user(user_profile_id: int,
     return get_status_dicts_for_rows(presence_rows, mobile_user_ids, slim_presence)
 
 
-def get_status_dict_by_realm(realm_id: int, slim_presence: bool = False) -> Dict[str, Dict[str, Any]]:
+def get_status_dict_by_realm(realm_id: int, slim_presence: bool = False,
+                             last_update_id_fetched_by_client: Optional[int] = None,
+                             ) -> Dict[str, Dict[str, Any]]:
     two_weeks_ago = timezone_now() - datetime.timedelta(weeks=2)
     query = UserPresence.objects.filter(
         realm_id=realm_id,
         timestamp__gte=two_weeks_ago,
         user_profile__is_active=True,
         user_profile__is_bot=False,
-    ).values(
+    )
+    if last_update_id_fetched_by_client is not None:
+        # Only the users with presence data the client hasn't seen;
+        # we still fetch all of each such user's rows, since a user's
+        # entry in the response is computed from all their clients.
+        query = query.filter(user_profile_id__in=UserPresence.objects.filter(
+            realm_id=realm_id,
+            last_update_id__gt=last_update_id_fetched_by_client,
+        ).values('user_profile_id'))
+    query = query.values(
         'client__name',
         'status',
         'timestamp',
@@ -182,18 +200,30 @@ def get_status_dict_by_realm(realm_id: int, slim_presence: bool = False) -> Dict
 
     return get_status_dicts_for_rows(presence_rows, mobile_user_ids, slim_presence)
 
-def get_presences_for_realm(realm: Realm,
-                            slim_presence: bool) -> Dict[str, Dict[str, Dict[str, Any]]]:
+def get_presences_for_realm(realm: Realm, slim_presence: bool,
+                            last_update_id_fetched_by_client: Optional[int] = None,
+                            ) -> Dict[str, Dict[str, Dict[str, Any]]]:
 
     if realm.presence_disabled:
         # Return an empty dict if presence is disabled in this realm
         return defaultdict(dict)
 
-    return get_status_dict_by_realm(realm.id, slim_presence)
+    return get_status_dict_by_realm(realm.id, slim_presence, last_update_id_fetched_by_client)
+
+def get_presence_last_update_id(realm_id: int) -> int:
+    return PresenceSequence.objects.filter(realm_id=realm_id).values_list(
+        'last_update_id', flat=True).first() or 0
 
 def get_presence_response(requesting_user_profile: UserProfile,
-                          slim_presence: bool) -> Dict[str, Any]:
+                          slim_presence: bool,
+                          last_update_id_fetched_by_client: Optional[int] = None,
+                          ) -> Dict[str, Any]:
     realm = requesting_user_profile.realm
     server_timestamp = time.time()
-    presences = get_presences_for_realm(realm, slim_presence)
-    return dict(presences=presences, server_timestamp=server_timestamp)
+    # We read the sequence before the presence data, so that the data
+    # includes every update up to the ID we return (and perhaps a few
+    # more, which the client will harmlessly receive again).
+    presence_last_update_id = get_presence_last_update_id(realm.id)
+    presences = get_presences_for_realm(realm, slim_presence, last_update_id_fetched_by_client)
+    return dict(presences=presences, server_timestamp=server_timestamp,
+                presence_last_update_id=presence_last_update_id)
@@ -2,8 +2,9 @@ import logging
 import random
 import threading
 import time
-from collections import defaultdict
-from typing import Any, Callable, Dict, List, Mapping, Optional, Set
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from typing import Any, Callable, Collection, Dict, Iterator, List, Mapping, Optional, Set, Tuple
 
 import pika
 import pika.adapters.tornado_connection
@@ -107,18 +108,40 @@ class SimpleQueueClient:
             self.queues.add(queue_name)
         callback()
 
+    def ensure_queues(self, queue_names: Collection[str], callback: Callable[[], None]) -> None:
+        '''Ensure that all of the given queues have been declared, and
+           then call the callback with no arguments.'''
+        if not queue_names:
+            callback()
+            return
+        queue_name, *rest = queue_names
+        self.ensure_queue(queue_name, lambda: self.ensure_queues(rest, callback))
+
+    def _basic_publish(self, queue_name: str, body: bytes) -> None:
+        self.channel.basic_publish(
+            exchange='',
+            routing_key=queue_name,
+            properties=pika.BasicProperties(delivery_mode=2),
+            body=body)
+
     def publish(self, queue_name: str, body: bytes) -> None:
         def do_publish() -> None:
-            self.channel.basic_publish(
-                exchange='',
-                routing_key=queue_name,
-                properties=pika.BasicProperties(delivery_mode=2),
-                body=body)
-
+            self._basic_publish(queue_name, body)
             statsd.incr(f"rabbitmq.publish.{queue_name}")
 
         self.ensure_queue(queue_name, do_publish)
 
+    def publish_batch(self, messages: List[Tuple[str, bytes]]) -> None:
+        '''Publishes a list of (queue_name, body) pairs in order,
+           declaring each queue only once.'''
+        def do_publish() -> None:
+            for queue_name, body in messages:
+                self._basic_publish(queue_name, body)
+            for queue_name, count in Counter(queue_name for queue_name, body in messages).items():
+                statsd.incr(f"rabbitmq.publish.{queue_name}", count)
+
+        self.ensure_queues({queue_name for queue_name, body in messages}, do_publish)
+
     def json_publish(self, queue_name: str, body: Mapping[str, Any]) -> None:
         data = ujson.dumps(body).encode()
         try:
@@ -130,6 +153,18 @@ class SimpleQueueClient:
         self._reconnect()
         self.publish(queue_name, data)
 
+    def json_publish_batch(self, messages: List[Tuple[str, bytes]]) -> None:
+        '''Like json_publish, for a list of (queue_name, body) pairs
+           whose bodies are already JSON-encoded.'''
+        try:
+            self.publish_batch(messages)
+            return
+        except pika.exceptions.AMQPConnectionError:
+            self.log.warning("Failed to send batch to rabbitmq, trying to reconnect and send again")
+
+        self._reconnect()
+        self.publish_batch(messages)
+
     def register_consumer(self, queue_name: str, consumer: Consumer) -> None:
         def wrapped_consumer(ch: BlockingChannel,
                              method: Basic.Deliver,
@@ -156,6 +191,47 @@ class SimpleQueueClient:
             callback(ujson.loads(body))
         self.register_consumer(queue_name, wrapped_callback)
 
+    def start_json_batch_consumer(self, queue_name: str,
+                                  callback: Callable[[List[Dict[str, Any]]], None],
+                                  batch_size: int, max_latency: float,
+                                  prefetch_count: int) -> None:
+        """Consumes the queue until stop_consuming is called, passing
+        events to the callback in batches of at most batch_size events.
+        A partial batch is passed on once its oldest event has waited
+        max_latency seconds, or as soon as the queue goes idle.  Every
+        event in a batch is acknowledged (or, if the callback raises,
+        rejected) with a single message to RabbitMQ.
+
+        prefetch_count bounds how many unacknowledged events RabbitMQ
+        will push to us; it should be at least batch_size, so that the
+        next batch can arrive while the current one is being processed.
+        """
+        def opened() -> None:
+            self.channel.basic_qos(prefetch_count=prefetch_count)
+        self.ensure_queue(queue_name, opened)
+
+        events: List[Dict[str, Any]] = []
+        last_delivery_tag = 0
+        batch_start = 0.0
+        for method, properties, body in self.channel.consume(queue_name,
+                                                             inactivity_timeout=max_latency):
+            if method is not None:
+                if not events:
+                    batch_start = time.time()
+                events.append(ujson.loads(body))
+                last_delivery_tag = method.delivery_tag
+            if not events:
+                continue
+            if (method is None or len(events) >= batch_size or
+                    time.time() - batch_start >= max_latency):
+                try:
+                    callback(events)
+                    self.channel.basic_ack(delivery_tag=last_delivery_tag, multiple=True)
+                except Exception as e:
+                    self.channel.basic_nack(delivery_tag=last_delivery_tag, multiple=True)
+                    raise e
+                events = []
+
     def drain_queue(self, queue_name: str) -> List[bytes]:
         "Returns all messages in the desired queue"
         messages = []
@@ -185,6 +261,12 @@ class SimpleQueueClient:
     def stop_consuming(self) -> None:
         self.channel.stop_consuming()
 
+    def stop_consuming_threadsafe(self) -> None:
+        """stop_consuming, for use from a thread other than the one
+        consuming from this client; pika's BlockingConnection isn't
+        thread-safe, so we have the consuming thread do the work."""
+        self.connection.add_callback_threadsafe(self.stop_consuming)
+
 # Patch pika.adapters.tornado_connection.TornadoConnection so that a socket error doesn't
 # throw an exception and disconnect the tornado process from the rabbitmq
 # queue. Instead, just re-connect as usual
@@ -208,6 +290,11 @@ class TornadoQueueClient(SimpleQueueClient):
             rabbitmq_heartbeat=None)
         self._on_open_cbs: List[Callable[[], None]] = []
         self._connection_failure_count = 0
+        # We use asynchronous publisher confirms, so that we find out
+        # about messages RabbitMQ failed to accept without waiting on
+        # each publish.  Maps delivery tags to (queue_name, body).
+        self._last_delivery_tag = 0
+        self._unconfirmed: Dict[int, Tuple[str, bytes]] = {}
 
     def _connect(self) -> None:
         self.log.info("Beginning TornadoQueueClient connection")
@@ -222,6 +309,11 @@ class TornadoQueueClient(SimpleQueueClient):
         self.connection = None
         self.channel = None
         self.queues = set()
+        if self._unconfirmed:
+            self.log.warning("TornadoQueueClient lost %d unconfirmed messages",
+                             len(self._unconfirmed))
+        self._last_delivery_tag = 0
+        self._unconfirmed = {}
         self.log.warning("TornadoQueueClient attempting to reconnect to RabbitMQ")
         self._connect()
 
@@ -274,11 +366,32 @@ class TornadoQueueClient(SimpleQueueClient):
 
     def _on_channel_open(self, channel: BlockingChannel) -> None:
         self.channel = channel
+        channel.confirm_delivery(ack_nack_callback=self._on_delivery_confirmation)
         for callback in self._on_open_cbs:
             callback()
         self._reconnect_consumer_callbacks()
         self.log.info('TornadoQueueClient connected')
 
+    def _basic_publish(self, queue_name: str, body: bytes) -> None:
+        super()._basic_publish(queue_name, body)
+        self._last_delivery_tag += 1
+        self._unconfirmed[self._last_delivery_tag] = (queue_name, body)
+
+    def _on_delivery_confirmation(self, frame: pika.frame.Method) -> None:
+        method = frame.method
+        if method.multiple:
+            delivery_tags = [tag for tag in self._unconfirmed if tag <= method.delivery_tag]
+        else:
+            delivery_tags = [method.delivery_tag]
+        for delivery_tag in delivery_tags:
+            if delivery_tag not in self._unconfirmed:
+                continue
+            queue_name, body = self._unconfirmed.pop(delivery_tag)
+            if isinstance(method, Basic.Nack):
+                statsd.incr(f"rabbitmq.publish_nack.{queue_name}")
+                self.log.error("RabbitMQ failed to accept a message published to %s: %r",
+                               queue_name, body)
+
     def ensure_queue(self, queue_name: str, callback: Callable[[], None]) -> None:
         def finish(frame: Any) -> None:
             self.queues.add(queue_name)
@@ -330,13 +443,43 @@ def get_queue_client() -> SimpleQueueClient:
 # randomly close.
 queue_lock = threading.RLock()
 
+# Events published with queue_json_publish inside a
+# queue_publish_batch block; they are encoded immediately, so that
+# later mutations of the event don't affect what is sent.
+batch_state = threading.local()
+
+@contextmanager
+def queue_publish_batch() -> Iterator[None]:
+    '''Buffers the RabbitMQ events published by queue_json_publish in
+    this thread, and publishes them together, in order, when the
+    block exits (including via an exception).  Nested blocks are part
+    of the outermost block's batch.  Without RabbitMQ, this has no
+    effect, since queue_json_publish processes events immediately.'''
+    if getattr(batch_state, 'pending', None) is not None:
+        yield
+        return
+
+    batch_state.pending = []
+    try:
+        yield
+    finally:
+        pending = batch_state.pending
+        batch_state.pending = None
+        if pending:
+            with queue_lock:
+                get_queue_client().json_publish_batch(pending)
+
 def queue_json_publish(queue_name: str,
                        event: Dict[str, Any],
                        processor: Callable[[Any], None]=None) -> None:
     # most events are dicts, but zerver.middleware.write_log_line uses a str
     with queue_lock:
         if settings.USING_RABBITMQ:
-            get_queue_client().json_publish(queue_name, event)
+            pending: Optional[List[Tuple[str, bytes]]] = getattr(batch_state, 'pending', None)
+            if pending is not None:
+                pending.append((queue_name, ujson.dumps(event).encode()))
+            else:
+                get_queue_client().json_publish(queue_name, event)
         elif processor:
             processor(event)
         else:
@@ -31,7 +31,7 @@ class RateLimitedObject(ABC):
         if backend is not None:
             self.backend: Type[RateLimiterBackend] = backend
         else:
-            self.backend = RedisRateLimiterBackend
+            self.backend = get_default_rate_limiter_backend()
 
     def rate_limit(self) -> Tuple[bool, float]:
         # Returns (ratelimited, secs_to_freedom)
@@ -460,6 +460,156 @@ class RedisRateLimiterBackend(RateLimiterBackend):
 
         return ratelimited, time
 
+class RedisTokenBucketRateLimiterBackend(RateLimiterBackend):
+    """Implements each rule as a token bucket, using the generic cell
+    rate algorithm (as TornadoInMemoryRateLimiterBackend does): for a
+    rule of max_count requests per time_window, we store the rule's
+    "theoretical arrival time" (TAT), which each request pushes
+    time_window / max_count seconds further into the future, and allow
+    a request only if it leaves the TAT at most time_window seconds
+    ahead of now.  The TATs for all of an entity's rules are checked
+    and updated by a single Lua script, so each check is one atomic
+    round trip to Redis.
+
+    With RATE_LIMITING_LEASE_SIZE > 1, each check asks Redis for up to
+    that many tokens, and this process hands the extra ones out to the
+    entity's next requests for RATE_LIMITING_LEASE_SECONDS without
+    contacting Redis.  Leased tokens this process doesn't use are
+    lost, so an entity whose requests are spread across many
+    processes can be limited up to (lease size - 1) requests per
+    process early; and a manual block only takes effect in a process
+    once the entity's lease there runs out.
+    """
+
+    # KEYS[1] is a hash holding the entity's TAT for each rule, keyed
+    # by "time_window:max_count", and KEYS[2] is its manual block key.
+    # ARGV is the current time, the number of tokens wanted, and then
+    # a time_window, max_count pair for each rule, longest rule last.
+    #
+    # Returns the number of tokens granted, and either the time until
+    # a request would be allowed (if none were granted) or the longest
+    # rule's new TAT.  Floats are returned as strings, since Redis
+    # would truncate them to integers.
+    TOKEN_BUCKET_SCRIPT = """
+local blocking_ttl = redis.call('PTTL', KEYS[2])
+if blocking_ttl ~= -2 then
+    if blocking_ttl < 0 then
+        blocking_ttl = 500
+    end
+    return {0, string.format('%.17g', blocking_ttl / 1000)}
+end
+
+local now = tonumber(ARGV[1])
+local granted = tonumber(ARGV[2])
+local rules = {}
+local longest_window = 0
+for i = 3, #ARGV, 2 do
+    local time_window = tonumber(ARGV[i])
+    local interval = time_window / tonumber(ARGV[i + 1])
+    local field = ARGV[i] .. ':' .. ARGV[i + 1]
+    local tat = math.max(tonumber(redis.call('HGET', KEYS[1], field) or now), now)
+    if tat + interval > now + time_window then
+        return {0, string.format('%.17g', tat + interval - time_window - now)}
+    end
+    local available = math.max(math.floor((now + time_window - tat) / interval), 1)
+    granted = math.min(granted, available)
+    rules[#rules + 1] = {field, tat, interval}
+    longest_window = math.max(longest_window, time_window)
+end
+
+local new_tat = now
+for _, rule in ipairs(rules) do
+    new_tat = rule[2] + granted * rule[3]
+    redis.call('HSET', KEYS[1], rule[1], string.format('%.17g', new_tat))
+end
+redis.call('EXPIRE', KEYS[1], math.ceil(longest_window))
+return {granted, string.format('%.17g', new_tat)}
+"""
+    token_bucket_script = client.register_script(TOKEN_BUCKET_SCRIPT)
+
+    # leases[entity_key] is (tokens, expires_at, reset_time): the
+    # number of tokens this process has taken from Redis for the
+    # entity but not yet used, when they expire, and the longest
+    # rule's TAT in Redis as of the last time we checked it.
+    leases: Dict[str, Tuple[int, float, float]] = {}
+    MAX_LEASES = 10000
+
+    @classmethod
+    def get_keys(cls, entity_key: str) -> List[str]:
+        return [f"{KEY_PREFIX}ratelimit:{entity_key}:{keytype}"
+                for keytype in ['bucket', 'block']]
+
+    @classmethod
+    def block_access(cls, entity_key: str, seconds: int) -> None:
+        "Manually blocks an entity for the desired number of seconds"
+        _, blocking_key = cls.get_keys(entity_key)
+        client.set(blocking_key, 1, ex=seconds)
+        cls.leases.pop(entity_key, None)
+
+    @classmethod
+    def unblock_access(cls, entity_key: str) -> None:
+        _, blocking_key = cls.get_keys(entity_key)
+        client.delete(blocking_key)
+
+    @classmethod
+    def clear_history(cls, entity_key: str) -> None:
+        client.delete(*cls.get_keys(entity_key))
+        cls.leases.pop(entity_key, None)
+
+    @classmethod
+    def get_api_calls_left(cls, entity_key: str, range_seconds: int,
+                           max_calls: int) -> Tuple[int, float]:
+        now = time.time()
+        lease = cls.leases.get(entity_key)
+        if lease is not None and now < lease[1]:
+            tokens, _, reset_time = lease
+        else:
+            bucket_key, _ = cls.get_keys(entity_key)
+            value = client.hget(bucket_key, f"{range_seconds}:{max_calls}")
+            if value is None:
+                return max_calls, 0
+            tokens, reset_time = 0, float(value)
+
+        calls_remaining = (now + range_seconds - reset_time) * max_calls // range_seconds
+        return int(calls_remaining) + tokens, reset_time - now
+
+    @classmethod
+    def take_tokens(cls, entity_key: str, rules: List[Tuple[int, int]],
+                    wanted: int, now: float) -> Tuple[int, float]:
+        "Returns (tokens_granted, secs_to_freedom or reset_time)"
+        args: List[float] = [now, wanted]
+        for time_window, max_count in rules:
+            args += [time_window, max_count]
+        granted, value = cls.token_bucket_script(keys=cls.get_keys(entity_key), args=args)
+        return int(granted), float(value)
+
+    @classmethod
+    def rate_limit_entity(cls, entity_key: str, rules: List[Tuple[int, int]],
+                          max_api_calls: int, max_api_window: int) -> Tuple[bool, float]:
+        assert rules
+        now = time.time()
+        lease = cls.leases.get(entity_key)
+        if lease is not None and lease[0] > 0 and now < lease[1]:
+            tokens, expires_at, reset_time = lease
+            cls.leases[entity_key] = (tokens - 1, expires_at, reset_time)
+            return False, 0.0
+
+        granted, value = cls.take_tokens(entity_key, rules, settings.RATE_LIMITING_LEASE_SIZE, now)
+        if granted == 0:
+            cls.leases.pop(entity_key, None)
+            statsd.incr(f"ratelimiter.limited.{entity_key}")
+            return True, value
+
+        if len(cls.leases) >= cls.MAX_LEASES:
+            cls.leases = {key: lease for key, lease in cls.leases.items() if now < lease[1]}
+        cls.leases[entity_key] = (granted - 1, now + settings.RATE_LIMITING_LEASE_SECONDS, value)
+        return False, 0.0
+
+def get_default_rate_limiter_backend() -> Type[RateLimiterBackend]:
+    if settings.RATE_LIMITING_BACKEND == 'redis_token_bucket':
+        return RedisTokenBucketRateLimiterBackend
+    return RedisRateLimiterBackend
+
 class RateLimitResult:
     def __init__(self, entity: RateLimitedObject, secs_to_freedom: float, over_limit: bool,
                  remaining: int) -> None:
@@ -0,0 +1,155 @@
+# The realm-wide parts of the state returned by /register (the users,
+# user groups, custom profile fields, etc.) are the same for every
+# user in a realm, and are expensive to compute for large realms.  A
+# reconnect storm, when thousands of clients re-register at once
+# (e.g. after a deploy), would otherwise compute them thousands of
+# times.  So fetch_initial_state_data gets them from a shared snapshot
+# of each section, which we store (pickled and compressed) in
+# memcached, with a small per-process LRU cache in front of it.
+#
+# Each section of a realm's snapshot has a version, which is a random
+# token stored in memcached and part of the cache key for the
+# section's data.  send_event deletes the version of any section
+# which the event could change (see SNAPSHOT_SECTIONS_BY_EVENT_TYPE),
+# and the next /register then builds a fresh snapshot under a new
+# version.  Since clients register their event queue before fetching
+# the initial state, an event is always either reflected in the
+# snapshot the client gets, or delivered to its queue (or both, which
+# is equally true of fetching the data from the database).
+#
+# Presence data changes too often for this, so it's instead versioned
+# by time, and may be up to PRESENCE_SNAPSHOT_SECONDS old; clients
+# refresh the presence data periodically anyway.
+import pickle
+import secrets
+import time
+import zlib
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, List, Tuple
+
+from django.conf import settings
+
+from zerver.lib.cache import (
+    cache_delete_many_now_and_on_commit,
+    cache_get_many,
+    cache_set_many,
+    realm_snapshot_cache_key,
+    realm_snapshot_version_cache_key,
+)
+
+REALM_SNAPSHOT_TIMEOUT = 3600 * 24
+REALM_SNAPSHOT_LOCAL_SIZE = 100
+PRESENCE_SNAPSHOT_SECONDS = 10
+
+# The snapshot sections which each type of event can change.
+SNAPSHOT_SECTIONS_BY_EVENT_TYPE: Dict[str, List[str]] = {
+    'custom_profile_fields': ['custom_profile_fields', 'realm_users'],
+    # For changes to e.g. email_address_visibility.
+    'realm': ['realm_users'],
+    'realm_bot': ['realm_users'],
+    'realm_user': ['realm_users'],
+    'user_group': ['realm_user_groups'],
+    'user_status': ['user_status'],
+}
+
+# Sections which are versioned by time, rather than by events, and
+# the number of seconds each version lasts.
+TIME_VERSIONED_SECTIONS: Dict[str, int] = {
+    'presences': PRESENCE_SNAPSHOT_SECONDS,
+}
+
+# Maps cache keys to encoded snapshot sections.
+local_snapshots: 'OrderedDict[str, bytes]' = OrderedDict()
+
+# A section of the snapshot to fetch: its name, the variant of the
+# section (for sections whose content depends on e.g. client
+# capabilities), and a function to build it.
+SnapshotSection = Tuple[str, str, Callable[[], Any]]
+
+def encode_snapshot(data: Any) -> bytes:
+    return zlib.compress(pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL))
+
+def decode_snapshot(blob: bytes) -> Any:
+    return pickle.loads(zlib.decompress(blob))
+
+def get_snapshot_versions(realm_id: int, names: Iterable[str]) -> Dict[str, str]:
+    versions = {}
+    version_keys = {}
+    for name in names:
+        if name in TIME_VERSIONED_SECTIONS:
+            versions[name] = str(int(time.time() // TIME_VERSIONED_SECTIONS[name]))
+        else:
+            version_keys[name] = realm_snapshot_version_cache_key(realm_id, name)
+    if not version_keys:
+        return versions
+
+    found = cache_get_many(list(version_keys.values()))
+    new_versions = {}
+    for name, key in version_keys.items():
+        if key in found:
+            versions[name] = found[key]
+        else:
+            versions[name] = new_versions[key] = secrets.token_hex(8)
+    if new_versions:
+        cache_set_many(new_versions, timeout=REALM_SNAPSHOT_TIMEOUT)
+    return versions
+
+def save_local_snapshot(key: str, blob: bytes) -> None:
+    local_snapshots[key] = blob
+    local_snapshots.move_to_end(key)
+    while len(local_snapshots) > REALM_SNAPSHOT_LOCAL_SIZE:
+        local_snapshots.popitem(last=False)
+
+def get_realm_snapshot(realm_id: int, sections: List[SnapshotSection]) -> Dict[str, Any]:
+    """Returns the current data for each of the given sections of the
+    realm's snapshot, building and saving any that aren't cached.  The
+    data is decoded afresh for each call, so the caller may modify it.
+    """
+    if not settings.REALM_SNAPSHOT_CACHE:
+        return {name: build() for name, variant, build in sections}
+
+    versions = get_snapshot_versions(realm_id, [name for name, variant, build in sections])
+    keys = {
+        name: realm_snapshot_cache_key(realm_id, name, variant, versions[name])
+        for name, variant, build in sections
+    }
+
+    blobs = {}
+    for name, key in keys.items():
+        if key in local_snapshots:
+            local_snapshots.move_to_end(key)
+            blobs[name] = local_snapshots[key]
+    remote_keys = [key for name, key in keys.items() if name not in blobs]
+    if remote_keys:
+        found = cache_get_many(remote_keys)
+        for name, key in keys.items():
+            if key in found:
+                blobs[name] = found[key]
+                save_local_snapshot(key, found[key])
+
+    result = {name: decode_snapshot(blob) for name, blob in blobs.items()}
+    # Maps cache timeouts to the new blobs to save with that timeout.
+    new_blobs: Dict[int, Dict[str, bytes]] = {}
+    for name, variant, build in sections:
+        if name in result:
+            continue
+        result[name] = build()
+        blob = encode_snapshot(result[name])
+        save_local_snapshot(keys[name], blob)
+        if name in TIME_VERSIONED_SECTIONS:
+            timeout = TIME_VERSIONED_SECTIONS[name] * 2
+        else:
+            timeout = REALM_SNAPSHOT_TIMEOUT
+        new_blobs.setdefault(timeout, {})[keys[name]] = blob
+    for timeout, items in new_blobs.items():
+        cache_set_many(items, timeout=timeout)
+    return result
+
+def flush_realm_snapshot(realm_id: int, names: Iterable[str]) -> None:
+    if not settings.REALM_SNAPSHOT_CACHE:
+        return
+    cache_delete_many_now_and_on_commit(
+        realm_snapshot_version_cache_key(realm_id, name) for name in names)
+
+def flush_realm_snapshot_for_event(realm_id: int, event_type: str) -> None:
+    flush_realm_snapshot(realm_id, SNAPSHOT_SECTIONS_BY_EVENT_TYPE.get(event_type, []))
@@ -1,4 +1,4 @@
-from typing import Any, List, Mapping, Optional
+from typing import Any, Dict, Iterable, List, Mapping, Optional
 
 import ujson
 from django.http import HttpResponse, HttpResponseNotAllowed
@@ -47,6 +47,56 @@ def json_response(res_type: str="success",
 def json_success(data: Mapping[str, Any]={}) -> HttpResponse:
     return json_response(data=data)
 
+class PreEncodedJSONDict(Dict[str, Any]):
+    """A dict which is sent unmodified in many responses (e.g. a message
+    payload delivered to every event queue subscribed to a stream),
+    and so carries its own JSON encoding, computed just once, for
+    json_events_response to splice into responses.  It must not be
+    mutated after construction; it is otherwise an ordinary dict.
+    """
+
+    def __init__(self, data: Mapping[str, Any]) -> None:
+        super().__init__(data)
+        self.encoded = ujson.dumps(data)
+
+def encode_event(event: Mapping[str, Any]) -> str:
+    message = event.get("message")
+    if not isinstance(message, PreEncodedJSONDict):
+        return ujson.dumps(event)
+    rest = dict(event)
+    del rest["message"]
+    # Events always have at least a type and id, so `rest` is nonempty.
+    encoded = ujson.dumps(rest)
+    return encoded[:-1] + ',"message":' + message.encoded + "}"
+
+def encode_events(events: Iterable[Mapping[str, Any]]) -> str:
+    return "[" + ",".join(encode_event(event) for event in events) + "]"
+
+def json_events_response(res_type: str="success",
+                         msg: str="",
+                         data: Mapping[str, Any]={},
+                         status: int=200) -> HttpResponse:
+    """Equivalent to json_response, for responses containing an `events`
+    list, but without re-encoding any PreEncodedJSONDict payloads."""
+    content: Dict[str, Any] = {"result": res_type, "msg": msg}
+    content.update(data)
+    events = content.pop("events", None)
+    if events is None:
+        return json_response(res_type=res_type, msg=msg, data=data, status=status)
+    encoded = ujson.dumps(content)
+    return HttpResponse(content=encoded[:-1] + ',"events":' + encode_events(events) + "}\n",
+                        content_type='application/json', status=status)
+
+def json_success_with_messages(data: Mapping[str, Any], encoded_messages: List[str]) -> HttpResponse:
+    """Equivalent to json_success for a response with a `messages` list,
+    given the JSON encoding of each message (see
+    encoded_messages_for_ids), which we splice in without decoding."""
+    content: Dict[str, Any] = {"result": "success", "msg": ""}
+    content.update(data)
+    encoded = ujson.dumps(content)
+    return HttpResponse(content=encoded[:-1] + ',"messages":[' + ",".join(encoded_messages) + "]}\n",
+                        content_type='application/json')
+
 def json_response_from_error(exception: JsonableError) -> HttpResponse:
     '''
     This should only be needed in middleware; in app code, just raise.
@@ -11,6 +11,7 @@ from typing import Any, Dict, List, Mapping, Optional, Tuple
 import ujson
 from django.conf import settings
 from django.core.mail import EmailMultiAlternatives
+from django.core.mail.backends.base import BaseEmailBackend
 from django.core.management import CommandError
 from django.template import loader
 from django.template.exceptions import TemplateDoesNotExist
@@ -141,19 +142,24 @@ class NoEmailArgumentException(CommandError):
 def send_email(template_prefix: str, to_user_ids: Optional[List[int]]=None,
                to_emails: Optional[List[str]]=None, from_name: Optional[str]=None,
                from_address: Optional[str]=None, reply_to_email: Optional[str]=None,
-               language: Optional[str]=None, context: Dict[str, Any]={}) -> None:
+               language: Optional[str]=None, context: Dict[str, Any]={},
+               connection: Optional[BaseEmailBackend]=None) -> None:
     mail = build_email(template_prefix, to_user_ids=to_user_ids, to_emails=to_emails,
                        from_name=from_name, from_address=from_address,
                        reply_to_email=reply_to_email, language=language, context=context)
     template = template_prefix.split("/")[-1]
     logger.info("Sending %s email to %s", template, mail.to)
 
+    if connection is not None:
+        # Reuse the caller's (already open) connection to the mail server.
+        mail.connection = connection
     if mail.send() == 0:
         logger.error("Error sending %s email to %s", template, mail.to)
         raise EmailNotDeliveredException
 
-def send_email_from_dict(email_dict: Mapping[str, Any]) -> None:
-    send_email(**dict(email_dict))
+def send_email_from_dict(email_dict: Mapping[str, Any],
+                         connection: Optional[BaseEmailBackend]=None) -> None:
+    send_email(**dict(email_dict), connection=connection)
 
 def send_future_email(template_prefix: str, realm: Realm, to_user_ids: Optional[List[int]]=None,
                       to_emails: Optional[List[str]]=None, from_name: Optional[str]=None,
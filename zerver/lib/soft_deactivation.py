@@ -9,6 +9,7 @@ from django.db.models import Max
 from django.utils.timezone import now as timezone_now
 
 from zerver.lib.logging_util import log_to_file
+from zerver.lib.narrow_result_cache import flush_narrow_result_cache_for_users
 from zerver.models import (
     Message,
     Realm,
@@ -204,6 +205,7 @@ def add_missing_messages(user_profile: UserProfile) -> None:
         UserMessage.objects.bulk_create(messages)
         user_profile.last_active_message_id = messages[-1].message_id
         user_profile.save(update_fields=['last_active_message_id'])
+    flush_narrow_result_cache_for_users([user_profile.id])
 
 def do_soft_deactivate_user(user_profile: UserProfile) -> None:
     try:
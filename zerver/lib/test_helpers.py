@@ -415,6 +415,7 @@ def write_instrumentation_reports(full_suite: bool, include_webhooks: bool) -> N
             # We exempt some patterns that are called via Tornado.
             'api/v1/events',
             'api/v1/events/internal',
+            'api/v1/events/internal/cleanup',
             'api/v1/register',
             # We also exempt some development environment debugging
             # static content URLs, since the content they point to may
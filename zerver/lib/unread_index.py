@@ -0,0 +1,240 @@
+# get_raw_unread_data needs the stream, topic, etc. of each of a
+# user's (up to MAX_UNREAD_MESSAGES) unread messages, which means
+# joining those UserMessage rows with Message and Recipient.  For
+# users with tens of thousands of unread messages, that join is most
+# of the cost of /register.
+#
+# So we keep a compact per-user index of those rows in memcached: the
+# distinct conversations (recipient and topic), and for each unread
+# message, its conversation, sender and mention flags.  These never
+# change for a message, except when it's edited, which invalidates
+# the affected indexes (see flush_unread_index_for_users and
+# flush_unread_index_for_realm).
+#
+# The index is maintained incrementally, but lazily: rather than
+# writing to every recipient's index whenever a message is sent or
+# marked as read, each lookup fetches the IDs of the user's unread
+# messages (an index-only scan of the partial index on unread
+# UserMessage rows), uses the index for the messages it has, fetches
+# rows only for the messages it's missing (e.g. new messages), and
+# drops the messages which are no longer unread.
+import pickle
+import secrets
+import zlib
+from array import array
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from django.conf import settings
+from django.db.models.query import QuerySet
+
+from zerver.lib.cache import (
+    cache_delete_many_now_and_on_commit,
+    cache_get_many,
+    cache_set,
+    unread_index_cache_key,
+    unread_index_epoch_cache_key,
+)
+from zerver.lib.topic import MESSAGE__TOPIC
+from zerver.models import UserMessage, UserProfile
+
+UNREAD_INDEX_TIMEOUT = 3600 * 24 * 7
+
+# The only flags get_raw_unread_data needs.
+INDEXED_FLAGS = int(UserMessage.flags.mentioned | UserMessage.flags.wildcard_mentioned)
+
+# (recipient_id, recipient type, recipient type_id, topic)
+Conversation = Tuple[int, int, int, str]
+
+def unread_message_rows_query(user_profile: UserProfile) -> QuerySet:
+    return UserMessage.objects.filter(
+        user_profile=user_profile,
+    ).extra(
+        where=[UserMessage.where_unread()],
+    ).values(
+        'message_id',
+        'message__sender_id',
+        MESSAGE__TOPIC,
+        'message__recipient_id',
+        'message__recipient__type',
+        'message__recipient__type_id',
+        'flags',
+    ).order_by("-message_id")
+
+def fetch_unread_message_rows(user_profile: UserProfile, excluded_recipient_ids: Iterable[int],
+                              limit: int) -> List[Dict[str, Any]]:
+    query = unread_message_rows_query(user_profile).exclude(
+        message__recipient_id__in=excluded_recipient_ids,
+    )
+    return list(query[:limit])
+
+class UnreadIndex:
+    def __init__(self, epoch: str) -> None:
+        self.epoch = epoch
+        self.conversations: List[Conversation] = []
+        self.conversation_numbers: Dict[Conversation, int] = {}
+        # Maps message IDs to (conversation number, sender ID, flags).
+        self.messages: Dict[int, Tuple[int, int, int]] = {}
+        self.changed = False
+
+    def add_row(self, row: Dict[str, Any]) -> None:
+        conversation = (row['message__recipient_id'], row['message__recipient__type'],
+                        row['message__recipient__type_id'], row[MESSAGE__TOPIC])
+        number = self.conversation_numbers.get(conversation)
+        if number is None:
+            number = self.conversation_numbers[conversation] = len(self.conversations)
+            self.conversations.append(conversation)
+        self.messages[row['message_id']] = (number, row['message__sender_id'],
+                                            row['flags'] & INDEXED_FLAGS)
+        self.changed = True
+
+    def get_row(self, message_id: int) -> Optional[Dict[str, Any]]:
+        """Returns the message's row, in the same format as
+        unread_message_rows_query (except for only having INDEXED_FLAGS)."""
+        if message_id not in self.messages:
+            return None
+        number, sender_id, flags = self.messages[message_id]
+        recipient_id, recipient_type, recipient_type_id, topic = self.conversations[number]
+        return {
+            'message_id': message_id,
+            'message__sender_id': sender_id,
+            MESSAGE__TOPIC: topic,
+            'message__recipient_id': recipient_id,
+            'message__recipient__type': recipient_type,
+            'message__recipient__type_id': recipient_type_id,
+            'flags': flags,
+        }
+
+    def retain(self, message_ids: Set[int]) -> None:
+        removed_ids = [message_id for message_id in self.messages
+                       if message_id not in message_ids]
+        for message_id in removed_ids:
+            del self.messages[message_id]
+        if removed_ids:
+            self.changed = True
+
+    def to_bytes(self) -> bytes:
+        # We store the per-message data as arrays, which are far more
+        # compact than a pickled dictionary of tuples; conversations
+        # which no longer have unread messages are dropped.
+        message_ids = sorted(self.messages)
+        used_numbers = sorted({self.messages[message_id][0] for message_id in message_ids})
+        renumbering = {number: i for i, number in enumerate(used_numbers)}
+        conversations = [self.conversations[number] for number in used_numbers]
+        data = (
+            self.epoch,
+            conversations,
+            array('q', message_ids),
+            array('q', [renumbering[self.messages[message_id][0]] for message_id in message_ids]),
+            array('q', [self.messages[message_id][1] for message_id in message_ids]),
+            array('q', [self.messages[message_id][2] for message_id in message_ids]),
+        )
+        return zlib.compress(pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL))
+
+    @classmethod
+    def from_bytes(cls, blob: bytes) -> 'UnreadIndex':
+        epoch, conversations, message_ids, numbers, sender_ids, flags = pickle.loads(
+            zlib.decompress(blob))
+        index = cls(epoch)
+        index.conversations = conversations
+        index.conversation_numbers = {
+            conversation: number for number, conversation in enumerate(conversations)
+        }
+        index.messages = {
+            message_id: (number, sender_id, message_flags)
+            for message_id, number, sender_id, message_flags
+            in zip(message_ids, numbers, sender_ids, flags)
+        }
+        return index
+
+def get_unread_index(user_profile: UserProfile) -> Tuple[Optional[UnreadIndex], str]:
+    """Returns the user's index, if there's a current one, and the
+    realm's current epoch."""
+    epoch_key = unread_index_epoch_cache_key(user_profile.realm_id)
+    index_key = unread_index_cache_key(user_profile.id)
+    # cache_set stores values as 1-tuples.
+    found = cache_get_many([epoch_key, index_key])
+    if epoch_key in found:
+        epoch = found[epoch_key][0]
+    else:
+        epoch = secrets.token_hex(8)
+        cache_set(epoch_key, epoch, timeout=UNREAD_INDEX_TIMEOUT)
+    if index_key not in found:
+        return None, epoch
+    index = UnreadIndex.from_bytes(found[index_key][0])
+    if index.epoch != epoch:
+        return None, epoch
+    return index, epoch
+
+def get_unread_message_rows(user_profile: UserProfile, excluded_recipient_ids: Iterable[int],
+                            limit: int) -> List[Dict[str, Any]]:
+    """Returns the same rows as fetch_unread_message_rows (newest first),
+    using and updating the user's unread index."""
+    if not settings.UNREAD_INDEX:
+        return fetch_unread_message_rows(user_profile, excluded_recipient_ids, limit)
+
+    index, epoch = get_unread_index(user_profile)
+    if index is None:
+        rows = fetch_unread_message_rows(user_profile, excluded_recipient_ids, limit)
+        index = UnreadIndex(epoch)
+        for row in rows:
+            index.add_row(row)
+        cache_set(unread_index_cache_key(user_profile.id), index.to_bytes(),
+                  timeout=UNREAD_INDEX_TIMEOUT)
+        return rows
+
+    excluded_recipient_ids = set(excluded_recipient_ids)
+    rows: List[Dict[str, Any]] = []
+    unread_ids: Set[int] = set()
+    before_id: Optional[int] = None
+    while True:
+        query = UserMessage.objects.filter(
+            user_profile=user_profile,
+        ).extra(
+            where=[UserMessage.where_unread()],
+        )
+        if before_id is not None:
+            query = query.filter(message_id__lt=before_id)
+        message_ids = list(query.order_by('-message_id').values_list(
+            'message_id', flat=True)[:limit])
+        unread_ids.update(message_ids)
+
+        missing_ids = [message_id for message_id in message_ids
+                       if message_id not in index.messages]
+        if missing_ids:
+            for row in unread_message_rows_query(user_profile).filter(message_id__in=missing_ids):
+                index.add_row(row)
+
+        for message_id in message_ids:
+            row = index.get_row(message_id)
+            # The row can be missing if the message was marked as
+            # read after we fetched its ID.
+            if row is None or row['message__recipient_id'] in excluded_recipient_ids:
+                continue
+            rows.append(row)
+            if len(rows) == limit:
+                break
+
+        # We only need to look further back if we excluded some
+        # messages from a full page of unread messages.
+        if len(rows) == limit or len(message_ids) < limit:
+            break
+        before_id = message_ids[-1]
+
+    index.retain(unread_ids)
+    if index.changed:
+        cache_set(unread_index_cache_key(user_profile.id), index.to_bytes(),
+                  timeout=UNREAD_INDEX_TIMEOUT)
+    return rows
+
+def flush_unread_index_for_users(user_ids: Iterable[int]) -> None:
+    """For changes to the mention flags of some users' messages."""
+    if not settings.UNREAD_INDEX:
+        return
+    cache_delete_many_now_and_on_commit(unread_index_cache_key(user_id) for user_id in user_ids)
+
+def flush_unread_index_for_realm(realm_id: int) -> None:
+    """For changes to the stream or topic of messages, which can
+    affect any user in the realm."""
+    if not settings.UNREAD_INDEX:
+        return
+    cache_delete_many_now_and_on_commit([unread_index_epoch_cache_key(realm_id)])
@@ -206,6 +206,20 @@ def user_ids_to_users(user_ids: Sequence[int], realm: Realm) -> List[UserProfile
             raise JsonableError(_("Invalid user ID: {}").format(user_profile.id))
     return user_profiles
 
+def prefetch_user_profiles_by_id(user_ids: Sequence[int]) -> None:
+    """Makes sure these users are in the remote cache, fetching any that
+    are missing with a single query, so that subsequent
+    get_user_profile_by_id calls for them don't hit the database."""
+
+    def fetch_users_by_id(user_ids: List[int]) -> List[UserProfile]:
+        return list(UserProfile.objects.filter(id__in=user_ids).select_related())
+
+    generic_bulk_cached_fetch(
+        cache_key_function=user_profile_by_id_cache_key,
+        query_function=fetch_users_by_id,
+        object_ids=user_ids,
+    )
+
 def access_bot_by_id(user_profile: UserProfile, user_id: int) -> UserProfile:
     try:
         target = get_user_profile_by_id_in_realm(user_id, user_profile.realm)
@@ -303,6 +317,10 @@ def compute_show_invites_and_add_streams(user_profile: Optional[UserProfile]) ->
 
     return True, True
 
+def can_access_delivery_emails(realm: Realm, acting_user: UserProfile) -> bool:
+    return (realm.email_address_visibility == Realm.EMAIL_ADDRESS_VISIBILITY_ADMINS and
+            acting_user.is_realm_admin)
+
 def format_user_row(realm: Realm, acting_user: UserProfile, row: Dict[str, Any],
                     client_gravatar: bool, user_avatar_url_field_optional: bool,
                     custom_profile_field_data: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
@@ -358,8 +376,7 @@ def format_user_row(realm: Realm, acting_user: UserProfile, row: Dict[str, Any],
                                                 medium=False,
                                                 client_gravatar=client_gravatar)
 
-    if (realm.email_address_visibility == Realm.EMAIL_ADDRESS_VISIBILITY_ADMINS and
-            acting_user.is_realm_admin):
+    if can_access_delivery_emails(realm, acting_user):
         result['delivery_email'] = row['delivery_email']
 
     if is_bot:
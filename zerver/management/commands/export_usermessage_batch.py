@@ -2,12 +2,13 @@ import glob
 import logging
 import os
 import shutil
+import time
 from argparse import ArgumentParser
-from typing import Any
+from typing import Any, Dict, Set
 
 from django.core.management.base import BaseCommand
 
-from zerver.lib.export import export_usermessages_batch
+from zerver.lib.export import MESSAGE_PARTIALS_IN_PROGRESS_FILE, export_usermessages_batch
 
 
 class Command(BaseCommand):
@@ -33,7 +34,21 @@ class Command(BaseCommand):
 
     def handle(self, *args: Any, **options: Any) -> None:
         logging.info("Starting UserMessage batch thread %s", options['thread'])
-        files = set(glob.glob(os.path.join(options['path'], 'messages-*.json.partial')))
+        in_progress_path = os.path.join(options['path'], MESSAGE_PARTIALS_IN_PROGRESS_FILE)
+        while True:
+            # Check this before looking for files, so that we don't
+            # miss any written just before the export finished.
+            in_progress = os.path.exists(in_progress_path)
+            files = set(glob.glob(os.path.join(options['path'], 'messages-*.json.partial')))
+            if files:
+                self.process_files(files, options)
+            elif in_progress:
+                # do_export_realm is still writing .partial files.
+                time.sleep(0.1)
+            else:
+                break
+
+    def process_files(self, files: Set[str], options: Dict[str, Any]) -> None:
         for partial_path in files:
             locked_path = partial_path.replace(".json.partial", ".json.locked")
             output_path = partial_path.replace(".json.partial", ".json")
@@ -30,6 +30,13 @@ import a database dump from one or more JSON files."""
                             action="store_true",
                             help='Import into an existing nonempty database.')
 
+        parser.add_argument('--resume',
+                            dest='resume',
+                            default=False,
+                            action="store_true",
+                            help='Resume an import into this subdomain which failed, '
+                                 'from its last completed step.')
+
         parser.add_argument('subdomain', metavar='<subdomain>',
                             type=str, help="Subdomain")
 
@@ -40,7 +47,8 @@ import a database dump from one or more JSON files."""
                             dest='processes',
                             action="store",
                             default=settings.DEFAULT_DATA_EXPORT_IMPORT_PARALLELISM,
-                            help='Number of processes to use for uploading Avatars to S3 in parallel')
+                            help='Number of processes to use for uploading Avatars to S3, and for importing '
+                            'message files, in parallel')
         parser.formatter_class = argparse.RawTextHelpFormatter
 
     def do_destroy_and_rebuild_database(self, db_name: str) -> None:
@@ -61,7 +69,8 @@ import a database dump from one or more JSON files."""
         elif options["import_into_nonempty"]:
             print("NOTE: The argument 'import_into_nonempty' is now the default behavior.")
 
-        check_subdomain_available(subdomain, from_management_command=True)
+        if not options["resume"]:
+            check_subdomain_available(subdomain, from_management_command=True)
 
         paths = []
         for path in options['export_paths']:
@@ -75,6 +84,6 @@ import a database dump from one or more JSON files."""
 
         for path in paths:
             print(f"Processing dump: {path} ...")
-            realm = do_import_realm(path, subdomain, num_processes)
+            realm = do_import_realm(path, subdomain, num_processes, resume=options["resume"])
             print("Checking the system bots.")
             do_import_system_bots(realm)
@@ -6,7 +6,7 @@ from zerver.lib.actions import (
     bulk_remove_subscriptions,
     do_deactivate_stream,
 )
-from zerver.lib.cache import cache_delete_many, to_dict_cache_key_id
+from zerver.lib.cache import cache_delete_many, message_cache_keys
 from zerver.lib.management import ZulipBaseCommand
 from zerver.models import Message, Subscription, get_stream
 
@@ -15,7 +15,7 @@ def bulk_delete_cache_keys(message_ids_to_clear: List[int]) -> None:
     while len(message_ids_to_clear) > 0:
         batch = message_ids_to_clear[0:5000]
 
-        keys_to_delete = [to_dict_cache_key_id(message_id) for message_id in batch]
+        keys_to_delete = [key for message_id in batch for key in message_cache_keys(message_id)]
         cache_delete_many(keys_to_delete)
 
         message_ids_to_clear = message_ids_to_clear[5000:]
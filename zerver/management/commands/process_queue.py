@@ -2,16 +2,22 @@ import logging
 import signal
 import sys
 import threading
+import time
 from argparse import ArgumentParser
 from types import FrameType
 from typing import Any, List
 
+from django import db
 from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
 from django.utils import autoreload
 
+from zerver.lib.metrics import start_metrics_server
 from zerver.worker.queue_processors import get_active_worker_queues, get_worker
 
+# How long we wait, on shutdown, for the workers in a multi-threaded
+# queue processor to finish the events they're processing.
+THREAD_SHUTDOWN_TIMEOUT_SECONDS = 20
 
 class Command(BaseCommand):
     def add_arguments(self, parser: ArgumentParser) -> None:
@@ -25,6 +31,8 @@ class Command(BaseCommand):
                             metavar='<list of queue name>',
                             type=str, required=False,
                             help="list of queue to process")
+        parser.add_argument('--metrics_port', metavar='<port>', type=int, required=False,
+                            help="serve the workers' metrics on http://127.0.0.1:<port>/metrics")
 
     help = "Runs a queue processing worker"
 
@@ -48,24 +56,58 @@ class Command(BaseCommand):
                 logger.error("Cannot run a queue processor when USING_RABBITMQ is False!")
             raise CommandError
 
-        def run_threaded_workers(queues: List[str], logger: logging.Logger) -> None:
-            cnt = 0
+        def run_threaded_workers(queues: List[str], logger: logging.Logger) -> List['Threaded_worker']:
+            if options['metrics_port']:
+                start_metrics_server(options['metrics_port'])
+            threads = []
             for queue_name in queues:
                 if not settings.DEVELOPMENT:
                     logger.info('launching queue worker thread ' + queue_name)
-                cnt += 1
                 td = Threaded_worker(queue_name)
                 td.start()
-            assert len(queues) == cnt
-            logger.info('%d queue worker threads were launched', cnt)
-
-        if options['all']:
-            signal.signal(signal.SIGUSR1, exit_with_three)
-            autoreload.run_with_reloader(run_threaded_workers, get_active_worker_queues(), logger)
-        elif options['multi_threaded']:
-            signal.signal(signal.SIGUSR1, exit_with_three)
-            queues = options['multi_threaded']
-            autoreload.run_with_reloader(run_threaded_workers, queues, logger)
+                threads.append(td)
+            assert len(queues) == len(threads)
+            logger.info('%d queue worker threads were launched', len(threads))
+            return threads
+
+        if options['all'] or options['multi_threaded']:
+            if options['all']:
+                queues = get_active_worker_queues()
+            else:
+                queues = options['multi_threaded']
+
+            if settings.DEVELOPMENT:
+                signal.signal(signal.SIGUSR1, exit_with_three)
+                autoreload.run_with_reloader(run_threaded_workers, queues, logger)
+                return
+
+            # In production, we don't want autoreload's file watching
+            # (or the extra copy of this process it runs the workers
+            # in); supervisord restarts us if we exit.
+            threads = run_threaded_workers(queues, logger)
+
+            def stop_threads(signal: int, frame: FrameType) -> None:
+                logger.info("Stopping %d queue worker threads", len(threads))
+                for td in threads:
+                    td.stop()
+                deadline = time.time() + THREAD_SHUTDOWN_TIMEOUT_SECONDS
+                for td in threads:
+                    td.join(max(0, deadline - time.time()))
+                sys.exit(0)
+            signal.signal(signal.SIGTERM, stop_threads)
+            signal.signal(signal.SIGINT, stop_threads)
+            signal.signal(signal.SIGUSR1, stop_threads)
+
+            while True:
+                dead_threads = [td for td in threads if not td.is_alive()]
+                if dead_threads:
+                    # A worker thread only exits if its worker crashed
+                    # outright; exit, so that supervisord restarts all
+                    # the workers in a clean process.
+                    logger.error("Queue worker thread for %s exited; restarting",
+                                 dead_threads[0].worker.queue_name)
+                    sys.exit(1)
+                time.sleep(1)
         else:
             queue_name = options['queue_name']
             worker_num = options['worker_num']
@@ -73,6 +115,8 @@ class Command(BaseCommand):
             logger.info("Worker %d connecting to queue %s", worker_num, queue_name)
             worker = get_worker(queue_name)
             worker.setup()
+            if options['metrics_port']:
+                start_metrics_server(options['metrics_port'])
 
             def signal_handler(signal: int, frame: FrameType) -> None:
                 logger.info("Worker %d disconnecting from queue %s", worker_num, queue_name)
@@ -86,10 +130,23 @@ class Command(BaseCommand):
 
 class Threaded_worker(threading.Thread):
     def __init__(self, queue_name: str) -> None:
-        threading.Thread.__init__(self)
+        # Daemon threads, so that a worker which won't stop (e.g. a
+        # LoopQueueProcessingWorker sleeping between batches) doesn't
+        # prevent the process from exiting.
+        threading.Thread.__init__(self, name=f'queue_worker_{queue_name}', daemon=True)
         self.worker = get_worker(queue_name)
 
     def run(self) -> None:
-        self.worker.setup()
-        logging.debug('starting consuming ' + self.worker.queue_name)
-        self.worker.start()
+        # Each thread has its own RabbitMQ connection (pika connections
+        # aren't thread-safe), and Django gives each thread its own
+        # database connection, which we close when the worker exits.
+        try:
+            self.worker.setup()
+            logging.debug('starting consuming ' + self.worker.queue_name)
+            self.worker.start()
+        finally:
+            db.connections.close_all()
+
+    def stop(self) -> None:
+        if self.worker.q is not None:
+            self.worker.q.stop_consuming_threadsafe()
@@ -0,0 +1,29 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('zerver', '0293_update_invite_as_dict_values'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PresenceSequence',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_update_id', models.BigIntegerField(default=0)),
+                ('realm', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='zerver.Realm')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='userpresence',
+            name='last_update_id',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AlterIndexTogether(
+            name='userpresence',
+            index_together={('realm', 'timestamp'), ('realm', 'last_update_id')},
+        ),
+    ]
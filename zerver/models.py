@@ -54,7 +54,6 @@ from zerver.lib.cache import (
     generic_bulk_cached_fetch,
     get_realm_used_upload_space_cache_key,
     get_stream_cache_key,
-    realm_alert_words_automaton_cache_key,
     realm_alert_words_cache_key,
     realm_user_dict_fields,
     realm_user_dicts_cache_key,
@@ -2448,6 +2447,7 @@ class UserPresence(models.Model):
         unique_together = ("user_profile", "client")
         index_together = [
             ("realm", "timestamp"),
+            ("realm", "last_update_id"),
         ]
 
     user_profile: UserProfile = models.ForeignKey(UserProfile, on_delete=CASCADE)
@@ -2457,6 +2457,11 @@ class UserPresence(models.Model):
     # The time we heard this update from the client.
     timestamp: datetime.datetime = models.DateTimeField('presence changed')
 
+    # The realm's PresenceSequence value when this row was last
+    # written, which lets clients fetch just the presence data that
+    # changed since their previous request.
+    last_update_id: int = models.BigIntegerField(default=0)
+
     # The user was actively using this Zulip client as of `timestamp` (i.e.,
     # they had interacted with the client recently).  When the timestamp is
     # itself recent, this is the green "active" status in the webapp.
@@ -2515,6 +2520,13 @@ class UserPresence(models.Model):
 
         return status_val
 
+class PresenceSequence(models.Model):
+    """The last UserPresence.last_update_id allocated in a realm.  Writers
+    lock this row while writing presence data, so that IDs become visible
+    to readers in increasing order."""
+    realm: Realm = models.OneToOneField(Realm, on_delete=CASCADE)
+    last_update_id: int = models.BigIntegerField(default=0)
+
 class UserStatus(models.Model):
     user_profile: UserProfile = models.OneToOneField(UserProfile, on_delete=CASCADE)
 
@@ -2989,12 +3001,24 @@ class AlertWord(models.Model):
         unique_together = ("user_profile", "word")
 
 def flush_realm_alert_words(realm: Realm) -> None:
+    # The per-process alert word automata are instead updated by
+    # zerver.lib.alert_words.publish_alert_word_change.
     cache_delete(realm_alert_words_cache_key(realm))
-    cache_delete(realm_alert_words_automaton_cache_key(realm))
 
 def flush_alert_word(sender: Any, **kwargs: Any) -> None:
-    realm = kwargs['instance'].realm
-    flush_realm_alert_words(realm)
+    from zerver.lib.alert_words import publish_alert_word_change
+    alert_word = kwargs['instance']
+    word = alert_word.word.lower()
+    change: Optional[Tuple[int, List[str], List[str]]]
+    if 'created' not in kwargs:
+        # post_delete, including for cascading deletes.
+        change = (alert_word.user_profile_id, [], [word])
+    elif kwargs['created']:
+        change = (alert_word.user_profile_id, [word], [])
+    else:
+        # We don't know the word's previous value.
+        change = None
+    publish_alert_word_change(alert_word.realm, change)
 
 post_save.connect(flush_alert_word, sender=AlertWord)
 post_delete.connect(flush_alert_word, sender=AlertWord)
@@ -1,10 +1,19 @@
+from typing import Dict, Set
+from unittest import mock
+
 import ujson
 
 from zerver.lib.actions import do_add_alert_words, do_remove_alert_words
-from zerver.lib.alert_words import alert_words_in_realm, user_alert_words
+from zerver.lib.alert_words import alert_words_in_realm, get_alert_word_automaton, user_alert_words
+from zerver.lib.cache import (
+    cache_delete,
+    cache_get_many,
+    realm_alert_words_change_cache_key,
+    realm_alert_words_version_cache_key,
+)
 from zerver.lib.test_classes import ZulipTestCase
 from zerver.lib.test_helpers import most_recent_message, most_recent_usermessage
-from zerver.models import UserProfile
+from zerver.models import AlertWord, UserProfile
 
 
 class AlertWordTests(ZulipTestCase):
@@ -100,6 +109,47 @@ class AlertWordTests(ZulipTestCase):
                          set(self.interesting_alert_word_list))
         self.assertEqual(set(realm_words[user2.id]), {'another'})
 
+    def test_alert_word_automaton(self) -> None:
+        cordelia = self.example_user('cordelia')
+        othello = self.example_user('othello')
+        realm = cordelia.realm
+
+        def alert_words_found(content: str) -> Dict[str, Set[int]]:
+            automaton = get_alert_word_automaton(realm)
+            if automaton is None:
+                return {}
+            return {word: set(user_ids) for end_index, (word, user_ids) in automaton.iter(content)}
+
+        self.assertEqual(alert_words_found('alert another'), {})
+        do_add_alert_words(cordelia, ['Alert', 'another'])
+        do_add_alert_words(othello, ['another'])
+
+        # The automaton is updated from the changes, without fetching
+        # all of the realm's alert words.
+        with mock.patch('zerver.lib.alert_words.alert_words_in_realm') as mock_alert_words:
+            self.assertEqual(alert_words_found('alert another'),
+                             {'alert': {cordelia.id}, 'another': {cordelia.id, othello.id}})
+            do_remove_alert_words(cordelia, ['another'])
+            self.assertEqual(alert_words_found('alert another'),
+                             {'alert': {cordelia.id}, 'another': {othello.id}})
+        mock_alert_words.assert_not_called()
+
+        # If a change is evicted from the cache, we fetch all the words.
+        do_remove_alert_words(othello, ['another'])
+        version = cache_get_many([realm_alert_words_version_cache_key(realm.id)])[
+            realm_alert_words_version_cache_key(realm.id)]
+        cache_delete(realm_alert_words_change_cache_key(realm.id, version))
+        self.assertEqual(alert_words_found('alert another'), {'alert': {cordelia.id}})
+
+        # Changes made other than by add_user_alert_words and
+        # remove_user_alert_words (e.g. cascading deletes) are
+        # published by AlertWord's signal handlers.
+        AlertWord.objects.create(user_profile=othello, realm=realm, word='Another')
+        self.assertEqual(alert_words_found('alert another'),
+                         {'alert': {cordelia.id}, 'another': {othello.id}})
+        AlertWord.objects.filter(user_profile=cordelia).delete()
+        self.assertEqual(alert_words_found('alert another'), {'another': {othello.id}})
+
     def test_json_list_default(self) -> None:
         self.login('hamlet')
 
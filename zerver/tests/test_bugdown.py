@@ -12,6 +12,7 @@ from django.test import TestCase, override_settings
 from zerver.lib import bugdown, mdiff
 from zerver.lib.actions import (
     do_add_alert_words,
+    do_change_full_name,
     do_remove_realm_emoji,
     do_set_realm_property,
     do_set_user_display_setting,
@@ -21,9 +22,10 @@ from zerver.lib.create_user import create_user
 from zerver.lib.emoji import get_emoji_url
 from zerver.lib.exceptions import BugdownRenderingException
 from zerver.lib.mention import possible_mentions, possible_user_group_mentions
-from zerver.lib.message import render_markdown
+from zerver.lib.message import render_markdown, render_markdown_batch
 from zerver.lib.request import JsonableError
 from zerver.lib.test_classes import ZulipTestCase
+from zerver.lib.test_helpers import queries_captured
 from zerver.lib.test_runner import slow
 from zerver.lib.tex import render_tex
 from zerver.lib.user_groups import create_user_group
@@ -1462,6 +1464,82 @@ class BugdownTest(ZulipTestCase):
                          'King Hamlet</span></p>')
         self.assertEqual(msg.mentions_user_ids, set())
 
+    @override_settings(BUGDOWN_RENDER_CACHE=True)
+    def test_render_cache(self) -> None:
+        bugdown.render_cache.clear()
+        othello = self.example_user('othello')
+        hamlet = self.example_user('hamlet')
+        do_add_alert_words(hamlet, ["alertword"])
+        realm_alert_words_automaton = get_alert_word_automaton(othello.realm)
+        content = "@**King Hamlet** alertword `code`"
+        expected = ('<p><span class="user-mention" '
+                    f'data-user-id="{hamlet.id}">'
+                    '@King Hamlet</span> alertword <code>code</code></p>')
+
+        def render() -> Message:
+            msg = Message(sender=othello, sending_client=get_client("test"))
+            self.assertEqual(render_markdown(msg, content,
+                                             realm_alert_words_automaton=realm_alert_words_automaton),
+                             expected)
+            self.assertEqual(msg.mentions_user_ids, {hamlet.id})
+            self.assertEqual(msg.user_ids_with_alert_words, {hamlet.id})
+            return msg
+
+        render()
+        with mock.patch('zerver.lib.bugdown.timeout') as mock_timeout:
+            render()
+        mock_timeout.assert_not_called()
+
+        # The same result comes from memcached in a fresh process.
+        bugdown.render_cache.clear()
+        with mock.patch('zerver.lib.bugdown.timeout') as mock_timeout:
+            render()
+        mock_timeout.assert_not_called()
+
+        # Renaming the mentioned user changes the cache key.
+        do_change_full_name(hamlet, "Prince Hamlet", acting_user=None)
+        msg = Message(sender=othello, sending_client=get_client("test"))
+        self.assertEqual(render_markdown(msg, content), '<p>@<strong>King Hamlet</strong> alertword <code>code</code></p>')
+        self.assertEqual(msg.mentions_user_ids, set())
+
+        # So does adding a realm filter.
+        msg = Message(sender=othello, sending_client=get_client("test"))
+        content = "Check #123"
+        self.assertEqual(render_markdown(msg, content), '<p>Check #123</p>')
+        RealmFilter(realm=othello.realm, pattern=r"#(?P<id>[0-9]+)",
+                    url_format_string=r"https://trac.example.com/ticket/%(id)s").save()
+        self.assertEqual(render_markdown(msg, content),
+                         '<p>Check <a href="https://trac.example.com/ticket/123">#123</a></p>')
+
+    def test_render_markdown_batch(self) -> None:
+        othello = self.example_user('othello')
+        hamlet = self.example_user('hamlet')
+        realm = othello.realm
+        contents = [
+            "@**King Hamlet** hello",
+            "#**Denmark** :green_tick:",
+            "**bold**",
+        ]
+        messages = [Message(sender=othello, sending_client=get_client("test"), content=content)
+                    for content in contents]
+        expected = [render_markdown(Message(sender=othello, sending_client=get_client("test")),
+                                    content)
+                    for content in contents]
+        self.assertIn(f'data-user-id="{hamlet.id}"', expected[0])
+
+        with queries_captured() as queries:
+            self.assertEqual(render_markdown_batch(realm, messages), expected)
+        # The data for all of the messages is fetched together.
+        self.assertLessEqual(len(queries), 6)
+
+        mention_data = bugdown.MentionData.for_contents(realm.id, contents)
+        self.assertEqual(mention_data.get_user_by_name('King Hamlet')['id'], hamlet.id)
+        self.assertEqual(render_markdown_batch(realm, []), [])
+
+        with mock.patch('zerver.lib.message.do_render_markdown',
+                        side_effect=BugdownRenderingException):
+            self.assertEqual(render_markdown_batch(realm, messages[:1]), [None])
+
     def test_possible_mentions(self) -> None:
         def assert_mentions(content: str, names: Set[str], has_wildcards: bool=False) -> None:
             self.assertEqual(possible_mentions(content), (names, has_wildcards))
@@ -1,20 +1,35 @@
+import os
+import re
+import tempfile
 import time
+import urllib
 from typing import Any, Callable, Dict, Tuple
 from unittest import mock
 
 import ujson
 from django.http import HttpRequest, HttpResponse
 
+from scripts.lib.sharding import get_user_shard_key_regex
 from zerver.lib.actions import do_change_subscription_property, do_mute_topic
+from zerver.lib.response import PreEncodedJSONDict, json_events_response, json_response
 from zerver.lib.test_classes import ZulipTestCase
 from zerver.lib.test_helpers import POSTRequestMock
-from zerver.models import Recipient, Stream, Subscription, UserProfile, get_stream
+from zerver.models import Recipient, Stream, Subscription, UserProfile, get_realm, get_stream
+from zerver.tornado import event_queue
 from zerver.tornado.event_queue import (
+    EVENT_QUEUE_CHECKPOINT_COMPACT_MIN_RECORDS,
     ClientDescriptor,
     allocate_client_descriptor,
+    checkpoint_event_queues,
+    clear_client_event_queues_for_testing,
+    do_gc_event_queues,
+    dump_event_queues,
     get_client_descriptor,
+    get_users_by_tornado_port,
+    load_event_queues,
     maybe_enqueue_notifications,
     missedmessage_hook,
+    persistent_queue_checkpoint_filename,
     persistent_queue_filename,
 )
 from zerver.tornado.views import cleanup_event_queue, get_events
@@ -494,6 +509,199 @@ class FileReloadLogicTest(ZulipTestCase):
             self.assertEqual(persistent_queue_filename(9993, last=True),
                              "/home/zulip/tornado/event_queues.9993.last.json")
 
+    def allocate_queue(self) -> ClientDescriptor:
+        hamlet = self.example_user('hamlet')
+        return allocate_client_descriptor(dict(
+            all_public_streams=False,
+            apply_markdown=False,
+            client_gravatar=True,
+            client_type_name='website',
+            event_types=None,
+            last_connection_time=time.time(),
+            queue_timeout=0,
+            realm_id=hamlet.realm_id,
+            user_profile_id=hamlet.id,
+        ))
+
+    def test_snapshot_and_checkpoints(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir, self.settings(
+                JSON_PERSISTENT_QUEUE_FILENAME_PATTERN=os.path.join(tmpdir, "event_queues%s.json"),
+                PERSISTENT_QUEUE_SNAPSHOT_FILENAME_PATTERN=os.path.join(tmpdir, "event_queues%s.snapshot"),
+                PERSISTENT_QUEUE_CHECKPOINT_FILENAME_PATTERN=os.path.join(tmpdir, "event_queues%s.checkpoint")):
+            client1 = self.allocate_queue()
+            client1.add_event(dict(type="unknown", value=1))
+            dump_event_queues(9993)
+            self.assertFalse(os.path.exists(persistent_queue_checkpoint_filename(9993)))
+
+            # Only the queues changed since the snapshot are checkpointed.
+            client2 = self.allocate_queue()
+            client2.add_event(dict(type="unknown", value=2))
+            client3 = self.allocate_queue()
+            with self.assertLogs(level='INFO') as logs:
+                checkpoint_event_queues(9993)
+            self.assertEqual(len(logs.output), 1)
+            self.assertIn('Tornado 9993 checkpointed 2 event queues', logs.output[0])
+
+            client1.add_event(dict(type="unknown", value=3))
+            do_gc_event_queues({client3.event_queue.id}, {client3.user_profile_id},
+                               {client3.realm_id})
+            checkpoint_event_queues(9993)
+            expected = {qid: client.to_dict() for (qid, client) in event_queue.clients.items()}
+            self.assertEqual(set(expected), {client1.event_queue.id, client2.event_queue.id})
+
+            # Simulate a crash, and reload from the snapshot plus checkpoints.
+            clear_client_event_queues_for_testing()
+            with self.assertLogs(level='INFO'):
+                load_event_queues(9993)
+            self.assertEqual({qid: client.to_dict() for (qid, client) in event_queue.clients.items()},
+                             expected)
+
+    def test_checkpoint_interval(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir, self.settings(
+                PERSISTENT_QUEUE_SNAPSHOT_FILENAME_PATTERN=os.path.join(tmpdir, "event_queues%s.snapshot"),
+                PERSISTENT_QUEUE_CHECKPOINT_FILENAME_PATTERN=os.path.join(tmpdir, "event_queues%s.checkpoint")):
+            clients = [self.allocate_queue() for i in range(3)]
+            with self.assertLogs(level='INFO'):
+                checkpoint_event_queues(9993)
+
+            # Each (periodic) checkpoint writes every queue that
+            # changed since the last one, so a crash loses at most one
+            # checkpoint interval of changes.
+            for i, client in enumerate(clients):
+                client.add_event(dict(type="unknown", value=i))
+            with self.assertLogs(level='INFO') as logs:
+                checkpoint_event_queues(9993)
+            self.assertIn('Tornado 9993 checkpointed 3 event queues', logs.output[0])
+            self.assertEqual(event_queue.dirty_queue_ids, set())
+            expected = {qid: client.to_dict() for (qid, client) in event_queue.clients.items()}
+
+            clear_client_event_queues_for_testing()
+            with self.assertLogs(level='INFO'):
+                load_event_queues(9993)
+            self.assertEqual({qid: client.to_dict() for (qid, client) in event_queue.clients.items()},
+                             expected)
+
+            # Once the checkpoint file has many more records than there
+            # are live queues, it's compacted into a snapshot.
+            event_queue.checkpoint_record_count = EVENT_QUEUE_CHECKPOINT_COMPACT_MIN_RECORDS + 1
+            event_queue.clients[clients[0].event_queue.id].add_event(dict(type="unknown", value=3))
+            with self.assertLogs(level='INFO') as logs:
+                checkpoint_event_queues(9993)
+            self.assertIn('Tornado 9993 dumped 3 event queues', logs.output[0])
+            self.assertFalse(os.path.exists(persistent_queue_checkpoint_filename(9993)))
+
+    def test_load_legacy_json_queues(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir, self.settings(
+                JSON_PERSISTENT_QUEUE_FILENAME_PATTERN=os.path.join(tmpdir, "event_queues%s.json"),
+                PERSISTENT_QUEUE_SNAPSHOT_FILENAME_PATTERN=os.path.join(tmpdir, "event_queues%s.snapshot"),
+                PERSISTENT_QUEUE_CHECKPOINT_FILENAME_PATTERN=os.path.join(tmpdir, "event_queues%s.checkpoint")):
+            client = self.allocate_queue()
+            client.add_event(dict(type="unknown", value=1))
+            with open(persistent_queue_filename(9993), "w") as f:
+                ujson.dump([(client.event_queue.id, client.to_dict())], f)
+            expected = client.to_dict()
+
+            clear_client_event_queues_for_testing()
+            with self.assertLogs(level='INFO'):
+                load_event_queues(9993)
+            self.assertEqual(event_queue.clients[expected['event_queue']['id']].to_dict(), expected)
+            self.assertTrue(os.path.exists(persistent_queue_filename(9993, last=True)))
+
+            # The migrated queues get written out in the new format.
+            checkpoint_event_queues(9993)
+            clear_client_event_queues_for_testing()
+            with self.assertLogs(level='INFO'):
+                load_event_queues(9993)
+            self.assertEqual(event_queue.clients[expected['event_queue']['id']].to_dict(), expected)
+
+class UserShardingTest(ZulipTestCase):
+    def test_get_users_by_tornado_port(self) -> None:
+        realm = get_realm('zulip')
+        stream_event = dict(type='message', stream_name='Denmark', invite_only=False)
+        private_event = dict(type='message', stream_name='secret', invite_only=True)
+        users = [dict(id=8, flags=[]), dict(id=9, flags=['mentioned']), dict(id=12, flags=[])]
+
+        # Not sharded by user: everything goes to the one port.
+        self.assertEqual(get_users_by_tornado_port(realm, private_event, users),
+                         {9993: users})
+
+        shard_map = {realm.host: [9800, 9801, 9802]}
+        with self.settings(TORNADO_PROCESSES=3, TORNADO_SERVER='http://127.0.0.1:9800'), \
+                mock.patch('zerver.tornado.sharding.shard_map', shard_map):
+            self.assertEqual(get_users_by_tornado_port(realm, private_event, users),
+                             {9800: [users[1], users[2]], 9802: [users[0]]})
+            # Public stream messages go to every shard, for clients
+            # receiving all public streams.
+            self.assertEqual(get_users_by_tornado_port(realm, stream_event, users),
+                             {9800: [users[1], users[2]], 9801: [], 9802: [users[0]]})
+            self.assertEqual(get_users_by_tornado_port(realm, dict(type='typing'), [10, 11]),
+                             {9801: [10], 9802: [11]})
+
+    def test_user_shard_key_regex(self) -> None:
+        regex = re.compile(get_user_shard_key_regex('zulip.example.com', ['9800', '9801']))
+
+        # The webapp passes queue_id in the query string via jQuery's
+        # $.param, which (like urlencode) percent-encodes the colons;
+        # nginx's $arg_queue_id is the raw value.
+        query = urllib.parse.urlencode(dict(queue_id='9801:1594252367:15',
+                                            last_event_id=-1, dont_block='false'))
+        arg_queue_id = dict(param.split('=') for param in query.split('&'))['queue_id']
+        self.assertEqual(arg_queue_id, '9801%3A1594252367%3A15')
+        match = regex.match(f'zulip.example.com/{arg_queue_id}')
+        assert match is not None
+        self.assertEqual(match.group(1), '9801')
+
+        match = regex.match('zulip.example.com/9800:1594252367:15')
+        assert match is not None
+        self.assertEqual(match.group(1), '9800')
+
+        self.assertIsNone(regex.match('zulip.example.com/9802%3A1594252367%3A15'))
+        self.assertIsNone(regex.match('zulipXexample.com/9801%3A1594252367%3A15'))
+        self.assertIsNone(regex.match('zulip.example.com/1594252367%3A15'))
+
+    def test_cleanup_event_queue_sharded(self) -> None:
+        hamlet = self.example_user('hamlet')
+        self.login_user(hamlet)
+        shard_map = {hamlet.realm.host: [9800, 9801, 9802]}
+        response = mock.Mock(content=b'{"result":"success","msg":""}', status_code=200,
+                             headers={'Content-Type': 'application/json'})
+        with self.settings(TORNADO_PROCESSES=3, TORNADO_SERVER='http://127.0.0.1:9800'), \
+                mock.patch('zerver.tornado.sharding.shard_map', shard_map), \
+                mock.patch('zerver.tornado.event_queue.requests_client.post',
+                           return_value=response) as mock_post:
+            # Django passes DELETE requests on to the process holding
+            # the queue, named in the queue ID.
+            result = self.client_delete('/json/events', {'queue_id': '9801:1594252367:15'})
+            self.assert_json_success(result)
+            self.assertEqual(mock_post.call_args[0][0],
+                             'http://127.0.0.1:9801/api/v1/events/internal/cleanup')
+            self.assertEqual(mock_post.call_args[1]['data']['queue_id'], '9801:1594252367:15')
+            self.assertEqual(mock_post.call_args[1]['data']['user_profile_id'], hamlet.id)
+
+            # Without a port in the queue ID, we use the user's process.
+            result = self.client_delete('/json/events', {'queue_id': '1594252367:15'})
+            self.assert_json_success(result)
+            self.assertEqual(mock_post.call_args[0][0],
+                             f'http://127.0.0.1:{9800 + hamlet.id % 3}/api/v1/events/internal/cleanup')
+
+class PreEncodedEventsTest(ZulipTestCase):
+    def test_json_events_response(self) -> None:
+        message = PreEncodedJSONDict({"id": 4, "content": "<p>test</p>", "flags": []})
+        events = [
+            dict(type="message", id=0, message=message, flags=["read"]),
+            dict(type="message", id=1, message=dict(message, invite_only_stream=True), flags=[]),
+            dict(type="heartbeat", id=2),
+        ]
+        data = dict(events=events, queue_id="1:1")
+        response = json_events_response(data=data)
+        self.assertEqual(ujson.loads(response.content),
+                         ujson.loads(json_response(data=data).content))
+        self.assertIn(message.encoded.encode(), response.content)
+
+        response = json_events_response(res_type="error", msg="Bad queue", status=400)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(ujson.loads(response.content), {"result": "error", "msg": "Bad queue"})
+
 class EventQueueTest(ZulipTestCase):
     def get_client_descriptor(self) -> ClientDescriptor:
         hamlet = self.example_user('hamlet')
@@ -661,6 +869,35 @@ class EventQueueTest(ZulipTestCase):
                            "timestamp": "1"}])
         self.verify_to_dict_end_to_end(client)
 
+    def test_prune(self) -> None:
+        client = self.get_client_descriptor()
+        queue = client.event_queue
+        for i in range(10):
+            queue.push({"type": "unknown", "value": i})
+        queue.push({"type": "pointer", "pointer": 1})
+        queue.push({"type": "unknown", "value": 10})
+
+        queue.prune(2)
+        self.assertEqual(queue.newest_pruned_id, 2)
+        self.assertEqual([event['id'] for event in queue.queue], [3, 4, 5, 6, 7, 8, 9, 11])
+        self.verify_to_dict_end_to_end(client)
+
+        # Pruning through an id we've already pruned is a no-op.
+        queue.prune(1)
+        self.assertEqual(queue.newest_pruned_id, 2)
+
+        # Once most of the list has been pruned, it is compacted.
+        queue.prune(7)
+        self.assertEqual(queue.first_index, 0)
+        self.assertEqual(queue.newest_pruned_id, 7)
+        self.assertEqual([event['id'] for event in queue.contents()], [8, 9, 10, 11])
+        self.verify_to_dict_end_to_end(client)
+
+        queue.prune(11)
+        self.assertTrue(queue.empty())
+        self.assertEqual(queue.events, [])
+        self.verify_to_dict_end_to_end(client)
+
     def test_collapse_event(self) -> None:
         client = self.get_client_descriptor()
         queue = client.event_queue
@@ -167,8 +167,10 @@ from zerver.models import (
     get_user_by_delivery_email,
 )
 from zerver.tornado.event_queue import (
+    ClientDescriptor,
     allocate_client_descriptor,
     clear_client_event_queues_for_testing,
+    do_gc_event_queues,
     get_client_info_for_message_event,
     process_message_event,
 )
@@ -3563,6 +3565,50 @@ class ClientDescriptorsTest(ZulipTestCase):
         test_get_info(apply_markdown=False, client_gravatar=True)
         test_get_info(apply_markdown=True, client_gravatar=True)
 
+    def test_get_client_info_for_narrowed_clients(self) -> None:
+        hamlet = self.example_user('hamlet')
+        realm = hamlet.realm
+        clear_client_event_queues_for_testing()
+
+        def allocate_narrowed_client(narrow: List[List[str]]) -> ClientDescriptor:
+            return allocate_client_descriptor(dict(
+                all_public_streams=False,
+                apply_markdown=True,
+                client_gravatar=True,
+                client_type_name='website',
+                event_types=['message'],
+                last_connection_time=time.time(),
+                queue_timeout=0,
+                realm_id=realm.id,
+                user_profile_id=hamlet.id,
+                narrow=narrow,
+            ))
+
+        stream_client = allocate_narrowed_client([['stream', 'Denmark'], ['topic', 'golf']])
+        starred_client = allocate_narrowed_client([['is', 'starred']])
+
+        # Clients narrowed to a stream are only considered for
+        # messages to that stream (in any case).
+        client_info = get_client_info_for_message_event(
+            dict(realm_id=realm.id, stream_name='denmark'),
+            users=[],
+        )
+        self.assertEqual(set(client_info), {stream_client.event_queue.id,
+                                            starred_client.event_queue.id})
+        client_info = get_client_info_for_message_event(
+            dict(realm_id=realm.id, stream_name='Verona'),
+            users=[],
+        )
+        self.assertEqual(set(client_info), {starred_client.event_queue.id})
+
+        # Garbage collection removes them from the index.
+        do_gc_event_queues({stream_client.event_queue.id}, {hamlet.id}, {realm.id})
+        client_info = get_client_info_for_message_event(
+            dict(realm_id=realm.id, stream_name='Denmark'),
+            users=[],
+        )
+        self.assertEqual(set(client_info), {starred_client.event_queue.id})
+
     def test_process_message_event_with_mocked_client_info(self) -> None:
         hamlet = self.example_user("hamlet")
 
@@ -1,9 +1,12 @@
 import os
+import threading
 from typing import Any, Callable, Dict, FrozenSet, List, Optional, Set, Tuple
 from unittest.mock import patch
 
 import ujson
 from django.conf import settings
+from django.core.management import call_command
+from django.db import connection
 from django.db.models import Q
 from django.utils.timezone import now as timezone_now
 
@@ -14,13 +17,25 @@ from zerver.lib.actions import (
     do_change_logo_source,
     do_change_plan_type,
     do_create_user,
+    do_set_zoom_token,
     do_update_user_presence,
 )
 from zerver.lib.avatar_hash import user_avatar_path
 from zerver.lib.bot_config import set_bot_config
 from zerver.lib.bot_lib import StateHandler
-from zerver.lib.export import do_export_realm, do_export_user, export_usermessages_batch
-from zerver.lib.import_realm import do_import_realm, get_incoming_message_ids
+from zerver.lib.export import (
+    MESSAGE_PARTIALS_IN_PROGRESS_FILE,
+    do_export_realm,
+    do_export_user,
+    export_usermessages_batch,
+)
+from zerver.lib.import_realm import (
+    IMPORT_CHECKPOINT_FILENAME,
+    allocate_ids,
+    bulk_import_model,
+    do_import_realm,
+    get_incoming_message_ids,
+)
 from zerver.lib.streams import create_stream_if_needed
 from zerver.lib.test_classes import ZulipTestCase
 from zerver.lib.test_helpers import create_s3_buckets, get_test_image_file, use_s3_backend
@@ -46,6 +61,7 @@ from zerver.models import (
     Realm,
     RealmAuditLog,
     RealmEmoji,
+    RealmFilter,
     Recipient,
     Stream,
     Subscription,
@@ -235,6 +251,9 @@ class ImportExportTest(ZulipTestCase):
 
         result = {}
         result['realm'] = read_file('realm.json')
+        with open(os.path.join(output_dir, 'stats.txt')) as f:
+            result['stats'] = f.read()
+        result['output_files'] = set(os.listdir(output_dir))
         result['attachment'] = read_file('attachment.json')
         result['message'] = read_file('messages-000001.json')
         try:
@@ -439,6 +458,13 @@ class ImportExportTest(ZulipTestCase):
         self.assertEqual(len(data['zerver_userprofile_crossrealm']), 3)
         self.assertEqual(len(data['zerver_userprofile_mirrordummy']), 0)
 
+        # realm.json is written one table at a time; the stats file
+        # uses the counts recorded while writing it.
+        for table, rows in data.items():
+            self.assertIn(f'{len(rows):5} {table}\n', full_data['stats'])
+        self.assertIn('zerver_reaction', data)
+        self.assertNotIn(MESSAGE_PARTIALS_IN_PROGRESS_FILE, full_data['output_files'])
+
         exported_user_emails = self.get_set(data['zerver_userprofile'], 'delivery_email')
         self.assertIn(self.example_email('cordelia'), exported_user_emails)
         self.assertIn('default-bot@zulip.com', exported_user_emails)
@@ -463,6 +489,94 @@ class ImportExportTest(ZulipTestCase):
         self.assertIn(pm_b_msg_id, exported_message_ids)
         self.assertIn(pm_c_msg_id, exported_message_ids)
 
+    def test_export_realm_with_threads(self) -> None:
+        """With threads, uploaded files and analytics tables are exported
+        by a pool of worker threads, and UserMessage rows by processes
+        which pick up each .partial file as it's written.  We run those
+        processes as threads here, so that they use the test database.
+        Like the worker pool's threads, they have their own database
+        connections, so they only see data committed before the test
+        started; that's why this test doesn't change any data."""
+        realm = Realm.objects.get(string_id='zulip')
+        realm_emoji_count = 0
+        for realm_emoji in RealmEmoji.objects.filter(realm=realm):
+            emoji_path = os.path.join(
+                settings.LOCAL_UPLOADS_DIR, 'avatars',
+                RealmEmoji.PATH_ID_TEMPLATE.format(realm_id=realm.id,
+                                                   emoji_file_name=realm_emoji.file_name),
+            )
+            os.makedirs(os.path.dirname(emoji_path), exist_ok=True)
+            with open(emoji_path, 'wb') as f:
+                f.write(b'emoji')
+            realm_emoji_count += 1
+
+        batch_threads: Dict[int, threading.Thread] = {}
+
+        def launch_batch_threads(threads: int, output_dir: str,
+                                 consent_message_id: Optional[int]=None) -> Dict[int, int]:
+            def export_batches(shard_id: int) -> None:
+                try:
+                    call_command('export_usermessage_batch', path=output_dir, thread=str(shard_id))
+                finally:
+                    connection.close()
+
+            pids = {}
+            for shard_id in range(threads):
+                thread = threading.Thread(target=export_batches, args=(shard_id,))
+                thread.start()
+                # A fake PID, which our os.wait returns once the
+                # thread has finished.
+                batch_threads[-1 - shard_id] = thread
+                pids[-1 - shard_id] = shard_id
+            return pids
+
+        def wait() -> Tuple[int, int]:
+            pid, thread = batch_threads.popitem()
+            thread.join()
+            return pid, 0
+
+        def export_realm(output_dir: str) -> None:
+            with patch('logging.info'), patch('builtins.print'), \
+                    patch('zerver.lib.export.create_soft_link'), \
+                    patch('zerver.lib.export.launch_user_message_subprocesses', launch_batch_threads), \
+                    patch('os.wait', wait):
+                do_export_realm(realm=realm, output_dir=output_dir, threads=1)
+
+        output_dir = self._make_output_dir()
+        export_realm(output_dir)
+        self.assertEqual(batch_threads, {})
+
+        output_files = set(os.listdir(output_dir))
+        self.assertIn('analytics.json', output_files)
+        with open(os.path.join(output_dir, 'emoji', 'records.json')) as f:
+            self.assertEqual(len(ujson.load(f)), realm_emoji_count)
+
+        self.assertEqual([fn for fn in output_files if fn.endswith(('.partial', '.locked'))], [])
+        message_ids: Set[int] = set()
+        user_messages = []
+        for fn in output_files:
+            if fn.startswith('messages-'):
+                with open(os.path.join(output_dir, fn)) as f:
+                    data = ujson.load(f)
+                message_ids |= {message['id'] for message in data['zerver_message']}
+                user_messages += data['zerver_usermessage']
+        self.assertTrue(message_ids)
+        self.assertTrue(user_messages)
+        for user_message in user_messages:
+            self.assertIn(user_message['message'], message_ids)
+
+        # If the export fails, we still wait for the worker threads
+        # and the UserMessage processes.
+        output_dir = self._make_output_dir()
+        with patch('zerver.lib.export.export_partial_message_files',
+                   side_effect=Exception('export failed')):
+            with self.assertRaisesRegex(Exception, 'export failed'):
+                export_realm(output_dir)
+        self.assertEqual(batch_threads, {})
+        output_files = set(os.listdir(output_dir))
+        self.assertIn('analytics.json', output_files)
+        self.assertNotIn(MESSAGE_PARTIALS_IN_PROGRESS_FILE, output_files)
+
     def test_export_realm_with_exportable_user_ids(self) -> None:
         realm = Realm.objects.get(string_id='zulip')
 
@@ -703,6 +817,9 @@ class ImportExportTest(ZulipTestCase):
 
         do_update_user_presence(sample_user, get_client("website"), timezone_now(), UserPresence.ACTIVE)
 
+        # JSONField values are encoded differently from other fields.
+        do_set_zoom_token(sample_user, {'access_token': 'token', 'scopes': ['meeting:write']})
+
         # data to test import of botstoragedata and botconfigdata
         bot_profile = do_create_user(
             email="bot-1@zulip.com",
@@ -780,6 +897,10 @@ class ImportExportTest(ZulipTestCase):
             lambda r: get_subscribers(get_recipient_user(r)),
         )
 
+        assert_realm_values(
+            lambda r: UserProfile.objects.get(realm=r, full_name='King Hamlet').zoom_token,
+        )
+
         # test custom profile fields
         def get_custom_profile_field_names(r: Realm) -> Set[str]:
             custom_profile_fields = CustomProfileField.objects.filter(realm=r)
@@ -1127,6 +1248,48 @@ class ImportExportTest(ZulipTestCase):
 
         self.assertEqual(message_ids, [555, 888, 999])
 
+    def test_resume_import(self) -> None:
+        original_realm = get_realm('zulip')
+        self._setup_export_files(original_realm)
+        self._export_realm(original_realm)
+        import_dir = os.path.join(settings.TEST_WORKER_DIR, 'test-export')
+        checkpoint_filename = os.path.join(import_dir, IMPORT_CHECKPOINT_FILENAME)
+
+        with patch('logging.info'):
+            with patch('zerver.lib.import_realm.import_attachments',
+                       side_effect=Exception('Interrupted')):
+                with self.assertRaises(Exception):
+                    do_import_realm(import_dir, 'test-zulip')
+            self.assertTrue(os.path.exists(checkpoint_filename))
+            realm = get_realm('test-zulip')
+            message_count = Message.objects.filter(sender__realm=realm).count()
+            self.assertFalse(Attachment.objects.filter(realm=realm).exists())
+
+            # Resuming skips the completed steps, including the
+            # message files, which would otherwise be duplicated.
+            resumed_realm = do_import_realm(import_dir, 'test-zulip', resume=True)
+        self.assertEqual(resumed_realm.id, realm.id)
+        self.assertEqual(Message.objects.filter(sender__realm=realm).count(), message_count)
+        self.assertEqual(Attachment.objects.filter(realm=realm).count(),
+                         Attachment.objects.filter(realm=original_realm).count())
+        self.assertFalse(os.path.exists(checkpoint_filename))
+
+    def test_bulk_import_model(self) -> None:
+        realm = get_realm('zulip')
+        [filter_id] = allocate_ids(RealmFilter, 1)
+        pattern = '#(?P<id>[0-9]+)\t\\N\\\n\r'
+        data = {'zerver_realmfilter': [dict(
+            id=filter_id,
+            realm_id=realm.id,
+            pattern=pattern,
+            url_format_string='https://trac.example.com/ticket/%(id)s',
+        )]}
+        with patch('logging.info'):
+            bulk_import_model(data, RealmFilter)
+        realm_filter = RealmFilter.objects.get(id=filter_id)
+        self.assertEqual(realm_filter.realm, realm)
+        self.assertEqual(realm_filter.pattern, pattern)
+
     def test_plan_type(self) -> None:
         realm = get_realm('zulip')
         do_change_plan_type(realm, Realm.LIMITED)
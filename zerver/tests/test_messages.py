@@ -2,7 +2,7 @@ import datetime
 import time
 from collections import namedtuple
 from operator import itemgetter
-from typing import Any, Dict, List, Set, Tuple, Union
+from typing import Any, Callable, Dict, List, Set, Tuple, Union
 from unittest import mock
 
 import ujson
@@ -53,6 +53,7 @@ from zerver.lib.create_user import create_user_profile
 from zerver.lib.message import (
     MessageDict,
     bulk_access_messages,
+    encoded_messages_for_ids,
     get_first_visible_message_id,
     get_raw_unread_data,
     get_recent_private_conversations,
@@ -1348,22 +1349,30 @@ class MessageDictTest(ZulipTestCase):
             [True, True],
         ]
 
-        msg_id = test_message_id()
+        hamlet = self.example_user('hamlet')
+        msg_ids = [
+            test_message_id(),
+            self.send_personal_message(hamlet, self.example_user('othello')),
+            self.send_personal_message(hamlet, hamlet),
+            self.send_huddle_message(hamlet, [self.example_user('othello'),
+                                              self.example_user('cordelia')]),
+        ]
 
-        for (apply_markdown, client_gravatar) in flag_setups:
-            send_message_payload = get_send_message_payload(
-                msg_id,
-                apply_markdown=apply_markdown,
-                client_gravatar=client_gravatar,
-            )
+        for msg_id in msg_ids:
+            for (apply_markdown, client_gravatar) in flag_setups:
+                send_message_payload = get_send_message_payload(
+                    msg_id,
+                    apply_markdown=apply_markdown,
+                    client_gravatar=client_gravatar,
+                )
 
-            fetch_payload = get_fetch_payload(
-                msg_id,
-                apply_markdown=apply_markdown,
-                client_gravatar=client_gravatar,
-            )
+                fetch_payload = get_fetch_payload(
+                    msg_id,
+                    apply_markdown=apply_markdown,
+                    client_gravatar=client_gravatar,
+                )
 
-            self.assertEqual(send_message_payload, fetch_payload)
+                self.assertEqual(send_message_payload, fetch_payload)
 
     @slow('builds lots of messages')
     def test_bulk_message_fetching(self) -> None:
@@ -4243,6 +4252,32 @@ class MessageHasKeywordsTest(ZulipTestCase):
         assert_attachment_claimed(dummy_path_ids[2], True)
         assert_attachment_claimed(dummy_path_ids[1], False)
 
+    def test_deferred_claim_attachment(self) -> None:
+        hamlet = self.example_user('hamlet')
+        dummy_path_ids = self.setup_dummy_attachments(hamlet)
+        self.subscribe(hamlet, "Denmark")
+        body = f"Files [zulip.txt](http://zulip.testserver/user_uploads/{dummy_path_ids[0]})"
+
+        # The tests run inside a transaction, which never commits.
+        on_commit_callbacks: List[Callable[[], None]] = []
+        with self.settings(DEFER_MESSAGE_SIDE_EFFECTS=True), \
+                mock.patch('zerver.lib.actions.transaction.on_commit',
+                           side_effect=on_commit_callbacks.append):
+            msg_id = self.send_stream_message(hamlet, "Denmark", body, "test")
+
+        # Only the message and its UserMessage rows have been saved.
+        msg = Message.objects.get(id=msg_id)
+        self.assertFalse(msg.has_attachment)
+        self.assertFalse(Attachment.objects.get(path_id=dummy_path_ids[0]).is_claimed())
+
+        # Once the transaction commits, the deferred_message_work
+        # queue processor claims the attachment.
+        for callback in on_commit_callbacks:
+            callback()
+        msg.refresh_from_db()
+        self.assertTrue(msg.has_attachment)
+        self.assertTrue(Attachment.objects.get(path_id=dummy_path_ids[0]).is_claimed())
+
     def test_finds_all_links(self) -> None:
         msg_ids = []
         msg_contents = ["foo.org", "[bar](baz.gov)", "http://quux.ca"]
@@ -5133,6 +5168,67 @@ class MessageHydrationTest(ZulipTestCase):
         self.assertIn('class="user-mention"', new_message['content'])
         self.assertEqual(new_message['flags'], ['mentioned'])
 
+    def test_encoded_messages_for_ids(self) -> None:
+        hamlet = self.example_user('hamlet')
+        cordelia = self.example_user('cordelia')
+        othello = self.example_user('othello')
+        message_ids = [
+            self.send_stream_message(cordelia, 'Verona', content='**stream** @**King Hamlet**'),
+            self.send_personal_message(cordelia, hamlet, content='*private*'),
+            self.send_personal_message(hamlet, hamlet, content='self'),
+            self.send_huddle_message(othello, [hamlet, cordelia], content='huddle'),
+        ]
+        user_message_flags = {message_id: ['read'] for message_id in message_ids}
+        search_fields = {message_ids[0]: {'match_content': 'stream', 'match_subject': 'test'}}
+
+        def assert_encoded_messages_equal() -> None:
+            for apply_markdown in [True, False]:
+                for client_gravatar in [True, False]:
+                    for allow_edit_history in [True, False]:
+                        kwargs = dict(
+                            message_ids=message_ids,
+                            user_message_flags=user_message_flags,
+                            search_fields=search_fields,
+                            apply_markdown=apply_markdown,
+                            client_gravatar=client_gravatar,
+                            allow_edit_history=allow_edit_history,
+                        )
+                        encoded_messages = encoded_messages_for_ids(**kwargs)
+                        self.assertEqual([ujson.loads(encoded) for encoded in encoded_messages],
+                                         messages_for_ids(**kwargs))
+
+        assert_encoded_messages_equal()
+
+        # With the fragments cached, we don't need to fetch the messages.
+        with queries_captured() as queries:
+            encoded_messages_for_ids(message_ids, user_message_flags, {},
+                                     apply_markdown=True, client_gravatar=False,
+                                     allow_edit_history=True)
+        self.assertFalse(any('"zerver_message"' in query['sql'] for query in queries))
+
+        # Edits and reactions invalidate the cached fragments.
+        self.login_user(cordelia)
+        result = self.client_patch("/json/messages/" + str(message_ids[0]), {
+            'message_id': message_ids[0],
+            'content': 'edited',
+        })
+        self.assert_json_success(result)
+        result = self.api_post(hamlet, f'/api/v1/messages/{message_ids[1]}/reactions',
+                               {'emoji_name': 'smile'})
+        self.assert_json_success(result)
+        assert_encoded_messages_equal()
+        self.assertIn('edited', ujson.loads(encoded_messages_for_ids(
+            message_ids, user_message_flags, {}, apply_markdown=True,
+            client_gravatar=False, allow_edit_history=True)[0])['content'])
+
+        # The response from GET /json/messages is the same either way.
+        self.login_user(hamlet)
+        params = dict(anchor='newest', num_before=10, num_after=0)
+        with override_settings(MESSAGE_FRAGMENT_CACHE=True):
+            result = self.client_get('/json/messages', params)
+        self.assertEqual(self.assert_json_success(result), self.assert_json_success(
+            self.client_get('/json/messages', params)))
+
     def test_display_recipient_up_to_date(self) -> None:
         """
         This is a test for a bug where due to caching of message_dicts,
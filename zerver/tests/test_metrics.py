@@ -0,0 +1,59 @@
+import requests
+
+from zerver.lib.metrics import Counter, Gauge, Histogram, MetricsRegistry, start_metrics_server
+from zerver.lib.test_classes import ZulipTestCase
+from zerver.worker.queue_processors import events_processed
+
+
+class MetricsTest(ZulipTestCase):
+    def test_render(self) -> None:
+        registry = MetricsRegistry()
+        counter = Counter('test_events_total', "Events.", ['queue'])
+        gauge = Gauge('test_size', "Size.")
+        histogram = Histogram('test_seconds', "Time.", ['queue'], buckets=(0.1, 1))
+        for metric in [counter, gauge, histogram]:
+            registry.register(metric)
+        with self.assertRaises(ValueError):
+            registry.register(Counter('test_size', "Duplicate."))
+
+        counter.inc('a')
+        counter.inc('a', amount=2)
+        counter.inc('b"\\')
+        gauge.set(value=7)
+        histogram.observe('a', value=0.05)
+        histogram.observe('a', value=0.5)
+        histogram.observe('a', value=5)
+        with self.assertRaises(ValueError):
+            counter.inc()
+
+        self.assertEqual(counter.get('a'), 3)
+        self.assertEqual(histogram.get_count('a'), 3)
+        self.assertEqual(registry.render(), '''\
+# HELP test_events_total Events.
+# TYPE test_events_total counter
+test_events_total{queue="a"} 3.0
+test_events_total{queue="b\\"\\\\"} 1.0
+# HELP test_seconds Time.
+# TYPE test_seconds histogram
+test_seconds_bucket{queue="a",le="0.1"} 1.0
+test_seconds_bucket{queue="a",le="1.0"} 2.0
+test_seconds_bucket{queue="a",le="+Inf"} 3.0
+test_seconds_sum{queue="a"} 5.55
+test_seconds_count{queue="a"} 3.0
+# HELP test_size Size.
+# TYPE test_size gauge
+test_size 7.0
+''')
+
+    def test_metrics_server(self) -> None:
+        server = start_metrics_server(0)
+        assert server is not None
+        try:
+            url = f'http://127.0.0.1:{server.server_address[1]}'
+            result = requests.get(url + '/metrics')
+            self.assertEqual(result.status_code, 200)
+            self.assertIn(f'# TYPE {events_processed.name} counter', result.text)
+            self.assertEqual(requests.get(url + '/other').status_code, 404)
+        finally:
+            server.shutdown()
+            server.server_close()
@@ -10,7 +10,7 @@ from sqlalchemy.sql.elements import ClauseElement
 
 from zerver.lib.actions import do_deactivate_user, do_set_realm_property
 from zerver.lib.message import MessageDict
-from zerver.lib.narrow import build_narrow_filter, is_web_public_compatible
+from zerver.lib.narrow import build_narrow_filter, get_narrow_stream_name, is_web_public_compatible
 from zerver.lib.request import JsonableError
 from zerver.lib.sqlalchemy_utils import get_sqlalchemy_connection
 from zerver.lib.streams import create_streams_if_needed
@@ -457,6 +457,19 @@ class NarrowLibraryTest(TestCase):
             for e in reject_events:
                 self.assertFalse(narrow_filter(e))
 
+    def test_build_narrow_filter_contradictory(self) -> None:
+        event = dict(
+            message=dict(type='stream', display_recipient='Denmark', subject='golf',
+                         sender_email='hamlet@zulip.com'),
+            flags=[],
+        )
+        self.assertTrue(build_narrow_filter([['stream', 'denmark'], ['stream', 'DENMARK']])(event))
+        self.assertFalse(build_narrow_filter([['stream', 'Denmark'], ['stream', 'Verona']])(event))
+        self.assertFalse(build_narrow_filter([['stream', 'Denmark'], ['is', 'private']])(event))
+        self.assertEqual(get_narrow_stream_name([['topic', 'golf'], ['stream', 'Denmark']]),
+                         'denmark')
+        self.assertIsNone(get_narrow_stream_name([['is', 'private']]))
+
     def test_build_narrow_filter_invalid(self) -> None:
         with self.assertRaises(JsonableError):
             build_narrow_filter(["invalid_operator", "operand"])
@@ -2251,6 +2264,136 @@ class GetOldMessagesTest(ZulipTestCase):
             self.assert_json_error(result,
                                    f"Missing '{required_args[i][0]}' argument")
 
+    def test_get_messages_with_cursor(self) -> None:
+        self.login('hamlet')
+        othello = self.example_user('othello')
+        message_ids = [self.send_stream_message(othello, "Verona", f"message {i}",
+                                                topic_name="cursor")
+                       for i in range(6)]
+        narrow = [dict(operator='stream', operand='Verona'),
+                  dict(operator='topic', operand='cursor')]
+
+        result = self.get_and_check_messages(dict(narrow=ujson.dumps(narrow), anchor="newest",
+                                                  num_before=2, num_after=0,
+                                                  use_cursor=ujson.dumps(True)))
+        self.assertEqual([message['id'] for message in result['messages']], message_ids[-2:])
+        self.assertFalse(result['found_oldest'])
+
+        # Fetch older messages, seeking from the oldest one fetched.
+        with queries_captured() as queries:
+            result = self.get_and_check_messages(dict(cursor=result['cursor'],
+                                                      num_before=3, num_after=0))
+        self.assertEqual([message['id'] for message in result['messages']], message_ids[1:4])
+        self.assertFalse(result['found_oldest'])
+        self.assertNotIn('anchor', result)
+        # Just one query, seeking by message ID, finds the messages.
+        self.assertEqual(len([query for query in queries
+                              if '/* get_messages */' in query['sql']]), 1)
+
+        result = self.get_and_check_messages(dict(cursor=result['cursor'],
+                                                  num_before=3, num_after=0))
+        self.assertEqual([message['id'] for message in result['messages']], message_ids[:1])
+        self.assertTrue(result['found_oldest'])
+
+        # And newer messages, seeking from the newest one fetched.
+        new_message_id = self.send_stream_message(othello, "Verona", "new", topic_name="cursor")
+        result = self.get_and_check_messages(dict(cursor=result['cursor'],
+                                                  num_before=0, num_after=5))
+        self.assertEqual([message['id'] for message in result['messages']], [new_message_id])
+        self.assertTrue(result['found_newest'])
+        cursor = result['cursor']
+
+        for bad_cursor in ['bad', 'x.1.2', '0' * 32 + '.a.b']:
+            result = self.client_get("/json/messages", dict(cursor=bad_cursor,
+                                                            num_before=1, num_after=0))
+            self.assert_json_error(result, "Invalid cursor")
+        result = self.client_get("/json/messages", dict(cursor='0' * 32 + '.1.2',
+                                                        num_before=1, num_after=0))
+        self.assert_json_error(result, "Invalid or expired cursor")
+
+        # Cursors can't be used by other users.
+        self.login('cordelia')
+        result = self.client_get("/json/messages", dict(cursor=cursor, num_before=1, num_after=0))
+        self.assert_json_error(result, "Invalid or expired cursor")
+
+    @override_settings(NARROW_RESULT_CACHE=True)
+    def test_get_messages_narrow_result_cache(self) -> None:
+        self.login('hamlet')
+        othello = self.example_user('othello')
+        message_ids = [self.send_stream_message(othello, "Verona", f"message {i}",
+                                                topic_name="cached")
+                       for i in range(4)]
+
+        def get_message_ids(narrow: List[Dict[str, Any]], **kwargs: Any) -> Tuple[List[int], int]:
+            """Returns the IDs of the messages fetched, and the number
+            of narrow queries needed to fetch them."""
+            params = dict(narrow=ujson.dumps(narrow), **kwargs)
+            with queries_captured() as queries:
+                result = self.get_and_check_messages(params)
+            with override_settings(NARROW_RESULT_CACHE=False):
+                uncached_result = self.get_and_check_messages(params)
+            for key in ['messages', 'found_anchor', 'found_oldest', 'found_newest',
+                        'history_limited', 'anchor']:
+                self.assertEqual(result[key], uncached_result[key])
+            query_count = len([query for query in queries if '/* get_messages */' in query['sql']])
+            return [message['id'] for message in result['messages']], query_count
+
+        # Narrows including the stream's history.
+        narrow = [dict(operator='stream', operand='Verona'),
+                  dict(operator='topic', operand='cached')]
+        self.assertEqual(get_message_ids(narrow, anchor='newest', num_before=3, num_after=0),
+                         (message_ids[-3:], 1))
+
+        # Checking for newer messages doesn't need a query.
+        self.assertEqual(get_message_ids(narrow, anchor=message_ids[-1], num_before=0, num_after=5),
+                         (message_ids[-1:], 0))
+        self.assertEqual(get_message_ids(narrow, anchor=message_ids[1], num_before=1, num_after=1),
+                         (message_ids[:3], 0))
+
+        # Until there's a new message in the stream.
+        new_message_id = self.send_stream_message(othello, "Verona", "new", topic_name="cached")
+        self.assertEqual(get_message_ids(narrow, anchor=message_ids[-1], num_before=0, num_after=5),
+                         ([message_ids[-1], new_message_id], 1))
+        message_ids.append(new_message_id)
+
+        # Messages to other streams, or private messages, don't
+        # invalidate the stream's narrows.
+        self.send_stream_message(othello, "Denmark", "elsewhere")
+        self.send_personal_message(othello, self.example_user('hamlet'), "private")
+        self.assertEqual(get_message_ids(narrow, anchor=message_ids[-1], num_before=0, num_after=5),
+                         (message_ids[-1:], 0))
+
+        # Changes to the user's flags do.
+        result = self.client_post("/json/messages/flags",
+                                  {"messages": ujson.dumps(message_ids[:2]),
+                                   "op": "add",
+                                   "flag": "starred"})
+        self.assert_json_success(result)
+        self.assertEqual(get_message_ids(narrow, anchor=message_ids[-1], num_before=0, num_after=5),
+                         (message_ids[-1:], 1))
+
+        # Private message narrows.
+        narrow = [dict(operator='pm-with', operand=othello.email)]
+        private_message_ids = get_message_ids(narrow, anchor='newest', num_before=5, num_after=0)[0]
+        self.assertEqual(get_message_ids(narrow, anchor='newest', num_before=5, num_after=0),
+                         (private_message_ids, 0))
+        new_message_id = self.send_personal_message(othello, self.example_user('hamlet'), "new")
+        self.assertEqual(get_message_ids(narrow, anchor='newest', num_before=5, num_after=0),
+                         ((private_message_ids + [new_message_id])[-5:], 1))
+
+        # Narrows which aren't limited to a stream or to private
+        # messages aren't cached.
+        narrow = [dict(operator='is', operand='starred')]
+        self.assertEqual(get_message_ids(narrow, anchor='newest', num_before=5, num_after=0),
+                         (message_ids[:2], 1))
+        self.assertEqual(get_message_ids(narrow, anchor='newest', num_before=5, num_after=0),
+                         (message_ids[:2], 1))
+
+        # Searches aren't cached.
+        narrow = [dict(operator='search', operand='new')]
+        get_message_ids(narrow, anchor='newest', num_before=5, num_after=0)
+        self.assertEqual(get_message_ids(narrow, anchor='newest', num_before=5, num_after=0)[1], 1)
+
     def test_get_messages_limits(self) -> None:
         """
         A call to GET /json/messages requesting more than
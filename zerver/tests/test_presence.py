@@ -3,9 +3,10 @@ from datetime import timedelta
 from typing import Any, Dict
 from unittest import mock
 
+import ujson
 from django.utils.timezone import now as timezone_now
 
-from zerver.lib.actions import do_deactivate_user
+from zerver.lib.actions import do_deactivate_user, do_update_user_presences
 from zerver.lib.presence import get_status_dict_by_realm
 from zerver.lib.statistics import seconds_usage_between
 from zerver.lib.test_classes import ZulipTestCase
@@ -13,12 +14,14 @@ from zerver.lib.test_helpers import make_client, queries_captured, reset_emails_
 from zerver.lib.timestamp import datetime_to_timestamp
 from zerver.models import (
     Client,
+    PresenceSequence,
     PushDeviceToken,
     UserActivity,
     UserActivityInterval,
     UserPresence,
     UserProfile,
     flush_per_request_caches,
+    get_client,
 )
 
 
@@ -395,6 +398,40 @@ class UserPresenceTests(ZulipTestCase):
             {hamlet.email},
         )
 
+    def test_batched_updates(self) -> None:
+        hamlet = self.example_user('hamlet')
+        othello = self.example_user('othello')
+        website = get_client('website')
+        android = get_client('ZulipAndroid')
+        now = timezone_now()
+
+        with queries_captured() as queries:
+            do_update_user_presences([
+                (hamlet, website, now - timedelta(seconds=30), UserPresence.IDLE),
+                (hamlet, android, now - timedelta(seconds=20), UserPresence.ACTIVE),
+                (hamlet, website, now, UserPresence.ACTIVE),
+                (othello, get_client('ZulipDesktop'), now, UserPresence.IDLE),
+            ])
+        # The rows are fetched, and then written, with one query each.
+        self.assert_length([query for query in queries if 'zerver_userpresence' in query['sql']], 2)
+
+        rows = UserPresence.objects.filter(user_profile__in=[hamlet, othello]).order_by('last_update_id')
+        self.assertEqual(
+            [(row.user_profile_id, row.client.name, row.status, row.timestamp) for row in rows],
+            [(hamlet.id, 'website', UserPresence.ACTIVE, now),
+             (hamlet.id, 'ZulipAndroid', UserPresence.ACTIVE, now - timedelta(seconds=20)),
+             (othello.id, 'website', UserPresence.IDLE, now)],
+        )
+        sequence = PresenceSequence.objects.get(realm=hamlet.realm)
+        self.assertEqual([row.last_update_id for row in rows],
+                         list(range(sequence.last_update_id - 2, sequence.last_update_id + 1)))
+
+        # Updates to existing rows bump their last_update_id.
+        do_update_user_presences([(othello, website, now, UserPresence.ACTIVE)])
+        othello_row = UserPresence.objects.get(user_profile=othello)
+        self.assertEqual(othello_row.status, UserPresence.ACTIVE)
+        self.assertEqual(othello_row.last_update_id, sequence.last_update_id + 1)
+
 class SingleUserPresenceTests(ZulipTestCase):
     def test_email_access(self) -> None:
         user = self.example_user('hamlet')
@@ -599,6 +636,39 @@ class GetRealmStatusesTest(ZulipTestCase):
         json = result.json()
         self.assertEqual(set(json['presences'].keys()), {hamlet.email, othello.email})
 
+    def test_presence_delta(self) -> None:
+        othello = self.example_user("othello")
+        hamlet = self.example_user("hamlet")
+
+        self.api_post(othello, "/api/v1/users/me/presence", dict(status='active'),
+                      HTTP_USER_AGENT="ZulipDesktop/1.0")
+        result = self.api_post(hamlet, "/api/v1/users/me/presence",
+                               dict(status='active', slim_presence='true'),
+                               HTTP_USER_AGENT="ZulipDesktop/1.0")
+        self.assert_json_success(result)
+        json = result.json()
+        self.assertEqual(set(json['presences'].keys()), {str(hamlet.id), str(othello.id)})
+        last_update_id = json['presence_last_update_id']
+
+        result = self.api_post(hamlet, "/api/v1/users/me/presence",
+                               dict(status='active', slim_presence='true',
+                                    last_update_id=ujson.dumps(last_update_id)))
+        json = result.json()
+        # Only Hamlet's own ping has changed anything.
+        self.assertEqual(set(json['presences'].keys()), {str(hamlet.id)})
+        self.assertGreater(json['presence_last_update_id'], last_update_id)
+
+        # A user whose data changed is returned with all their clients.
+        last_update_id = json['presence_last_update_id']
+        self.api_post(othello, "/api/v1/users/me/presence", dict(status='idle'),
+                      HTTP_USER_AGENT="ZulipAndroid/1.0")
+        result = self.api_post(hamlet, "/api/v1/users/me/presence",
+                               dict(status='active', last_update_id=ujson.dumps(last_update_id)))
+        json = result.json()
+        self.assertEqual(set(json['presences'].keys()), {hamlet.email, othello.email})
+        self.assertEqual(set(json['presences'][othello.email].keys()),
+                         {'aggregated', 'website', 'ZulipAndroid'})
+
     def test_presence_disabled(self) -> None:
         # Disable presence status and test whether the presence
         # is reported or not.
@@ -4,7 +4,12 @@ from unittest import mock
 from django.test import override_settings
 from pika.exceptions import AMQPConnectionError, ConnectionClosed
 
-from zerver.lib.queue import TornadoQueueClient, get_queue_client, queue_json_publish
+from zerver.lib.queue import (
+    TornadoQueueClient,
+    get_queue_client,
+    queue_json_publish,
+    queue_publish_batch,
+)
 from zerver.lib.test_classes import ZulipTestCase
 
 
@@ -36,6 +41,30 @@ class TestQueueImplementation(ZulipTestCase):
         self.assertEqual(len(result), 1)
         self.assertEqual(result[0]['event'], 'my_event')
 
+    @override_settings(USING_RABBITMQ=True)
+    def test_queue_publish_batch(self) -> None:
+        queue_client = get_queue_client()
+        with mock.patch.object(queue_client, 'publish_batch',
+                               wraps=queue_client.publish_batch) as mock_publish_batch:
+            with queue_publish_batch():
+                queue_json_publish("test_suite", {"event": "event1"})
+                with queue_publish_batch():
+                    queue_json_publish("test_suite", {"event": "event2"})
+                self.assertEqual(queue_client.json_drain_queue("test_suite"), [])
+                queue_json_publish("test_suite", {"event": "event3"})
+            mock_publish_batch.assert_called_once()
+
+        result = queue_client.json_drain_queue("test_suite")
+        self.assertEqual([event['event'] for event in result], ["event1", "event2", "event3"])
+
+        # Events are still published if the block raises an exception.
+        with self.assertRaises(ValueError):
+            with queue_publish_batch():
+                queue_json_publish("test_suite", {"event": "event4"})
+                raise ValueError()
+        result = queue_client.json_drain_queue("test_suite")
+        self.assertEqual([event['event'] for event in result], ["event4"])
+
     @override_settings(USING_RABBITMQ=True)
     def test_register_consumer(self) -> None:
         output = []
@@ -1,4 +1,5 @@
 import base64
+import datetime
 import os
 import smtplib
 import time
@@ -16,8 +17,16 @@ from zerver.lib.rate_limiter import RateLimiterLockingException
 from zerver.lib.remote_server import PushNotificationBouncerRetryLaterError
 from zerver.lib.send_email import FromAddress
 from zerver.lib.test_classes import ZulipTestCase
-from zerver.lib.test_helpers import simulated_queue_client
-from zerver.models import PreregistrationUser, UserActivity, get_client, get_realm, get_stream
+from zerver.lib.test_helpers import queries_captured, simulated_queue_client
+from zerver.lib.timestamp import timestamp_to_datetime
+from zerver.models import (
+    PreregistrationUser,
+    UserActivity,
+    UserActivityInterval,
+    get_client,
+    get_realm,
+    get_stream,
+)
 from zerver.tornado.event_queue import build_offline_notification
 from zerver.worker import queue_processors
 from zerver.worker.queue_processors import (
@@ -58,6 +67,17 @@ class WorkerTest(ZulipTestCase):
                 callback(data)
             self.queue = []
 
+        def start_json_batch_consumer(self,
+                                      queue_name: str,
+                                      callback: Callable[[List[Dict[str, Any]]], None],
+                                      batch_size: int,
+                                      max_latency: float,
+                                      prefetch_count: int) -> None:
+            while self.queue:
+                batch = [data for _, data in self.queue[:batch_size]]
+                self.queue = self.queue[batch_size:]
+                callback(batch)
+
         def json_drain_queue(self, queue_name: str) -> List[Event]:
             events = [
                 dct
@@ -138,6 +158,53 @@ class WorkerTest(ZulipTestCase):
                 self.assertEqual(len(activity_records), 1)
                 self.assertEqual(activity_records[0].count, 3)
 
+    def test_UserActivityIntervalWorker(self) -> None:
+        hamlet = self.example_user('hamlet')
+        othello = self.example_user('othello')
+        UserActivityInterval.objects.filter(user_profile__in=[hamlet, othello]).delete()
+        start = int(time.time())
+        events = [
+            dict(user_profile_id=hamlet.id, time=start),
+            dict(user_profile_id=othello.id, time=start),
+            dict(user_profile_id=hamlet.id, time=start + 600),
+            dict(user_profile_id=hamlet.id, time=start + 3600),
+        ]
+        worker = queue_processors.UserActivityIntervalWorker()
+        with queries_captured() as queries:
+            worker.consume_batch(events)
+        # One query to fetch the latest intervals, and one to create
+        # the new ones.
+        self.assert_length(queries, 2)
+
+        def get_intervals() -> List[Tuple[int, datetime.datetime, datetime.datetime]]:
+            return list(UserActivityInterval.objects.filter(
+                user_profile__in=[hamlet, othello],
+            ).order_by('user_profile_id', 'start').values_list('user_profile_id', 'start', 'end'))
+
+        length = UserActivityInterval.MIN_INTERVAL_LENGTH
+        self.assertEqual(get_intervals(), sorted([
+            (hamlet.id, timestamp_to_datetime(start), timestamp_to_datetime(start + 600) + length),
+            (hamlet.id, timestamp_to_datetime(start + 3600), timestamp_to_datetime(start + 3600) + length),
+            (othello.id, timestamp_to_datetime(start), timestamp_to_datetime(start) + length),
+        ]))
+
+        # Activity overlapping the latest interval extends it.
+        with queries_captured() as queries:
+            worker.consume_batch([dict(user_profile_id=hamlet.id, time=start + 3700)])
+        self.assert_length(queries, 2)
+        self.assertEqual(get_intervals()[1],
+                         (hamlet.id, timestamp_to_datetime(start + 3600),
+                          timestamp_to_datetime(start + 3700) + length))
+
+        # If the bulk write fails, we process the events one at a time,
+        # so that only those which fail on their own are set aside.
+        with patch('zerver.worker.queue_processors.do_update_user_activity_intervals',
+                   side_effect=Exception('bulk write failed')), \
+                patch('zerver.worker.queue_processors.do_update_user_activity_interval') as mock_single, \
+                self.assertLogs('zerver.worker.queue_processors', level='WARNING'):
+            worker.consume_batch(events[:2])
+        self.assertEqual(mock_single.call_count, 2)
+
     def test_missed_message_worker(self) -> None:
         cordelia = self.example_user('cordelia')
         hamlet = self.example_user('hamlet')
@@ -301,6 +368,63 @@ class WorkerTest(ZulipTestCase):
                     self.assertEqual(mock_handle_new.call_count, 1 + MAX_REQUEST_RETRIES)
                     self.assertEqual(mock_handle_remove.call_count, 1 + MAX_REQUEST_RETRIES)
 
+    def test_push_notifications_worker_merges_removals(self) -> None:
+        fake_client = self.FakeClient()
+        hamlet = self.example_user('hamlet')
+        cordelia = self.example_user('cordelia')
+
+        def remove_event(user_profile_id: int, message_ids: List[int]) -> Dict[str, Any]:
+            return {
+                "type": "remove",
+                "user_profile_id": user_profile_id,
+                "message_ids": message_ids,
+            }
+
+        for event in [remove_event(hamlet.id, [1]),
+                      remove_event(hamlet.id, [2, 3]),
+                      remove_event(cordelia.id, [4, 5]),
+                      remove_event(hamlet.id, [3, 6]),
+                      build_offline_notification(hamlet.id, 7)]:
+            fake_client.queue.append(('missedmessage_mobile_notifications', event))
+
+        with simulated_queue_client(lambda: fake_client):
+            worker = queue_processors.PushNotificationsWorker()
+            worker.setup()
+            with patch('zerver.worker.queue_processors.handle_push_notification') as mock_handle_new, \
+                    patch('zerver.worker.queue_processors.handle_remove_push_notification') as mock_handle_remove, \
+                    patch('zerver.worker.queue_processors.initialize_push_notifications'):
+                worker.start()
+
+        mock_handle_new.assert_called_once()
+        # The single-message removal is sent on its own; the others
+        # are merged per user.
+        self.assertEqual(
+            [call[0] for call in mock_handle_remove.call_args_list],
+            [(hamlet.id, [1]), (hamlet.id, [2, 3, 6]), (cordelia.id, [4, 5])],
+        )
+
+    def test_email_sending_worker_batch(self) -> None:
+        fake_client = self.FakeClient()
+        for user in [self.example_user('hamlet'), self.example_user('cordelia')]:
+            fake_client.queue.append(('email_senders', {
+                'template_prefix': 'zerver/emails/confirm_new_email',
+                'to_user_ids': [user.id],
+                'from_name': 'Zulip Account Security',
+                'from_address': FromAddress.NOREPLY,
+                'context': {},
+            }))
+
+        with simulated_queue_client(lambda: fake_client):
+            worker = queue_processors.EmailSendingWorker()
+            worker.setup()
+            with patch('zerver.worker.queue_processors.send_email_from_dict') as mock_send:
+                worker.start()
+
+        self.assertEqual(mock_send.call_count, 2)
+        connections = {call[1]['connection'] for call in mock_send.call_args_list}
+        self.assertEqual(len(connections), 1)
+        self.assertIsNone(worker.connection)
+
     @patch('zerver.worker.queue_processors.mirror_email')
     def test_mirror_worker(self, mock_mirror_email: MagicMock) -> None:
         fake_client = self.FakeClient()
@@ -552,6 +676,10 @@ class WorkerTest(ZulipTestCase):
                 )
 
         self.assertEqual(processed, ['good', 'fine', 'back to normal'])
+        self.assertEqual(queue_processors.events_processed.get('unreliable_worker'), 3)
+        self.assertEqual(queue_processors.consume_errors.get('unreliable_worker'), 1)
+        self.assertEqual(queue_processors.event_seconds.get_count('unreliable_worker', 'good'), 1)
+        self.assertEqual(queue_processors.consume_seconds.get_count('unreliable_worker'), 3)
         with open(fn) as f:
             line = f.readline().strip()
         events = ujson.loads(line.split('\t')[1])
@@ -559,6 +687,37 @@ class WorkerTest(ZulipTestCase):
         event = events[0]
         self.assertEqual(event["type"], 'unexpected behaviour')
 
+        # In batch mode, only the failing event of a batch is set aside.
+        processed = []
+
+        @queue_processors.assign_queue('unreliable_batch_worker')
+        class UnreliableBatchWorker(UnreliableWorker):
+            batch_size = 10
+
+        for msg in ['good', 'fine', 'unexpected behaviour', 'back to normal']:
+            fake_client.queue.append(('unreliable_batch_worker', {'type': msg}))
+
+        fn = os.path.join(settings.QUEUE_ERROR_DIR, 'unreliable_batch_worker.errors')
+        try:
+            os.remove(fn)
+        except OSError:  # nocoverage # error handling for the directory not existing
+            pass
+
+        with simulated_queue_client(lambda: fake_client):
+            batch_worker = UnreliableBatchWorker()
+            batch_worker.setup()
+            with patch('logging.exception') as logging_exception_mock:
+                batch_worker.start()
+                logging_exception_mock.assert_called_once_with(
+                    "Problem handling data on queue %s", "unreliable_batch_worker",
+                )
+
+        self.assertEqual(processed, ['good', 'fine', 'back to normal'])
+        with open(fn) as f:
+            line = f.readline().strip()
+        events = ujson.loads(line.split('\t')[1])
+        self.assertEqual(events, [{'type': 'unexpected behaviour'}])
+
         processed = []
 
         @queue_processors.assign_queue('unreliable_loopworker')
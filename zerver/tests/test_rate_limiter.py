@@ -7,6 +7,7 @@ from zerver.lib.rate_limiter import (
     RateLimitedUser,
     RateLimiterBackend,
     RedisRateLimiterBackend,
+    RedisTokenBucketRateLimiterBackend,
     TornadoInMemoryRateLimiterBackend,
     add_ratelimit_rule,
     remove_ratelimit_rule,
@@ -200,6 +201,60 @@ class TornadoInMemoryRateLimiterBackendTest(RateLimiterBackendBase):
         with mock.patch('time.time', return_value=(start_time + 1.01)):
             self.make_request(obj, expect_ratelimited=False, verify_api_calls_left=False)
 
+class RedisTokenBucketRateLimiterBackendTest(RateLimiterBackendBase):
+    __unittest_skip__ = False
+    backend = RedisTokenBucketRateLimiterBackend
+
+    def api_calls_left_from_history(self, history: List[float], max_window: int,
+                                    max_calls: int, now: float) -> Tuple[int, float]:
+        # The same algorithm as TornadoInMemoryRateLimiterBackend.
+        reset_time = 0.0
+        for timestamp in history:
+            reset_time = max(reset_time, timestamp) + (max_window / max_calls)
+
+        calls_left = (now + max_window - reset_time) * max_calls // max_window
+        calls_left = int(calls_left)
+
+        return calls_left, reset_time - now
+
+    def test_block_access(self) -> None:
+        obj = self.create_object('test', [(2, 5)])
+
+        obj.block_access(1)
+        self.make_request(obj, expect_ratelimited=True, verify_api_calls_left=False)
+
+    def test_lease(self) -> None:
+        obj = self.create_object('test', [(2, 5)])
+        start_time = time.time()
+        take_tokens = mock.patch.object(self.backend, 'take_tokens',
+                                        wraps=self.backend.take_tokens)
+
+        with self.settings(RATE_LIMITING_LEASE_SIZE=3), take_tokens as mock_take_tokens:
+            # The first request takes three tokens from Redis, and the
+            # next two use the rest of the lease.
+            for i in range(3):
+                with mock.patch('time.time', return_value=(start_time + i * 0.01)):
+                    self.assertEqual(obj.rate_limit(), (False, 0.0))
+            self.assertEqual(mock_take_tokens.call_count, 1)
+
+            # Only two tokens are left in Redis.
+            with mock.patch('time.time', return_value=(start_time + 0.03)):
+                self.assertEqual(obj.rate_limit(), (False, 0.0))
+                self.assertEqual(obj.api_calls_left()[0], 1)
+                self.assertEqual(obj.rate_limit(), (False, 0.0))
+                ratelimited, secs_to_freedom = obj.rate_limit()
+            self.assertTrue(ratelimited)
+            self.assertGreater(secs_to_freedom, 0)
+            self.assertEqual(mock_take_tokens.call_count, 3)
+
+        # Without a lease, each request checks Redis.
+        obj.clear_history()
+        with mock.patch('time.time', return_value=start_time), take_tokens as mock_take_tokens:
+            obj.rate_limit()
+            obj.rate_limit()
+            self.assertEqual(mock_take_tokens.call_count, 2)
+            self.assertEqual(obj.api_calls_left()[0], 3)
+
 class RateLimitedObjectsTest(ZulipTestCase):
     def test_user_rate_limits(self) -> None:
         user_profile = self.example_user("hamlet")
@@ -222,6 +277,13 @@ class RateLimitedObjectsTest(ZulipTestCase):
         remove_ratelimit_rule(10, 100, domain='some_new_domain')
         self.assertEqual(obj.get_rules(), [(4, 5)])
 
+    def test_default_backend(self) -> None:
+        user_profile = self.example_user("hamlet")
+        self.assertEqual(RateLimitedUser(user_profile).backend, RedisRateLimiterBackend)
+        with self.settings(RATE_LIMITING_BACKEND='redis_token_bucket'):
+            obj = RateLimitedUser(user_profile)
+        self.assertEqual(obj.backend, RedisTokenBucketRateLimiterBackend)
+
     def test_empty_rules_edge_case(self) -> None:
         obj = RateLimitedTestObject("test", rules=[], backend=RedisRateLimiterBackend)
         self.assertEqual(obj.get_rules(), [(1, 9999)])
@@ -0,0 +1,91 @@
+from typing import Any, Dict
+
+from django.test import override_settings
+
+from zerver.lib import realm_snapshot
+from zerver.lib.actions import check_add_user_group, do_change_full_name
+from zerver.lib.events import fetch_initial_state_data
+from zerver.lib.soft_deactivation import do_soft_deactivate_user
+from zerver.lib.test_classes import ZulipTestCase
+from zerver.lib.test_helpers import queries_captured
+from zerver.lib.users import get_raw_user_data
+from zerver.models import UserProfile
+
+
+@override_settings(REALM_SNAPSHOT_CACHE=True)
+class RealmSnapshotTest(ZulipTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        realm_snapshot.local_snapshots.clear()
+
+    def fetch(self, user_profile: UserProfile, **kwargs: Any) -> Dict[str, Any]:
+        return fetch_initial_state_data(
+            user_profile,
+            event_types=['custom_profile_fields', 'presence', 'realm_user',
+                         'realm_user_groups', 'user_status'],
+            queue_id='',
+            client_gravatar=kwargs.get('client_gravatar', False),
+            user_avatar_url_field_optional=kwargs.get('user_avatar_url_field_optional', False),
+        )
+
+    def test_shared_between_users(self) -> None:
+        hamlet = self.example_user('hamlet')
+        othello = self.example_user('othello')
+
+        with queries_captured() as queries:
+            hamlet_state = self.fetch(hamlet)
+        uncached_query_count = len(queries)
+        self.assertEqual(hamlet_state['raw_users'], get_raw_user_data(
+            hamlet.realm, hamlet, client_gravatar=False, user_avatar_url_field_optional=False))
+
+        with queries_captured() as queries:
+            othello_state = self.fetch(othello)
+        self.assertLess(len(queries), uncached_query_count)
+        for key in ['custom_profile_fields', 'presences', 'raw_users',
+                    'realm_user_groups', 'user_status']:
+            self.assertEqual(othello_state[key], hamlet_state[key])
+        self.assertEqual(othello_state['user_id'], othello.id)
+
+        # Each call gets its own copy of the data.
+        othello_state['raw_users'].clear()
+        self.assertEqual(self.fetch(hamlet)['raw_users'], hamlet_state['raw_users'])
+
+        # The same snapshot is used from memcached in another process.
+        realm_snapshot.local_snapshots.clear()
+        with queries_captured() as queries:
+            self.assertEqual(self.fetch(othello)['raw_users'], hamlet_state['raw_users'])
+        self.assertLess(len(queries), uncached_query_count)
+
+        # Different client capabilities get different variants.
+        self.assertNotEqual(self.fetch(hamlet, client_gravatar=True)['raw_users'],
+                            hamlet_state['raw_users'])
+
+    def test_invalidation(self) -> None:
+        hamlet = self.example_user('hamlet')
+        othello = self.example_user('othello')
+        state = self.fetch(hamlet)
+        self.assertEqual(state['raw_users'][othello.id]['full_name'], 'Othello, the Moor of Venice')
+
+        # Sends a realm_user event.
+        do_change_full_name(othello, 'New Name', acting_user=None)
+        state = self.fetch(hamlet)
+        self.assertEqual(state['raw_users'][othello.id]['full_name'], 'New Name')
+
+        # Sends a user_group event.
+        check_add_user_group(hamlet.realm, 'new_group', [othello], description='')
+        state = self.fetch(hamlet)
+        self.assertIn('new_group', [group['name'] for group in state['realm_user_groups']])
+
+        # Soft deactivation sends no event, but the change is seen
+        # when the user is saved.
+        state = self.fetch(hamlet, user_avatar_url_field_optional=True)
+        self.assertIn('avatar_url', state['raw_users'][othello.id])
+        do_soft_deactivate_user(othello)
+        state = self.fetch(hamlet, user_avatar_url_field_optional=True)
+        self.assertNotIn('avatar_url', state['raw_users'][othello.id])
+
+    @override_settings(REALM_SNAPSHOT_CACHE=False)
+    def test_disabled(self) -> None:
+        hamlet = self.example_user('hamlet')
+        self.fetch(hamlet)
+        self.assertEqual(len(realm_snapshot.local_snapshots), 0)
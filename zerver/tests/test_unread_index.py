@@ -0,0 +1,89 @@
+import ujson
+from django.test import override_settings
+
+from zerver.lib.message import RawUnreadMessagesResult, get_raw_unread_data
+from zerver.lib.test_classes import ZulipTestCase
+from zerver.lib.test_helpers import queries_captured
+from zerver.lib.unread_index import UnreadIndex, get_unread_index
+from zerver.models import UserProfile
+
+
+@override_settings(UNREAD_INDEX=True)
+class UnreadIndexTest(ZulipTestCase):
+    def get_unread_data(self, user_profile: UserProfile) -> RawUnreadMessagesResult:
+        data = get_raw_unread_data(user_profile)
+        with override_settings(UNREAD_INDEX=False):
+            self.assertEqual(data, get_raw_unread_data(user_profile))
+        return data
+
+    def test_unread_index(self) -> None:
+        hamlet = self.example_user('hamlet')
+        cordelia = self.example_user('cordelia')
+        message_id = self.send_stream_message(cordelia, 'Denmark', '@**King Hamlet** hello',
+                                              topic_name='old topic')
+        data = self.get_unread_data(hamlet)
+        self.assertEqual(data['stream_dict'][message_id]['topic'], 'old topic')
+        self.assertIn(message_id, data['mentions'])
+        index, epoch = get_unread_index(hamlet)
+        assert index is not None
+        self.assertIn(message_id, index.messages)
+
+        # With the index, we don't need to join with Message.
+        with queries_captured() as queries:
+            get_raw_unread_data(hamlet)
+        self.assertFalse(any('"zerver_message"' in query['sql'] for query in queries))
+
+        # New messages are added to the index.
+        pm_id = self.send_personal_message(cordelia, hamlet, 'hello')
+        data = self.get_unread_data(hamlet)
+        self.assertEqual(data['pm_dict'][pm_id]['sender_id'], cordelia.id)
+
+        # Messages marked as read are removed.
+        self.login_user(hamlet)
+        result = self.client_post("/json/messages/flags",
+                                  {"messages": ujson.dumps([pm_id]),
+                                   "op": "add",
+                                   "flag": "read"})
+        self.assert_json_success(result)
+        data = self.get_unread_data(hamlet)
+        self.assertNotIn(pm_id, data['pm_dict'])
+        index, epoch = get_unread_index(hamlet)
+        assert index is not None
+        self.assertNotIn(pm_id, index.messages)
+
+        # Edits to the topic or mentions are reflected.
+        self.login_user(cordelia)
+        result = self.client_patch("/json/messages/" + str(message_id), {
+            'message_id': message_id,
+            'topic': 'new topic',
+        })
+        self.assert_json_success(result)
+        data = self.get_unread_data(hamlet)
+        self.assertEqual(data['stream_dict'][message_id]['topic'], 'new topic')
+
+        result = self.client_patch("/json/messages/" + str(message_id), {
+            'message_id': message_id,
+            'content': 'hello',
+        })
+        self.assert_json_success(result)
+        data = self.get_unread_data(hamlet)
+        self.assertNotIn(message_id, data['mentions'])
+
+    def test_index_encoding(self) -> None:
+        hamlet = self.example_user('hamlet')
+        cordelia = self.example_user('cordelia')
+        sent_ids = [self.send_stream_message(cordelia, 'Denmark', 'hello', topic_name=f'topic {i}')
+                    for i in range(3)]
+        get_raw_unread_data(hamlet)
+        index, epoch = get_unread_index(hamlet)
+        assert index is not None
+        message_ids = set(index.messages) - {sent_ids[0]}
+        rows = {message_id: index.get_row(message_id) for message_id in message_ids}
+
+        # Conversations without unread messages are dropped.
+        index.retain(message_ids)
+        decoded = UnreadIndex.from_bytes(index.to_bytes())
+        self.assertEqual(decoded.epoch, epoch)
+        self.assertEqual({message_id: decoded.get_row(message_id) for message_id in message_ids}, rows)
+        self.assertIsNone(decoded.get_row(sent_ids[0]))
+        self.assertEqual(len(decoded.conversations), len(index.conversations) - 1)
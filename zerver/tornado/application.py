@@ -21,6 +21,7 @@ def create_tornado_application(port: int) -> tornado.web.Application:
         r"/json/events",
         r"/api/v1/events",
         r"/api/v1/events/internal",
+        r"/api/v1/events/internal/cleanup",
     )
 
     # Application is an instance of Django's standard wsgi handler.
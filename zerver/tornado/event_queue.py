@@ -9,12 +9,11 @@ import signal
 import sys
 import time
 import traceback
-from collections import deque
+from functools import partial
 from typing import (
     AbstractSet,
     Any,
     Callable,
-    Deque,
     Dict,
     Iterable,
     List,
@@ -36,9 +35,12 @@ from typing_extensions import TypedDict
 
 from zerver.decorator import cachify
 from zerver.lib.message import MessageDict
-from zerver.lib.narrow import build_narrow_filter
-from zerver.lib.queue import queue_json_publish, retry_event
+from zerver.lib.narrow import build_narrow_filter, get_narrow_stream_name
+from zerver.lib.narrow_result_cache import flush_narrow_result_cache_for_event
+from zerver.lib.queue import queue_json_publish, queue_publish_batch, retry_event
+from zerver.lib.realm_snapshot import flush_realm_snapshot_for_event
 from zerver.lib.request import JsonableError
+from zerver.lib.response import PreEncodedJSONDict
 from zerver.lib.utils import statsd
 from zerver.middleware import async_request_timer_restart
 from zerver.models import Client, Realm, UserProfile
@@ -51,7 +53,23 @@ from zerver.tornado.handlers import (
     get_handler_by_id,
     handler_stats_string,
 )
-from zerver.tornado.sharding import get_tornado_port, get_tornado_uri, notify_tornado_queue_name
+from zerver.tornado.sharding import (
+    get_queue_tornado_port,
+    get_realm_tornado_ports,
+    get_tornado_uri,
+    get_tornado_uri_for_port,
+    get_user_tornado_port,
+    notify_tornado_queue_name,
+)
+from zerver.tornado.snapshot import (
+    RECORD_CLIENT,
+    RECORD_DELETE,
+    SnapshotFormatError,
+    SnapshotReader,
+    write_client_record,
+    write_delete_record,
+    write_snapshot_header,
+)
 
 requests_client = requests.Session()
 for host in ['127.0.0.1', 'localhost']:
@@ -67,6 +85,21 @@ DEFAULT_EVENT_QUEUE_TIMEOUT_SECS = 60 * 10
 # We garbage-collect every minute; this is totally fine given that the
 # GC scan takes ~2ms with 1000 event queues.
 EVENT_QUEUE_GC_FREQ_MSECS = 1000 * 60 * 1
+# We append the event queues that changed since they were last
+# checkpointed to the checkpoint file this often, so if Tornado is
+# killed without a clean shutdown, we lose at most this interval's
+# changes to event queue state.  Since nearly every connected queue
+# changes between checkpoints (if only with a heartbeat), each
+# checkpoint serializes most of the live queues; ujson makes that
+# cheap enough to do on the IOLoop.
+EVENT_QUEUE_CHECKPOINT_FREQ_MSECS = 1000 * 5
+# Once the checkpoint file has accumulated this many records (or
+# EVENT_QUEUE_CHECKPOINT_COMPACT_FACTOR times the number of live
+# queues, if larger), we compact it into a fresh full snapshot, so
+# that loading the snapshot plus checkpoints on restart never reads
+# much more than the live queues.
+EVENT_QUEUE_CHECKPOINT_COMPACT_MIN_RECORDS = 10000
+EVENT_QUEUE_CHECKPOINT_COMPACT_FACTOR = 2
 
 # Capped limit for how long a client can request an event queue
 # to live
@@ -111,6 +144,7 @@ class ClientDescriptor:
         self._timeout_handle: Any = None  # TODO: should be return type of ioloop.call_later
         self.narrow = narrow
         self.narrow_filter = build_narrow_filter(narrow)
+        self.narrow_stream_name = get_narrow_stream_name(narrow)
         self.bulk_message_deletion = bulk_message_deletion
 
         # Default for lifespan_secs is DEFAULT_EVENT_QUEUE_TIMEOUT_SECS;
@@ -179,6 +213,7 @@ class ClientDescriptor:
             async_request_timer_restart(handler._request)
 
         self.event_queue.push(event)
+        dirty_queue_ids.add(self.event_queue.id)
         self.finish_current_handler()
 
     def finish_current_handler(self) -> bool:
@@ -213,6 +248,9 @@ class ClientDescriptor:
         self.current_handler_id = handler_id
         self.current_client_name = client_name
         set_descriptor_by_handler_id(handler_id, self)
+        # We don't checkpoint the queue for this; last_connection_time
+        # is only used for garbage collection, and gets persisted with
+        # the queue's next event (at the latest, a heartbeat).
         self.last_connection_time = time.time()
 
         def timeout_callback() -> None:
@@ -263,12 +301,22 @@ class EventQueue:
         # When extending this list of properties, one must be sure to
         # update to_dict and from_dict.
 
-        self.queue: Deque[Dict[str, Any]] = deque()
+        # The events in the queue, in increasing order of id.  Pruning
+        # just advances first_index past the pruned events (found by
+        # binary search); they are only removed from the list once
+        # they make up half of it, so that pruning is cheap even for
+        # clients with very deep queues.
+        self.events: List[Dict[str, Any]] = []
+        self.first_index = 0
         self.next_event_id: int = 0
         self.newest_pruned_id: Optional[int] = -1  # will only be None for migration from old versions
         self.id: str = id
         self.virtual_events: Dict[str, Dict[str, Any]] = {}
 
+    @property
+    def queue(self) -> List[Dict[str, Any]]:
+        return self.events[self.first_index:]
+
     def to_dict(self) -> Dict[str, Any]:
         # If you add a new key to this dict, make sure you add appropriate
         # migration code in from_dict or load_event_queues to account for
@@ -276,7 +324,7 @@ class EventQueue:
         d = dict(
             id=self.id,
             next_event_id=self.next_event_id,
-            queue=list(self.queue),
+            queue=self.queue,
             virtual_events=self.virtual_events,
         )
         if self.newest_pruned_id is not None:
@@ -288,7 +336,7 @@ class EventQueue:
         ret = cls(d['id'])
         ret.next_event_id = d['next_event_id']
         ret.newest_pruned_id = d.get('newest_pruned_id', None)
-        ret.queue = deque(d['queue'])
+        ret.events = list(d['queue'])
         ret.virtual_events = d.get("virtual_events", {})
         return ret
 
@@ -320,52 +368,68 @@ class EventQueue:
             elif full_event_type.startswith("flags/"):
                 virtual_event["messages"] += event["messages"]
         else:
-            self.queue.append(event)
+            self.events.append(event)
 
     # Note that pop ignores virtual events.  This is fine in our
     # current usage since virtual events should always be resolved to
     # a real event before being given to users.
     def pop(self) -> Dict[str, Any]:
-        return self.queue.popleft()
+        if self.first_index == len(self.events):
+            raise IndexError("pop from an empty EventQueue")
+        event = self.events[self.first_index]
+        self.first_index += 1
+        self.compact()
+        return event
 
     def empty(self) -> bool:
-        return len(self.queue) == 0 and len(self.virtual_events) == 0
+        return len(self.events) == self.first_index and len(self.virtual_events) == 0
+
+    def index_after(self, event_id: int) -> int:
+        """Returns the index in self.events of the first unpruned event
+        with an id greater than event_id."""
+        low = self.first_index
+        high = len(self.events)
+        while low < high:
+            mid = (low + high) // 2
+            if self.events[mid]['id'] <= event_id:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def compact(self) -> None:
+        if self.first_index * 2 >= len(self.events):
+            del self.events[:self.first_index]
+            self.first_index = 0
 
     # See the comment on pop; that applies here as well
     def prune(self, through_id: int) -> None:
-        while len(self.queue) != 0 and self.queue[0]['id'] <= through_id:
-            self.newest_pruned_id = self.queue[0]['id']
-            self.pop()
+        index = self.index_after(through_id)
+        if index == self.first_index:
+            return
+        self.newest_pruned_id = self.events[index - 1]['id']
+        self.first_index = index
+        self.compact()
 
     def contents(self) -> List[Dict[str, Any]]:
-        contents: List[Dict[str, Any]] = []
-        virtual_id_map: Dict[str, Dict[str, Any]] = {}
-        for event_type in self.virtual_events:
-            virtual_id_map[self.virtual_events[event_type]["id"]] = self.virtual_events[event_type]
-        virtual_ids = sorted(list(virtual_id_map.keys()))
-
-        # Merge the virtual events into their final place in the queue
-        index = 0
-        length = len(virtual_ids)
-        for event in self.queue:
-            while index < length and virtual_ids[index] < event["id"]:
-                contents.append(virtual_id_map[virtual_ids[index]])
-                index += 1
-            contents.append(event)
-        while index < length:
-            contents.append(virtual_id_map[virtual_ids[index]])
-            index += 1
-
-        self.virtual_events = {}
-        self.queue = deque(contents)
-        return contents
+        # Merge the virtual events into their final place in the
+        # queue.  There are only ever a handful of virtual events.
+        if self.virtual_events:
+            for event in sorted(self.virtual_events.values(), key=lambda event: event["id"]):
+                self.events.insert(self.index_after(event["id"]), event)
+            self.virtual_events = {}
+        return self.queue
 
 # maps queue ids to client descriptors
 clients: Dict[str, ClientDescriptor] = {}
 # maps user id to list of client descriptors
 user_clients: Dict[int, List[ClientDescriptor]] = {}
-# maps realm id to list of client descriptors with all_public_streams=True
+# maps realm id to list of client descriptors with all_public_streams=True,
+# or with a narrow which doesn't specify a stream
 realm_clients_all_streams: Dict[int, List[ClientDescriptor]] = {}
+# maps realm id and (lowercased) stream name to list of client
+# descriptors whose narrow is for that stream
+realm_clients_by_stream: Dict[int, Dict[str, List[ClientDescriptor]]] = {}
 
 # list of registered gc hooks.
 # each one will be called with a user profile id, queue, and bool
@@ -375,15 +439,33 @@ realm_clients_all_streams: Dict[int, List[ClientDescriptor]] = {}
 gc_hooks: List[Callable[[int, ClientDescriptor, bool], None]] = []
 
 next_queue_id = 0
+# When running several Tornado processes, queue IDs are prefixed with
+# the port, which lets nginx route requests for a queue to the right
+# process when a realm's users are spread across several of them.
+queue_id_prefix = ''
+
+# Queue ids created/modified or garbage-collected since they were
+# last checkpointed; see checkpoint_event_queues.
+dirty_queue_ids: Set[str] = set()
+removed_queue_ids: Set[str] = set()
+# The generation of the full snapshot that the checkpoint file extends,
+# and the number of records written to the checkpoint file so far.
+snapshot_generation = 0
+checkpoint_record_count = 0
 
 def clear_client_event_queues_for_testing() -> None:
     assert(settings.TEST_SUITE)
     clients.clear()
     user_clients.clear()
     realm_clients_all_streams.clear()
+    realm_clients_by_stream.clear()
     gc_hooks.clear()
-    global next_queue_id
+    dirty_queue_ids.clear()
+    removed_queue_ids.clear()
+    global next_queue_id, snapshot_generation, checkpoint_record_count
     next_queue_id = 0
+    snapshot_generation = 0
+    checkpoint_record_count = 0
 
 def add_client_gc_hook(hook: Callable[[int, ClientDescriptor, bool], None]) -> None:
     gc_hooks.append(hook)
@@ -397,24 +479,35 @@ def get_client_descriptors_for_user(user_profile_id: int) -> List[ClientDescript
 def get_client_descriptors_for_realm_all_streams(realm_id: int) -> List[ClientDescriptor]:
     return realm_clients_all_streams.get(realm_id, [])
 
+def get_client_descriptors_for_realm_stream(realm_id: int, stream_name: str) -> List[ClientDescriptor]:
+    return realm_clients_by_stream.get(realm_id, {}).get(stream_name.lower(), [])
+
 def add_to_client_dicts(client: ClientDescriptor) -> None:
     user_clients.setdefault(client.user_profile_id, []).append(client)
-    if client.all_public_streams or client.narrow != []:
+    if client.all_public_streams:
+        realm_clients_all_streams.setdefault(client.realm_id, []).append(client)
+    elif client.narrow_stream_name is not None:
+        # Narrowed clients only need messages sent to public streams
+        # they're not subscribed to if they're for the narrow's stream.
+        realm_clients_by_stream.setdefault(client.realm_id, {}).setdefault(
+            client.narrow_stream_name, []).append(client)
+    elif client.narrow != []:
         realm_clients_all_streams.setdefault(client.realm_id, []).append(client)
 
 def allocate_client_descriptor(new_queue_data: MutableMapping[str, Any]) -> ClientDescriptor:
     global next_queue_id
-    queue_id = str(settings.SERVER_GENERATION) + ':' + str(next_queue_id)
+    queue_id = queue_id_prefix + str(settings.SERVER_GENERATION) + ':' + str(next_queue_id)
     next_queue_id += 1
     new_queue_data["event_queue"] = EventQueue(queue_id).to_dict()
     client = ClientDescriptor.from_dict(new_queue_data)
     clients[queue_id] = client
     add_to_client_dicts(client)
+    dirty_queue_ids.add(queue_id)
     return client
 
 def do_gc_event_queues(to_remove: AbstractSet[str], affected_users: AbstractSet[int],
                        affected_realms: AbstractSet[int]) -> None:
-    def filter_client_dict(client_dict: MutableMapping[int, List[ClientDescriptor]], key: int) -> None:
+    def filter_client_dict(client_dict: MutableMapping[Any, List[ClientDescriptor]], key: Any) -> None:
         if key not in client_dict:
             return
 
@@ -429,11 +522,19 @@ def do_gc_event_queues(to_remove: AbstractSet[str], affected_users: AbstractSet[
 
     for realm_id in affected_realms:
         filter_client_dict(realm_clients_all_streams, realm_id)
+        if realm_id in realm_clients_by_stream:
+            stream_clients = realm_clients_by_stream[realm_id]
+            for stream_name in list(stream_clients):
+                filter_client_dict(stream_clients, stream_name)
+            if not stream_clients:
+                del realm_clients_by_stream[realm_id]
 
     for id in to_remove:
         for cb in gc_hooks:
             cb(clients[id].user_profile_id, clients[id], clients[id].user_profile_id not in user_clients)
         del clients[id]
+        dirty_queue_ids.discard(id)
+        removed_queue_ids.add(id)
 
 def gc_event_queues(port: int) -> None:
     start = time.time()
@@ -459,44 +560,162 @@ def gc_event_queues(port: int) -> None:
     statsd.gauge('tornado.active_queues', len(clients))
     statsd.gauge('tornado.active_users', len(user_clients))
 
-def persistent_queue_filename(port: int, last: bool=False) -> str:
+def port_aware_filename(pattern: str, port: int, last: bool=False) -> str:
     if settings.TORNADO_PROCESSES == 1:
         # Use non-port-aware, legacy version.
         if last:
-            return settings.JSON_PERSISTENT_QUEUE_FILENAME_PATTERN % ('',) + '.last'
-        return settings.JSON_PERSISTENT_QUEUE_FILENAME_PATTERN % ('',)
+            return pattern % ('',) + '.last'
+        return pattern % ('',)
     if last:
-        return settings.JSON_PERSISTENT_QUEUE_FILENAME_PATTERN % ('.' + str(port) + '.last',)
-    return settings.JSON_PERSISTENT_QUEUE_FILENAME_PATTERN % ('.' + str(port),)
+        return pattern % ('.' + str(port) + '.last',)
+    return pattern % ('.' + str(port),)
+
+def persistent_queue_filename(port: int, last: bool=False) -> str:
+    # The legacy, single-JSON-document format; we only read it, to
+    # migrate event queues across an upgrade.
+    return port_aware_filename(settings.JSON_PERSISTENT_QUEUE_FILENAME_PATTERN, port, last)
+
+def persistent_queue_snapshot_filename(port: int, last: bool=False) -> str:
+    return port_aware_filename(settings.PERSISTENT_QUEUE_SNAPSHOT_FILENAME_PATTERN, port, last)
+
+def persistent_queue_checkpoint_filename(port: int, last: bool=False) -> str:
+    return port_aware_filename(settings.PERSISTENT_QUEUE_CHECKPOINT_FILENAME_PATTERN, port, last)
+
+def move_to_last(filename: str, last_filename: str) -> None:
+    try:
+        os.rename(filename, last_filename)
+    except OSError:
+        pass
 
 def dump_event_queues(port: int) -> None:
+    """Writes a full snapshot of all event queues, replacing both the
+    previous snapshot and the checkpoint file extending it."""
+    global snapshot_generation, checkpoint_record_count
     start = time.time()
 
-    with open(persistent_queue_filename(port), "w") as stored_queues:
-        ujson.dump([(qid, client.to_dict()) for (qid, client) in clients.items()],
-                   stored_queues)
+    new_generation = snapshot_generation + 1
+    snapshot_filename = persistent_queue_snapshot_filename(port)
+    tmp_filename = snapshot_filename + '.tmp'
+    with open(tmp_filename, 'wb') as stored_queues:
+        write_snapshot_header(stored_queues, new_generation)
+        for client in clients.values():
+            write_client_record(stored_queues, client.to_dict())
+    os.rename(tmp_filename, snapshot_filename)
+
+    # If we crash before removing the checkpoint file, its generation
+    # no longer matches the snapshot, and load_event_queues ignores it.
+    try:
+        os.remove(persistent_queue_checkpoint_filename(port))
+    except FileNotFoundError:
+        pass
+
+    snapshot_generation = new_generation
+    checkpoint_record_count = 0
+    dirty_queue_ids.clear()
+    removed_queue_ids.clear()
 
     logging.info('Tornado %d dumped %d event queues in %.3fs',
                  port, len(clients), time.time() - start)
 
+def checkpoint_event_queues(port: int) -> None:
+    """Appends the event queues that changed since they were last
+    checkpointed to the checkpoint file; this is cheap enough to run
+    periodically and on shutdown, unlike a full dump_event_queues."""
+    global checkpoint_record_count
+    if not dirty_queue_ids and not removed_queue_ids:
+        return
+
+    if checkpoint_record_count > max(EVENT_QUEUE_CHECKPOINT_COMPACT_MIN_RECORDS,
+                                     EVENT_QUEUE_CHECKPOINT_COMPACT_FACTOR * len(clients)):
+        # Most of the checkpoint file is superseded records by now;
+        # compact it so that it stays quick to load.
+        dump_event_queues(port)
+        return
+
+    start = time.time()
+    with open(persistent_queue_checkpoint_filename(port), 'ab') as checkpoint:
+        if checkpoint.tell() == 0:
+            write_snapshot_header(checkpoint, snapshot_generation)
+        for queue_id in removed_queue_ids:
+            write_delete_record(checkpoint, queue_id)
+        for queue_id in dirty_queue_ids:
+            write_client_record(checkpoint, clients[queue_id].to_dict())
+
+    num_records = len(dirty_queue_ids) + len(removed_queue_ids)
+    checkpoint_record_count += num_records
+    dirty_queue_ids.clear()
+    removed_queue_ids.clear()
+
+    logging.info('Tornado %d checkpointed %d event queues in %.3fs',
+                 port, num_records, time.time() - start)
+
+def read_event_queue_snapshot(port: int) -> Dict[str, Dict[str, Any]]:
+    global snapshot_generation, checkpoint_record_count
+    client_dicts: Dict[str, Dict[str, Any]] = {}
+
+    generation = 0
+    snapshot_filename = persistent_queue_snapshot_filename(port)
+    if os.path.exists(snapshot_filename):
+        with SnapshotReader(snapshot_filename) as reader:
+            generation = reader.generation
+            for record_type, client_dict in reader.records():
+                client_dicts[client_dict['event_queue']['id']] = client_dict
+
+    num_records = 0
+    checkpoint_filename = persistent_queue_checkpoint_filename(port)
+    if os.path.exists(checkpoint_filename):
+        with SnapshotReader(checkpoint_filename) as reader:
+            if reader.generation != generation:
+                logging.warning("Tornado %d ignoring checkpoint for stale snapshot generation %d",
+                                port, reader.generation)
+                reader.close()
+                move_to_last(checkpoint_filename, persistent_queue_checkpoint_filename(port, last=True))
+            else:
+                for record_type, data in reader.records():
+                    num_records += 1
+                    if record_type == RECORD_CLIENT:
+                        client_dicts[data['event_queue']['id']] = data
+                    elif record_type == RECORD_DELETE:
+                        client_dicts.pop(data, None)
+
+    snapshot_generation = generation
+    checkpoint_record_count = num_records
+    return client_dicts
+
+def read_legacy_event_queues(port: int) -> Dict[str, Dict[str, Any]]:
+    filename = persistent_queue_filename(port)
+    try:
+        with open(filename) as stored_queues:
+            data = ujson.load(stored_queues)
+    except FileNotFoundError:
+        return {}
+    move_to_last(filename, persistent_queue_filename(port, last=True))
+    # We need to write the migrated queues in the new format.
+    dirty_queue_ids.update(qid for (qid, client) in data)
+    return {qid: client for (qid, client) in data}
+
 def load_event_queues(port: int) -> None:
     global clients
     start = time.time()
 
+    snapshot_filename = persistent_queue_snapshot_filename(port)
+    checkpoint_filename = persistent_queue_checkpoint_filename(port)
     try:
-        with open(persistent_queue_filename(port)) as stored_queues:
-            data = ujson.load(stored_queues)
-    except FileNotFoundError:
-        pass
-    except ValueError:
+        if os.path.exists(snapshot_filename) or os.path.exists(checkpoint_filename):
+            client_dicts = read_event_queue_snapshot(port)
+        else:
+            client_dicts = read_legacy_event_queues(port)
+        clients = {
+            qid: ClientDescriptor.from_dict(client) for (qid, client) in client_dicts.items()
+        }
+    except (SnapshotFormatError, ValueError, KeyError):
         logging.exception("Tornado %d could not deserialize event queues", port)
-    else:
-        try:
-            clients = {
-                qid: ClientDescriptor.from_dict(client) for (qid, client) in data
-            }
-        except Exception:
-            logging.exception("Tornado %d could not deserialize event queues", port)
+        # Set the unreadable files aside, so that we don't fail the
+        # same way on every restart, and start over with no queues.
+        move_to_last(snapshot_filename, persistent_queue_snapshot_filename(port, last=True))
+        move_to_last(checkpoint_filename, persistent_queue_checkpoint_filename(port, last=True))
+        move_to_last(persistent_queue_filename(port), persistent_queue_filename(port, last=True))
+        dirty_queue_ids.clear()
 
     for client in clients.values():
         # Put code for migrations due to event queue data format changes here
@@ -515,20 +734,24 @@ def send_restart_events(immediate: bool=False) -> None:
             client.add_event(event)
 
 def setup_event_queue(port: int) -> None:
+    global queue_id_prefix
+    if settings.TORNADO_PROCESSES > 1:
+        queue_id_prefix = f"{port}:"
+
+    ioloop = tornado.ioloop.IOLoop.instance()
     if not settings.TEST_SUITE:
         load_event_queues(port)
-        atexit.register(dump_event_queues, port)
-        # Make sure we dump event queues even if we exit via signal
+        atexit.register(checkpoint_event_queues, port)
+        # Make sure we checkpoint event queues even if we exit via signal
         signal.signal(signal.SIGTERM, lambda signum, stack: sys.exit(1))
-        add_reload_hook(lambda: dump_event_queues(port))
+        add_reload_hook(lambda: checkpoint_event_queues(port))
 
-    try:
-        os.rename(persistent_queue_filename(port), persistent_queue_filename(port, last=True))
-    except OSError:
-        pass
+        checkpoint_pc = tornado.ioloop.PeriodicCallback(
+            lambda: checkpoint_event_queues(port),
+            EVENT_QUEUE_CHECKPOINT_FREQ_MSECS, ioloop)
+        checkpoint_pc.start()
 
     # Set up event queue garbage collection
-    ioloop = tornado.ioloop.IOLoop.instance()
     pc = tornado.ioloop.PeriodicCallback(lambda: gc_event_queues(port),
                                          EVENT_QUEUE_GC_FREQ_MSECS, ioloop)
     pc.start()
@@ -569,6 +792,9 @@ def fetch_events(query: Mapping[str, Any]) -> Dict[str, Any]:
                 raise JsonableError(_("An event newer than {event_id} has already been pruned!").format(
                     event_id=last_event_id,
                 ))
+            # We don't checkpoint the queue for this; if we restart
+            # with the pruned events still in it, the client's next
+            # request prunes them again.
             client.event_queue.prune(last_event_id)
             if (
                 client.event_queue.newest_pruned_id is not None
@@ -616,7 +842,7 @@ def request_event_queue(user_profile: UserProfile, user_client: Client, apply_ma
                         bulk_message_deletion: bool=False) -> Optional[str]:
 
     if settings.TORNADO_SERVER:
-        tornado_uri = get_tornado_uri(user_profile.realm)
+        tornado_uri = get_tornado_uri(user_profile.realm, user_profile.id)
         req = {'dont_block': 'true',
                'apply_markdown': ujson.dumps(apply_markdown),
                'client_gravatar': ujson.dumps(client_gravatar),
@@ -651,7 +877,7 @@ def request_event_queue(user_profile: UserProfile, user_client: Client, apply_ma
 
 def get_user_events(user_profile: UserProfile, queue_id: str, last_event_id: int) -> List[Dict[str, Any]]:
     if settings.TORNADO_SERVER:
-        tornado_uri = get_tornado_uri(user_profile.realm)
+        tornado_uri = get_tornado_uri(user_profile.realm, user_profile.id)
         post_data: Dict[str, Any] = {
             'queue_id': queue_id,
             'last_event_id': last_event_id,
@@ -667,6 +893,17 @@ def get_user_events(user_profile: UserProfile, queue_id: str, last_event_id: int
         return resp.json()['events']
     return []
 
+def cleanup_user_event_queue(user_profile: UserProfile, queue_id: str) -> requests.Response:
+    tornado_uri = get_tornado_uri_for_port(
+        get_queue_tornado_port(user_profile.realm, user_profile.id, queue_id))
+    post_data = {
+        'queue_id': queue_id,
+        'user_profile_id': user_profile.id,
+        'secret': settings.SHARED_SECRET,
+    }
+    return requests_client.post(tornado_uri + '/api/v1/events/internal/cleanup',
+                                data=post_data)
+
 # Send email notifications to idle users
 # after they are idle for 1 hour
 NOTIFY_AFTER_IDLE_HOURS = 1
@@ -823,7 +1060,9 @@ def get_client_info_for_message_event(event_template: Mapping[str, Any],
     # bots) that are registered to get events for ALL streams.
     if 'stream_name' in event_template and not event_template.get("invite_only"):
         realm_id = event_template['realm_id']
-        for client in get_client_descriptors_for_realm_all_streams(realm_id):
+        stream_clients = get_client_descriptors_for_realm_stream(
+            realm_id, event_template['stream_name'])
+        for client in get_client_descriptors_for_realm_all_streams(realm_id) + stream_clients:
             send_to_clients[client.event_queue.id] = dict(
                 client=client,
                 flags=[],
@@ -868,13 +1107,15 @@ def process_message_event(event_template: Mapping[str, Any], users: Iterable[Map
     message_type: str = wide_dict['type']
     sending_client: str = wide_dict['client']
 
+    # Each payload variant is JSON-encoded just once, and that encoding
+    # is reused when writing the event to every client's response.
     @cachify
     def get_client_payload(apply_markdown: bool, client_gravatar: bool) -> Dict[str, Any]:
-        return MessageDict.finalize_payload(
+        return PreEncodedJSONDict(MessageDict.finalize_payload(
             wide_dict,
             apply_markdown=apply_markdown,
             client_gravatar=client_gravatar,
-        )
+        ))
 
     # Extra user-specific data to include
     extra_user_data: Dict[int, Any] = {}
@@ -1119,27 +1360,30 @@ def process_notification(notice: Mapping[str, Any]) -> None:
     users: Union[List[int], List[Mapping[str, Any]]] = notice['users']
     start_time = time.time()
 
-    if event['type'] == "message":
-        process_message_event(event, cast(Iterable[Mapping[str, Any]], users))
-    elif event['type'] == "update_message":
-        process_message_update_event(event, cast(Iterable[Mapping[str, Any]], users))
-    elif event['type'] == "delete_message":
-        if len(users) > 0 and isinstance(users[0], dict):
-            # do_delete_messages used to send events with users in
-            # dict format {"id": <int>} This block is here for
-            # compatibility with events in that format still in the
-            # queue at the time of upgrade.
-            #
-            # TODO: Remove this block in release >= 4.0.
-            user_ids: List[int] = [user['id'] for user in
-                                   cast(List[Mapping[str, int]], users)]
+    # Any notifications we enqueue for the queue processors (e.g. for
+    # every recipient of a message to a large stream) go out as a batch.
+    with queue_publish_batch():
+        if event['type'] == "message":
+            process_message_event(event, cast(Iterable[Mapping[str, Any]], users))
+        elif event['type'] == "update_message":
+            process_message_update_event(event, cast(Iterable[Mapping[str, Any]], users))
+        elif event['type'] == "delete_message":
+            if len(users) > 0 and isinstance(users[0], dict):
+                # do_delete_messages used to send events with users in
+                # dict format {"id": <int>} This block is here for
+                # compatibility with events in that format still in the
+                # queue at the time of upgrade.
+                #
+                # TODO: Remove this block in release >= 4.0.
+                user_ids: List[int] = [user['id'] for user in
+                                       cast(List[Mapping[str, int]], users)]
+            else:
+                user_ids = cast(List[int], users)
+            process_deletion_event(event, user_ids)
+        elif event['type'] == "presence":
+            process_presence_event(event, cast(Iterable[int], users))
         else:
-            user_ids = cast(List[int], users)
-        process_deletion_event(event, user_ids)
-    elif event['type'] == "presence":
-        process_presence_event(event, cast(Iterable[int], users))
-    else:
-        process_event(event, cast(Iterable[int], users))
+            process_event(event, cast(Iterable[int], users))
     logging.debug(
         "Tornado: Event %s for %s users took %sms",
         event['type'], len(users), int(1000 * (time.time() - start_time)),
@@ -1164,21 +1408,46 @@ def get_wrapped_process_notification(queue_name: str) -> Callable[[Dict[str, Any
 # We use JSON rather than bare form parameters, so that we can represent
 # different types and for compatibility with non-HTTP transports.
 
-def send_notification_http(realm: Realm, data: Mapping[str, Any]) -> None:
+def send_notification_http(port: int, data: Mapping[str, Any]) -> None:
     if settings.TORNADO_SERVER and not settings.RUNNING_INSIDE_TORNADO:
-        tornado_uri = get_tornado_uri(realm)
+        tornado_uri = get_tornado_uri_for_port(port)
         requests_client.post(tornado_uri + '/notify_tornado', data=dict(
             data   = ujson.dumps(data),
             secret = settings.SHARED_SECRET))
     else:
         process_notification(data)
 
+def get_users_by_tornado_port(realm: Realm, event: Mapping[str, Any],
+                              users: Union[Iterable[int], Iterable[Mapping[str, Any]]],
+                              ) -> Dict[int, List[Any]]:
+    ports = get_realm_tornado_ports(realm)
+    if len(ports) == 1:
+        return {ports[0]: list(users)}
+
+    # The realm's users are sharded across several Tornado processes;
+    # each process only needs the event if it has queues for some of
+    # the affected users.
+    users_by_port: Dict[int, List[Any]] = {port: [] for port in ports}
+    for user in users:
+        user_profile_id = user['id'] if isinstance(user, dict) else user
+        users_by_port[get_user_tornado_port(ports, user_profile_id)].append(user)
+
+    # Messages to public streams are also delivered to clients
+    # registered for all public streams (or with a narrow), which
+    # live on every shard; see get_client_info_for_message_event.
+    if event['type'] == 'message' and 'stream_name' in event and not event.get('invite_only'):
+        return users_by_port
+    return {port: port_users for (port, port_users) in users_by_port.items() if port_users}
+
 def send_event(realm: Realm, event: Mapping[str, Any],
                users: Union[Iterable[int], Iterable[Mapping[str, Any]]]) -> None:
     """`users` is a list of user IDs, or in the case of `message` type
     events, a list of dicts describing the users and metadata about
     the user/message pair."""
-    port = get_tornado_port(realm)
-    queue_json_publish(notify_tornado_queue_name(port),
-                       dict(event=event, users=users),
-                       lambda *args, **kwargs: send_notification_http(realm, *args, **kwargs))
+    users = list(users)
+    flush_realm_snapshot_for_event(realm.id, event['type'])
+    flush_narrow_result_cache_for_event(realm.id, event, users)
+    for (port, port_users) in get_users_by_tornado_port(realm, event, users).items():
+        queue_json_publish(notify_tornado_queue_name(port),
+                           dict(event=event, users=port_users),
+                           partial(send_notification_http, port))
@@ -11,7 +11,7 @@ from django.http import HttpRequest, HttpResponse
 from django.urls import set_script_prefix
 from tornado.wsgi import WSGIContainer
 
-from zerver.lib.response import json_response
+from zerver.lib.response import json_events_response
 from zerver.middleware import async_request_timer_restart, async_request_timer_stop
 from zerver.tornado.descriptors import get_descriptor_by_handler_id
 
@@ -229,8 +229,8 @@ class AsyncDjangoHandler(tornado.web.RequestHandler, base.BaseHandler):
         # request/middleware system to run unmodified while avoiding
         # running expensive things like Zulip's authentication code a
         # second time.
-        request.saved_response = json_response(res_type=result_dict['result'],
-                                               data=result_dict, status=self.get_status())
+        request.saved_response = json_events_response(res_type=result_dict['result'],
+                                                      data=result_dict, status=self.get_status())
 
         try:
             response = self.get_response(request)
@@ -1,29 +1,54 @@
 import json
 import os
+from typing import Dict, List, Optional, Union
 
 from django.conf import settings
 
 from zerver.models import Realm
 
-shard_map = {}
+# Maps realm hosts to either the Tornado port serving the realm, or a
+# list of ports, across which the realm's users are spread by user ID
+# (see scripts/lib/sharding.py).
+shard_map: Dict[str, Union[int, List[int]]] = {}
 if os.path.exists("/etc/zulip/sharding.json"):
     with open("/etc/zulip/sharding.json") as f:
         shard_map = json.loads(f.read())
 
-def get_tornado_port(realm: Realm) -> int:
+def get_realm_tornado_ports(realm: Realm) -> List[int]:
     if settings.TORNADO_SERVER is None:
-        return 9993
+        return [9993]
     if settings.TORNADO_PROCESSES == 1:
-        return int(settings.TORNADO_SERVER.split(":")[-1])
-    return shard_map.get(realm.host, 9800)
+        return [int(settings.TORNADO_SERVER.split(":")[-1])]
+    shard = shard_map.get(realm.host, 9800)
+    if isinstance(shard, list):
+        return shard
+    return [shard]
 
-def get_tornado_uri(realm: Realm) -> str:
+def get_user_tornado_port(ports: List[int], user_profile_id: int) -> int:
+    return ports[user_profile_id % len(ports)]
+
+def get_tornado_port(realm: Realm, user_profile_id: Optional[int]=None) -> int:
+    ports = get_realm_tornado_ports(realm)
+    if user_profile_id is None:
+        return ports[0]
+    return get_user_tornado_port(ports, user_profile_id)
+
+def get_queue_tornado_port(realm: Realm, user_profile_id: int, queue_id: str) -> int:
+    # With several Tornado processes, queue IDs start with the port of
+    # the process holding the queue (see allocate_client_descriptor).
+    queue_id_parts = queue_id.split(':')
+    if len(queue_id_parts) == 3 and queue_id_parts[0].isdigit():
+        return int(queue_id_parts[0])
+    return get_tornado_port(realm, user_profile_id)
+
+def get_tornado_uri_for_port(port: int) -> str:
     if settings.TORNADO_PROCESSES == 1:
         return settings.TORNADO_SERVER
-
-    port = get_tornado_port(realm)
     return f"http://127.0.0.1:{port}"
 
+def get_tornado_uri(realm: Realm, user_profile_id: Optional[int]=None) -> str:
+    return get_tornado_uri_for_port(get_tornado_port(realm, user_profile_id))
+
 def notify_tornado_queue_name(port: int) -> str:
     if settings.TORNADO_PROCESSES == 1:
         return "notify_tornado"
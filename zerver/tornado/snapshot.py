@@ -0,0 +1,114 @@
+# Compact on-disk format used to persist Tornado's event queues across
+# restarts.  See `load_event_queues` and `checkpoint_event_queues` in
+# zerver/tornado/event_queue.py for how these files are used.
+#
+# A file is a fixed-size header followed by a sequence of
+# length-prefixed records, one per event queue.  Because every record
+# is independent, files can be read as a stream (or memory-mapped)
+# without parsing one giant JSON document, and checkpoints can be
+# appended to an existing file.  The header's `generation` ties an
+# incremental checkpoint file to the full snapshot it extends.
+import logging
+import mmap
+import os
+import struct
+from typing import IO, Any, Dict, Iterator, Optional, Tuple
+
+import ujson
+
+SNAPSHOT_MAGIC = b'ZEQS'
+SNAPSHOT_VERSION = 1
+
+HEADER = struct.Struct('>4sHQ')
+RECORD_HEADER = struct.Struct('>cI')
+
+# A full ClientDescriptor.to_dict(), JSON-encoded.
+RECORD_CLIENT = b'C'
+# An event queue id that has been garbage-collected.
+RECORD_DELETE = b'D'
+
+class SnapshotFormatError(Exception):
+    pass
+
+def write_snapshot_header(f: IO[bytes], generation: int) -> None:
+    f.write(HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, generation))
+
+def write_record(f: IO[bytes], record_type: bytes, payload: bytes) -> None:
+    f.write(RECORD_HEADER.pack(record_type, len(payload)))
+    f.write(payload)
+
+def write_client_record(f: IO[bytes], client_dict: Dict[str, Any]) -> None:
+    write_record(f, RECORD_CLIENT, ujson.dumps(client_dict).encode())
+
+def write_delete_record(f: IO[bytes], queue_id: str) -> None:
+    write_record(f, RECORD_DELETE, queue_id.encode())
+
+class SnapshotReader:
+    """Iterates over the records of a snapshot or checkpoint file.
+
+    With use_mmap=True (the default), the file is memory-mapped rather
+    than read into memory, so that only one record at a time needs to
+    be materialized as a Python object.
+    """
+
+    def __init__(self, path: str, use_mmap: bool=True) -> None:
+        self.path = path
+        self.use_mmap = use_mmap
+        self.generation = 0
+        self._file: Optional[IO[bytes]] = None
+        self._buffer: Any = b''
+
+    def __enter__(self) -> 'SnapshotReader':
+        self._file = open(self.path, 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        if size < HEADER.size:
+            self.close()
+            raise SnapshotFormatError(f"{self.path} is too short to be a snapshot")
+        if self.use_mmap:
+            self._buffer = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._buffer = self._file.read()
+
+        magic, version, generation = HEADER.unpack_from(self._buffer, 0)
+        if magic != SNAPSHOT_MAGIC:
+            self.close()
+            raise SnapshotFormatError(f"{self.path} is not an event queue snapshot")
+        if version != SNAPSHOT_VERSION:
+            self.close()
+            raise SnapshotFormatError(f"{self.path} has unsupported snapshot version {version}")
+        self.generation = generation
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if isinstance(self._buffer, mmap.mmap):
+            self._buffer.close()
+        self._buffer = b''
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def records(self) -> Iterator[Tuple[bytes, Any]]:
+        buf = self._buffer
+        end = len(buf)
+        offset = HEADER.size
+        while offset + RECORD_HEADER.size <= end:
+            record_type, length = RECORD_HEADER.unpack_from(buf, offset)
+            start = offset + RECORD_HEADER.size
+            if start + length > end:
+                break
+            payload = buf[start:start + length]
+            if record_type == RECORD_CLIENT:
+                yield (record_type, ujson.loads(payload))
+            elif record_type == RECORD_DELETE:
+                yield (record_type, payload.decode())
+            else:
+                raise SnapshotFormatError(f"Unknown record type {record_type!r} in {self.path}")
+            offset = start + length
+
+        if offset != end:
+            # This is expected if we were killed in the middle of
+            # writing a checkpoint; every record before it is intact.
+            logging.warning("Ignoring truncated trailing record in %s", self.path)
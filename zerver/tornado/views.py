@@ -2,11 +2,12 @@ import time
 from typing import Iterable, Optional, Sequence
 
 import ujson
+from django.conf import settings
 from django.http import HttpRequest, HttpResponse
 from django.utils.translation import ugettext as _
 
 from zerver.decorator import REQ, has_request_variables, internal_notify_view, process_client
-from zerver.lib.response import json_error, json_success
+from zerver.lib.response import json_error, json_events_response, json_success
 from zerver.lib.validator import (
     check_bool,
     check_int,
@@ -15,7 +16,12 @@ from zerver.lib.validator import (
     to_non_negative_int,
 )
 from zerver.models import Client, UserProfile, get_client, get_user_profile_by_id
-from zerver.tornado.event_queue import fetch_events, get_client_descriptor, process_notification
+from zerver.tornado.event_queue import (
+    cleanup_user_event_queue,
+    fetch_events,
+    get_client_descriptor,
+    process_notification,
+)
 from zerver.tornado.exceptions import BadEventQueueIdError
 from zerver.tornado.handlers import AsyncDjangoHandler
 
@@ -28,6 +34,26 @@ def notify(request: HttpRequest) -> HttpResponse:
 @has_request_variables
 def cleanup_event_queue(request: HttpRequest, user_profile: UserProfile,
                         queue_id: str=REQ()) -> HttpResponse:
+    if settings.TORNADO_SERVER and not settings.RUNNING_INSIDE_TORNADO:
+        # nginx can't tell which Tornado process holds the queue, since
+        # its ID is in the request body, so it sends these requests to
+        # Django, which passes them on to the right process.
+        resp = cleanup_user_event_queue(user_profile, queue_id)
+        return HttpResponse(resp.content, status=resp.status_code,
+                            content_type=resp.headers.get('Content-Type'))
+    return cleanup_event_queue_backend(request, user_profile, queue_id)
+
+@internal_notify_view(True)
+@has_request_variables
+def cleanup_event_queue_internal(request: HttpRequest,
+                                 user_profile_id: int = REQ(validator=check_int),
+                                 queue_id: str = REQ()) -> HttpResponse:
+    user_profile = get_user_profile_by_id(user_profile_id)
+    request._requestor_for_logs = user_profile.format_requestor_for_logs()
+    return cleanup_event_queue_backend(request, user_profile, queue_id)
+
+def cleanup_event_queue_backend(request: HttpRequest, user_profile: UserProfile,
+                                queue_id: str) -> HttpResponse:
     client = get_client_descriptor(str(queue_id))
     if client is None:
         raise BadEventQueueIdError(queue_id)
@@ -128,4 +154,4 @@ def get_events_backend(request: HttpRequest, user_profile: UserProfile,
         return response
     if result["type"] == "error":
         raise result["exception"]
-    return json_success(result["response"])
+    return json_events_response(data=result["response"])
@@ -1,3 +1,4 @@
+import hashlib
 import re
 from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
 
@@ -8,13 +9,14 @@ from django.db import connection
 from django.http import HttpRequest, HttpResponse
 from django.utils.html import escape as escape_html
 from django.utils.translation import ugettext as _
-from sqlalchemy import func
+from sqlalchemy import Integer, func
 from sqlalchemy.dialects import postgresql
 from sqlalchemy.sql import (
     ColumnElement,
     Selectable,
     alias,
     and_,
+    bindparam,
     column,
     join,
     literal,
@@ -29,9 +31,22 @@ from sqlalchemy.sql import (
 from zerver.decorator import REQ, has_request_variables
 from zerver.lib.actions import recipient_for_user_profiles
 from zerver.lib.addressee import get_user_profiles, get_user_profiles_by_ids
+from zerver.lib.cache import cache_get, cache_set, message_fetch_plan_cache_key
 from zerver.lib.exceptions import ErrorCode, JsonableError
-from zerver.lib.message import get_first_visible_message_id, messages_for_ids
-from zerver.lib.response import json_error, json_success
+from zerver.lib.message import (
+    encoded_messages_for_ids,
+    get_first_visible_message_id,
+    messages_for_ids,
+)
+from zerver.lib.narrow_result_cache import (
+    NARROW_RESULT_PAGE_SIZE,
+    NarrowResultPage,
+    get_narrow_result_page,
+    private_epoch_name,
+    rows_from_page,
+    stream_epoch_name,
+)
+from zerver.lib.response import json_error, json_success, json_success_with_messages
 from zerver.lib.sqlalchemy_utils import get_sqlalchemy_connection
 from zerver.lib.streams import (
     can_access_stream_history_by_id,
@@ -791,6 +806,42 @@ def parse_anchor_value(anchor_val: Optional[str],
     except ValueError:
         raise JsonableError(_("Invalid anchor"))
 
+def narrow_has_search(narrow: OptionalNarrowListT) -> bool:
+    return narrow is not None and any(term['operator'] == 'search' for term in narrow)
+
+def get_narrow_messages_epoch(narrow: OptionalNarrowListT,
+                              user_profile: UserProfile) -> Optional[str]:
+    """Returns the narrow result cache epoch of the messages the
+    narrow is limited to, or None if it isn't limited to one stream or
+    to the user's private messages."""
+    if narrow is None:
+        return None
+    for term in narrow:
+        if term.get('negated', False):
+            continue
+        if term['operator'] == 'stream':
+            try:
+                stream = get_stream_by_narrow_operand_access_unchecked(term['operand'],
+                                                                       user_profile.realm)
+            except Stream.DoesNotExist:
+                return None
+            return stream_epoch_name(stream.id)
+        if (term['operator'] in ('pm-with', 'group-pm-with') or
+                (term['operator'] == 'is' and term['operand'] == 'private')):
+            return private_epoch_name(user_profile.id)
+    return None
+
+def fetch_narrow_result_page(sa_conn: Any, query: Query, id_col: ColumnElement) -> NarrowResultPage:
+    query = query.order_by(id_col.desc()).limit(NARROW_RESULT_PAGE_SIZE + 1)
+    main_query = alias(query)
+    query = select(main_query.c, None, main_query).order_by(column("message_id").asc())
+    query = query.prefix_with("/* get_messages */")
+    rows = [tuple(row) for row in sa_conn.execute(query).fetchall()]
+    return NarrowResultPage(
+        rows=rows[-NARROW_RESULT_PAGE_SIZE:],
+        complete=len(rows) <= NARROW_RESULT_PAGE_SIZE,
+    )
+
 @has_request_variables
 def get_messages_backend(request: HttpRequest, user_profile: UserProfile,
                          anchor_val: Optional[str]=REQ(
@@ -801,8 +852,11 @@ def get_messages_backend(request: HttpRequest, user_profile: UserProfile,
                          use_first_unread_anchor_val: bool=REQ('use_first_unread_anchor',
                                                                validator=check_bool, default=False),
                          client_gravatar: bool=REQ(validator=check_bool, default=False),
-                         apply_markdown: bool=REQ(validator=check_bool, default=True)) -> HttpResponse:
-    anchor = parse_anchor_value(anchor_val, use_first_unread_anchor_val)
+                         apply_markdown: bool=REQ(validator=check_bool, default=True),
+                         use_cursor: bool=REQ(validator=check_bool, default=False),
+                         cursor: Optional[str]=REQ(default=None)) -> HttpResponse:
+    if cursor is None:
+        anchor = parse_anchor_value(anchor_val, use_first_unread_anchor_val)
     if num_before + num_after > MAX_MESSAGES_PER_FETCH:
         return json_error(_("Too many messages requested (maximum {}).").format(
             MAX_MESSAGES_PER_FETCH,
@@ -813,6 +867,16 @@ def get_messages_backend(request: HttpRequest, user_profile: UserProfile,
         # clients cannot compute gravatars, so we force-set it to false.
         client_gravatar = False
 
+    if cursor is not None:
+        return get_messages_from_cursor(
+            user_profile=user_profile,
+            cursor=cursor,
+            num_before=num_before,
+            num_after=num_after,
+            apply_markdown=apply_markdown,
+            client_gravatar=client_gravatar,
+        )
+
     include_history = ok_to_include_history(narrow, user_profile)
     if include_history:
         # The initial query in this case doesn't use `zerver_usermessage`,
@@ -832,19 +896,6 @@ def get_messages_backend(request: HttpRequest, user_profile: UserProfile,
         need_message = True
         need_user_message = True
 
-    query, inner_msg_id_col = get_base_query_for_search(
-        user_profile=user_profile,
-        need_message=need_message,
-        need_user_message=need_user_message,
-    )
-
-    query, is_search = add_narrow_conditions(
-        user_profile=user_profile,
-        inner_msg_id_col=inner_msg_id_col,
-        query=query,
-        narrow=narrow,
-    )
-
     if narrow is not None:
         # Add some metadata to our logging data for narrows
         verbose_operators = []
@@ -857,6 +908,17 @@ def get_messages_backend(request: HttpRequest, user_profile: UserProfile,
 
     sa_conn = get_sqlalchemy_connection()
 
+    # The narrow result cache only has results for narrows with a
+    # given anchor, since the first unread message in the narrow
+    # could be older than the cached page.
+    cache_narrow_results = (settings.NARROW_RESULT_CACHE and anchor is not None and
+                            not use_cursor and not narrow_has_search(narrow))
+    narrow_messages_epoch = None
+    if cache_narrow_results:
+        narrow_messages_epoch = get_narrow_messages_epoch(narrow, user_profile)
+        if narrow_messages_epoch is None:
+            cache_narrow_results = False
+
     if anchor is None:
         # The use_first_unread_anchor code path
         anchor = find_first_unread_anchor(
@@ -874,35 +936,286 @@ def get_messages_backend(request: HttpRequest, user_profile: UserProfile,
         num_after = 0
 
     first_visible_message_id = get_first_visible_message_id(user_profile.realm)
-    query = limit_query_to_range(
-        query=query,
+
+    is_search = False
+    rows: Optional[List[Any]] = None
+    if cache_narrow_results:
+        assert narrow_messages_epoch is not None
+        page = get_narrow_result_page(user_profile.id, user_profile.realm_id,
+                                      narrow_messages_epoch, narrow, include_history,
+                                      fetch=None)
+        if page is not None:
+            rows = rows_from_page(
+                page=page,
+                num_before=num_before,
+                num_after=num_after,
+                anchor=anchor,
+                anchored_to_left=anchored_to_left,
+                anchored_to_right=anchored_to_right,
+                first_visible_message_id=first_visible_message_id,
+            )
+
+    if rows is None:
+        query, inner_msg_id_col = get_base_query_for_search(
+            user_profile=user_profile,
+            need_message=need_message,
+            need_user_message=need_user_message,
+        )
+
+        query, is_search = add_narrow_conditions(
+            user_profile=user_profile,
+            inner_msg_id_col=inner_msg_id_col,
+            query=query,
+            narrow=narrow,
+        )
+
+        if use_cursor:
+            plan_id = save_message_fetch_plan(
+                user_profile=user_profile,
+                narrow=narrow,
+                include_history=include_history,
+                is_search=is_search,
+                query=query,
+                id_col=inner_msg_id_col,
+            )
+
+        if cache_narrow_results and anchored_to_right:
+            # Fetching the newest messages in a narrow is by far the
+            # most common request, so we cache a page of them, from
+            # which we can likely answer the next few requests.
+            assert narrow_messages_epoch is not None
+            page = get_narrow_result_page(
+                user_profile.id, user_profile.realm_id, narrow_messages_epoch, narrow,
+                include_history,
+                fetch=lambda: fetch_narrow_result_page(sa_conn, query, inner_msg_id_col),
+            )
+            assert page is not None
+            rows = rows_from_page(
+                page=page,
+                num_before=num_before,
+                num_after=num_after,
+                anchor=anchor,
+                anchored_to_left=anchored_to_left,
+                anchored_to_right=anchored_to_right,
+                first_visible_message_id=first_visible_message_id,
+            )
+
+    if rows is None:
+        query = limit_query_to_range(
+            query=query,
+            num_before=num_before,
+            num_after=num_after,
+            anchor=anchor,
+            anchored_to_left=anchored_to_left,
+            anchored_to_right=anchored_to_right,
+            id_col=inner_msg_id_col,
+            first_visible_message_id=first_visible_message_id,
+        )
+
+        main_query = alias(query)
+        query = select(main_query.c, None, main_query).order_by(column("message_id").asc())
+        # This is a hack to tag the query we use for testing
+        query = query.prefix_with("/* get_messages */")
+        rows = list(sa_conn.execute(query).fetchall())
+
+    query_info = post_process_limited_query(
+        rows=rows,
         num_before=num_before,
         num_after=num_after,
         anchor=anchor,
         anchored_to_left=anchored_to_left,
         anchored_to_right=anchored_to_right,
-        id_col=inner_msg_id_col,
         first_visible_message_id=first_visible_message_id,
     )
 
+    rows = query_info['rows']
+    ret = dict(
+        result='success',
+        msg='',
+        found_anchor=query_info['found_anchor'],
+        found_oldest=query_info['found_oldest'],
+        found_newest=query_info['found_newest'],
+        history_limited=query_info['history_limited'],
+        anchor=anchor,
+    )
+    if use_cursor:
+        message_ids = [row[0] for row in rows]
+        ret['cursor'] = encode_message_fetch_cursor(
+            plan_id,
+            min(message_ids, default=anchor),
+            max(message_ids, default=anchor),
+        )
+    return messages_response(
+        ret,
+        user_profile=user_profile,
+        rows=rows,
+        include_history=include_history,
+        is_search=is_search,
+        narrow=narrow,
+        apply_markdown=apply_markdown,
+        client_gravatar=client_gravatar,
+    )
+
+# In cursor mode (see get_messages_backend), the first request saves
+# the compiled SQL for fetching the messages before or after a given
+# message ID in the narrow (a "plan"), and returns a cursor naming the
+# plan and the range of message IDs the client has fetched.  Requests
+# with the cursor then just run the plan's SQL, seeking by message ID
+# from the edge of that range, rather than rebuilding the narrow query
+# (which may require several database lookups), computing the anchor
+# and compiling the query again.
+MESSAGE_FETCH_PLAN_TIMEOUT = 600
+
+def compile_seek_query(query: Query, id_col: ColumnElement, before: bool) -> Tuple[str, Dict[str, Any]]:
+    if before:
+        query = query.where(id_col < bindparam('cursor_id', type_=Integer))
+        query = query.order_by(id_col.desc())
+    else:
+        query = query.where(id_col > bindparam('cursor_id', type_=Integer))
+        query = query.order_by(id_col.asc())
+    query = query.limit(bindparam('cursor_limit', type_=Integer))
+
     main_query = alias(query)
     query = select(main_query.c, None, main_query).order_by(column("message_id").asc())
-    # This is a hack to tag the query we use for testing
     query = query.prefix_with("/* get_messages */")
-    rows = list(sa_conn.execute(query).fetchall())
+    compiled = query.compile(dialect=postgresql.dialect())
+    return str(compiled), dict(compiled.params)
+
+def save_message_fetch_plan(user_profile: UserProfile,
+                            narrow: OptionalNarrowListT,
+                            include_history: bool,
+                            is_search: bool,
+                            query: Query,
+                            id_col: ColumnElement) -> str:
+    plan_id = hashlib.sha256(ujson.dumps(
+        [user_profile.id, narrow, include_history],
+        sort_keys=True,
+    ).encode()).hexdigest()[:32]
+    plan = dict(
+        user_profile_id=user_profile.id,
+        narrow=narrow,
+        include_history=include_history,
+        is_search=is_search,
+        before=compile_seek_query(query, id_col, before=True),
+        after=compile_seek_query(query, id_col, before=False),
+    )
+    cache_set(message_fetch_plan_cache_key(plan_id), plan, timeout=MESSAGE_FETCH_PLAN_TIMEOUT)
+    return plan_id
+
+def encode_message_fetch_cursor(plan_id: str, oldest_id: int, newest_id: int) -> str:
+    return f"{plan_id}.{oldest_id}.{newest_id}"
+
+def get_messages_from_cursor(user_profile: UserProfile,
+                             cursor: str,
+                             num_before: int,
+                             num_after: int,
+                             apply_markdown: bool,
+                             client_gravatar: bool) -> HttpResponse:
+    try:
+        plan_id, oldest_str, newest_str = cursor.split('.')
+        oldest_id, newest_id = int(oldest_str), int(newest_str)
+    except ValueError:
+        raise JsonableError(_("Invalid cursor"))
+    if not re.fullmatch('[0-9a-f]{32}', plan_id):
+        raise JsonableError(_("Invalid cursor"))
+
+    cached = cache_get(message_fetch_plan_cache_key(plan_id))
+    if cached is None or cached[0]['user_profile_id'] != user_profile.id:
+        # Clients should start again with an anchor.
+        raise JsonableError(_("Invalid or expired cursor"))
+    plan = cached[0]
+    if plan['include_history'] and not ok_to_include_history(plan['narrow'], user_profile):
+        # The user has lost access to the stream's history.
+        raise JsonableError(_("Invalid or expired cursor"))
 
-    query_info = post_process_limited_query(
+    sa_conn = get_sqlalchemy_connection()
+
+    def seek(sql_and_params: Tuple[str, Dict[str, Any]], cursor_id: int, limit: int) -> List[Any]:
+        if limit == 0:
+            return []
+        sql, params = sql_and_params
+        params = dict(params, cursor_id=cursor_id, cursor_limit=limit)
+        return list(sa_conn.execute(sql, params).fetchall())
+
+    before_rows = seek(plan['before'], oldest_id, num_before)
+    after_rows = seek(plan['after'], newest_id, num_after)
+
+    first_visible_message_id = get_first_visible_message_id(user_profile.realm)
+    visible_before_rows = [row for row in before_rows if row[0] >= first_visible_message_id]
+    visible_after_rows = [row for row in after_rows if row[0] >= first_visible_message_id]
+    rows_limited = len(visible_before_rows) + len(visible_after_rows) != len(before_rows) + len(after_rows)
+    found_oldest = len(visible_before_rows) < num_before
+    found_newest = len(after_rows) < num_after
+
+    rows = visible_before_rows + visible_after_rows
+    message_ids = [row[0] for row in rows]
+    ret = dict(
+        result='success',
+        msg='',
+        found_oldest=found_oldest,
+        found_newest=found_newest,
+        history_limited=rows_limited and found_oldest,
+        cursor=encode_message_fetch_cursor(
+            plan_id,
+            min(message_ids + [oldest_id]),
+            max(message_ids + [newest_id]),
+        ),
+    )
+    return messages_response(
+        ret,
+        user_profile=user_profile,
         rows=rows,
-        num_before=num_before,
-        num_after=num_after,
-        anchor=anchor,
-        anchored_to_left=anchored_to_left,
-        anchored_to_right=anchored_to_right,
-        first_visible_message_id=first_visible_message_id,
+        include_history=plan['include_history'],
+        is_search=plan['is_search'],
+        narrow=plan['narrow'],
+        apply_markdown=apply_markdown,
+        client_gravatar=client_gravatar,
     )
 
-    rows = query_info['rows']
+def messages_response(data: Dict[str, Any],
+                      user_profile: UserProfile,
+                      rows: List[Any],
+                      include_history: bool,
+                      is_search: bool,
+                      narrow: OptionalNarrowListT,
+                      apply_markdown: bool,
+                      client_gravatar: bool) -> HttpResponse:
+    """Returns the json_success response with the messages for the rows
+    (see messages_for_rows) added to `data`."""
+    if not settings.MESSAGE_FRAGMENT_CACHE:
+        data['messages'] = messages_for_rows(
+            user_profile=user_profile,
+            rows=rows,
+            include_history=include_history,
+            is_search=is_search,
+            narrow=narrow,
+            apply_markdown=apply_markdown,
+            client_gravatar=client_gravatar,
+        )
+        return json_success(data)
 
+    # Splice the encoded messages into the response, rather than
+    # encoding the message dictionaries; see encoded_messages_for_ids.
+    message_ids, user_message_flags, search_fields = get_message_flags_and_search_fields(
+        user_profile, rows, include_history, is_search, narrow)
+    encoded_messages = encoded_messages_for_ids(
+        message_ids=message_ids,
+        user_message_flags=user_message_flags,
+        search_fields=search_fields,
+        apply_markdown=apply_markdown,
+        client_gravatar=client_gravatar,
+        allow_edit_history=user_profile.realm.allow_edit_history,
+    )
+    statsd.incr('loaded_old_messages', len(encoded_messages))
+    return json_success_with_messages(data, encoded_messages)
+
+def get_message_flags_and_search_fields(
+        user_profile: UserProfile,
+        rows: List[Any],
+        include_history: bool,
+        is_search: bool,
+        narrow: OptionalNarrowListT,
+) -> Tuple[List[int], Dict[int, List[str]], Dict[int, Dict[str, str]]]:
     # The following is a little messy, but ensures that the code paths
     # are similar regardless of the value of include_history.  The
     # 'user_messages' dictionary maps each message to the user's
@@ -945,6 +1258,17 @@ def get_messages_backend(request: HttpRequest, user_profile: UserProfile,
                 # debugged the case that makes it happen.
                 raise Exception(str(err), message_id, narrow)
 
+    return message_ids, user_message_flags, search_fields
+
+def messages_for_rows(user_profile: UserProfile,
+                      rows: List[Any],
+                      include_history: bool,
+                      is_search: bool,
+                      narrow: OptionalNarrowListT,
+                      apply_markdown: bool,
+                      client_gravatar: bool) -> List[Dict[str, Any]]:
+    message_ids, user_message_flags, search_fields = get_message_flags_and_search_fields(
+        user_profile, rows, include_history, is_search, narrow)
     message_list = messages_for_ids(
         message_ids=message_ids,
         user_message_flags=user_message_flags,
@@ -955,18 +1279,7 @@ def get_messages_backend(request: HttpRequest, user_profile: UserProfile,
     )
 
     statsd.incr('loaded_old_messages', len(message_list))
-
-    ret = dict(
-        messages=message_list,
-        result='success',
-        msg='',
-        found_anchor=query_info['found_anchor'],
-        found_oldest=query_info['found_oldest'],
-        found_newest=query_info['found_newest'],
-        history_limited=query_info['history_limited'],
-        anchor=anchor,
-    )
-    return json_success(ret)
+    return message_list
 
 def limit_query_to_range(query: Query,
                          num_before: int,
@@ -12,7 +12,7 @@ from zerver.lib.presence import get_presence_for_user, get_presence_response
 from zerver.lib.request import REQ, JsonableError, has_request_variables
 from zerver.lib.response import json_error, json_success
 from zerver.lib.timestamp import datetime_to_timestamp
-from zerver.lib.validator import check_bool, check_capped_string
+from zerver.lib.validator import check_bool, check_capped_string, check_int
 from zerver.models import UserActivity, UserPresence, UserProfile, get_active_user
 
 
@@ -74,6 +74,7 @@ def update_active_status_backend(request: HttpRequest, user_profile: UserProfile
                                  ping_only: bool=REQ(validator=check_bool, default=False),
                                  new_user_input: bool=REQ(validator=check_bool, default=False),
                                  slim_presence: bool=REQ(validator=check_bool, default=False),
+                                 last_update_id: Optional[int]=REQ(validator=check_int, default=None),
                                  ) -> HttpResponse:
     status_val = UserPresence.status_from_string(status)
     if status_val is None:
@@ -85,7 +86,8 @@ def update_active_status_backend(request: HttpRequest, user_profile: UserProfile
     if ping_only:
         ret: Dict[str, Any] = {}
     else:
-        ret = get_presence_response(user_profile, slim_presence)
+        ret = get_presence_response(user_profile, slim_presence,
+                                    last_update_id_fetched_by_client=last_update_id)
 
     if user_profile.realm.is_zephyr_mirror_realm:
         # In zephyr mirroring realms, users can't see the presence of other
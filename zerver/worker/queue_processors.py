@@ -10,6 +10,7 @@ import signal
 import smtplib
 import socket
 import tempfile
+import threading
 import time
 import urllib
 from abc import ABC, abstractmethod
@@ -34,18 +35,24 @@ from typing import (
 import requests
 import ujson
 from django.conf import settings
+from django.core.mail import get_connection
+from django.core.mail.backends.base import BaseEmailBackend
 from django.db import connection
 from django.utils.timezone import now as timezone_now
 from zulip_bots.lib import ExternalBotHandler, extract_query_without_mention
 
 from zerver.context_processors import common_context
+from zerver.lib import metrics
 from zerver.lib.actions import (
+    do_deferred_message_work,
     do_mark_stream_messages_as_read,
     do_send_confirmation_email,
     do_update_embedded_data,
-    do_update_user_activity,
+    do_update_user_activities,
     do_update_user_activity_interval,
+    do_update_user_activity_intervals,
     do_update_user_presence,
+    do_update_user_presences,
     internal_send_private_message,
     notify_realm_export,
     render_incoming_message,
@@ -81,6 +88,7 @@ from zerver.lib.send_email import (
 from zerver.lib.streams import access_stream_by_id
 from zerver.lib.timestamp import timestamp_to_datetime
 from zerver.lib.url_preview import preview as url_preview
+from zerver.lib.users import prefetch_user_profiles_by_id
 from zerver.models import (
     Client,
     Message,
@@ -155,9 +163,53 @@ def retry_send_email_failures(
 
     return wrapper
 
+# In-process metrics for all queue workers, which process_queue
+# --metrics_port exposes for monitoring to scrape.
+consume_seconds = metrics.histogram(
+    'zulip_queue_worker_consume_seconds',
+    "Time spent processing each batch of events (just one event, for most queues).",
+    ['queue'])
+event_seconds = metrics.histogram(
+    'zulip_queue_worker_event_seconds',
+    "Time spent processing individual events, by event type.",
+    ['queue', 'event_type'])
+batch_events = metrics.histogram(
+    'zulip_queue_worker_batch_size',
+    "Number of events in each batch processed.",
+    ['queue'],
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000))
+events_processed = metrics.counter(
+    'zulip_queue_worker_events_total',
+    "Events processed successfully.",
+    ['queue'])
+consume_errors = metrics.counter(
+    'zulip_queue_worker_errors_total',
+    "Batches of events whose processing failed with an exception.",
+    ['queue'])
+pending_events = metrics.gauge(
+    'zulip_queue_worker_queue_size',
+    "Events delivered to the worker, but not yet processed.",
+    ['queue'])
+queue_last_emptied = metrics.gauge(
+    'zulip_queue_worker_last_emptied_timestamp_seconds',
+    "When the worker last had no events waiting; the age of its backlog is the time since.",
+    ['queue'])
+
 class QueueProcessingWorker(ABC):
     queue_name: str = None
-    CONSUME_ITERATIONS_BEFORE_UPDATE_STATS_NUM = 50
+    # How often we refresh the stats file read by the
+    # check_rabbitmq_queue Nagios plugin.
+    STATS_UPDATE_INTERVAL_SECONDS = 30
+
+    # Workers which set batch_size are passed events in batches of up
+    # to that many events via consume_batch, rather than one at a time
+    # via consume; a partial batch is processed once its oldest event
+    # has waited batch_max_latency seconds.  prefetch_count is the
+    # number of unacknowledged events RabbitMQ will send the worker,
+    # and defaults to two batches' worth.
+    batch_size: Optional[int] = None
+    batch_max_latency: float = 1.0
+    prefetch_count: Optional[int] = None
 
     def __init__(self) -> None:
         self.q: SimpleQueueClient = None
@@ -170,7 +222,6 @@ class QueueProcessingWorker(ABC):
         self.queue_last_emptied_timestamp = time.time()
         self.consumed_since_last_emptied = 0
         self.recent_consume_times: MutableSequence[Tuple[int, float]] = deque(maxlen=50)
-        self.consume_interation_counter = 0
 
         self.update_statistics(0)
 
@@ -189,17 +240,21 @@ class QueueProcessingWorker(ABC):
             consumed_since_last_emptied=self.consumed_since_last_emptied,
         )
 
+        self.last_statistics_update = time.time()
+
         os.makedirs(settings.QUEUE_STATS_DIR, exist_ok=True)
 
         fname = f'{self.queue_name}.stats'
         fn = os.path.join(settings.QUEUE_STATS_DIR, fname)
-        with lockfile(fn + '.lock'):
-            tmp_fn = fn + '.tmp'
-            with open(tmp_fn, 'w') as f:
-                serialized_dict = ujson.dumps(stats_dict, indent=2)
-                serialized_dict += '\n'
-                f.write(serialized_dict)
-            os.rename(tmp_fn, fn)
+        # Every writer uses its own temporary file, and the rename is
+        # atomic, so readers never see a partial file and we don't
+        # need a lock.
+        tmp_fn = f'{fn}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_fn, 'w') as f:
+            serialized_dict = ujson.dumps(stats_dict, indent=2)
+            serialized_dict += '\n'
+            f.write(serialized_dict)
+        os.replace(tmp_fn, fn)
 
     @abstractmethod
     def consume(self, data: Dict[str, Any]) -> None:
@@ -213,6 +268,7 @@ class QueueProcessingWorker(ABC):
             consume_time_seconds: Optional[float] = time.time() - time_start
             self.consumed_since_last_emptied += len(events)
         except Exception:
+            consume_errors.inc(self.queue_name)
             self._handle_consume_exception(events)
             consume_time_seconds = None
         finally:
@@ -221,6 +277,9 @@ class QueueProcessingWorker(ABC):
 
             if consume_time_seconds is not None:
                 self.recent_consume_times.append((len(events), consume_time_seconds))
+                consume_seconds.observe(self.queue_name, value=consume_time_seconds)
+                batch_events.observe(self.queue_name, value=len(events))
+                events_processed.inc(self.queue_name, amount=len(events))
 
             if self.q is not None:
                 remaining_queue_size = self.q.queue_size()
@@ -230,15 +289,54 @@ class QueueProcessingWorker(ABC):
             if remaining_queue_size == 0:
                 self.queue_last_emptied_timestamp = time.time()
                 self.consumed_since_last_emptied = 0
+            pending_events.set(self.queue_name, value=remaining_queue_size)
+            queue_last_emptied.set(self.queue_name, value=self.queue_last_emptied_timestamp)
 
-            self.consume_interation_counter += 1
-            if self.consume_interation_counter >= self.CONSUME_ITERATIONS_BEFORE_UPDATE_STATS_NUM:
-
-                self.consume_interation_counter = 0
+            if time.time() - self.last_statistics_update >= self.STATS_UPDATE_INTERVAL_SECONDS:
                 self.update_statistics(remaining_queue_size)
 
+    def get_event_type(self, event: Mapping[str, Any]) -> str:
+        """The label under which we record the time spent processing
+        this event; workers whose events don't have a "type" can
+        override this."""
+        return str(event.get('type', 'default'))
+
+    def consume_single_event(self, event: Dict[str, Any]) -> None:
+        time_start = time.time()
+        self.consume(event)
+        event_seconds.observe(self.queue_name, self.get_event_type(event),
+                              value=time.time() - time_start)
+
+    def consume_batch(self, events: List[Dict[str, Any]]) -> None:
+        """Subclasses setting batch_size can override this to share work
+        across the events in a batch."""
+        for event in events:
+            self.consume_batch_event(event)
+
+    def consume_batch_event(self, event: Dict[str, Any]) -> None:
+        """Processes one event of a batch, such that if it fails, only
+        that event is set aside, not the whole batch."""
+        try:
+            self.consume_single_event(event)
+        except Exception:
+            consume_errors.inc(self.queue_name)
+            self._handle_consume_exception([event])
+
+    def consume_batch_in_bulk(self, consume_bulk: Callable[[List[Dict[str, Any]]], None],
+                              events: List[Dict[str, Any]]) -> None:
+        """For workers which process a whole batch with bulk queries: if
+        that fails, we process the events one at a time, so that only
+        the events which fail on their own are set aside."""
+        try:
+            consume_bulk(events)
+        except Exception:
+            logger.warning("Processing a batch of %d events on queue %s failed; "
+                           "processing them one at a time", len(events), self.queue_name,
+                           exc_info=True)
+            QueueProcessingWorker.consume_batch(self, events)
+
     def consume_wrapper(self, data: Dict[str, Any]) -> None:
-        consume_func = lambda events: self.consume(events[0])
+        consume_func = lambda events: self.consume_single_event(events[0])
         self.do_consume(consume_func, [data])
 
     def _handle_consume_exception(self, events: List[Dict[str, Any]]) -> None:
@@ -264,6 +362,15 @@ class QueueProcessingWorker(ABC):
 
     def start(self) -> None:
         self.initialize_statistics()
+        if self.batch_size is not None:
+            self.q.start_json_batch_consumer(
+                self.queue_name,
+                lambda events: self.do_consume(self.consume_batch, events),
+                batch_size=self.batch_size,
+                max_latency=self.batch_max_latency,
+                prefetch_count=self.prefetch_count or 2 * self.batch_size,
+            )
+            return
         self.q.register_json_consumer(self.queue_name, self.consume_wrapper)
         self.q.start_consuming()
 
@@ -413,19 +520,23 @@ class UserActivityWorker(LoopQueueProcessingWorker):
                 count, time = uncommitted_events[key_tuple]
                 uncommitted_events[key_tuple] = (count + 1, max(time, event['time']))
 
-        # Then we insert the updates into the database.
-        #
-        # TODO: Doing these updates in sequence individually is likely
-        # inefficient; the idealized version would do some sort of
-        # bulk insert_or_update query.
-        for key_tuple in uncommitted_events:
-            (user_profile_id, client_id, query) = key_tuple
-            count, time = uncommitted_events[key_tuple]
-            log_time = timestamp_to_datetime(time)
-            do_update_user_activity(user_profile_id, client_id, query, count, log_time)
+        # Then we insert the updates into the database, with a single
+        # upsert query per thousand rows.
+        do_update_user_activities({
+            key_tuple: (count, timestamp_to_datetime(time))
+            for key_tuple, (count, time) in uncommitted_events.items()
+        })
 
 @assign_queue('user_activity_interval')
 class UserActivityIntervalWorker(QueueProcessingWorker):
+    batch_size = 1000
+
+    def consume_batch(self, events: List[Dict[str, Any]]) -> None:
+        self.consume_batch_in_bulk(lambda events: do_update_user_activity_intervals([
+            (event["user_profile_id"], timestamp_to_datetime(event["time"]))
+            for event in events
+        ]), events)
+
     def consume(self, event: Mapping[str, Any]) -> None:
         user_profile = get_user_profile_by_id(event["user_profile_id"])
         log_time = timestamp_to_datetime(event["time"])
@@ -433,6 +544,25 @@ class UserActivityIntervalWorker(QueueProcessingWorker):
 
 @assign_queue('user_presence')
 class UserPresenceWorker(QueueProcessingWorker):
+    # Every client pings us about once a minute, so we collect a few
+    # seconds of pings and write them with a handful of bulk queries,
+    # rather than a get_or_create and save for each one.
+    batch_size = 1000
+    batch_max_latency = 5.0
+
+    def consume_batch(self, events: List[Dict[str, Any]]) -> None:
+        self.consume_batch_in_bulk(self.update_presences, events)
+
+    def update_presences(self, events: List[Dict[str, Any]]) -> None:
+        prefetch_user_profiles_by_id(list({event["user_profile_id"] for event in events}))
+        do_update_user_presences([
+            (get_user_profile_by_id(event["user_profile_id"]),
+             get_client(event["client"]),
+             timestamp_to_datetime(event["time"]),
+             event["status"])
+            for event in events
+        ])
+
     def consume(self, event: Mapping[str, Any]) -> None:
         logging.debug("Received presence event: %s", event)
         user_profile = get_user_profile_by_id(event["user_profile_id"])
@@ -505,6 +635,32 @@ class MissedMessageWorker(QueueProcessingWorker):
 
 @assign_queue('email_senders')
 class EmailSendingWorker(QueueProcessingWorker):
+    batch_size = 50
+    connection: Optional[BaseEmailBackend] = None
+
+    def consume_batch(self, events: List[Dict[str, Any]]) -> None:
+        # Send the whole batch over a single connection to the mail
+        # server, and load all the recipients with one query.
+        prefetch_user_profiles_by_id(list({
+            user_id for event in events for user_id in event.get('to_user_ids') or []
+        }))
+        self.connection = get_connection()
+        try:
+            self.connection.open()
+        except (smtplib.SMTPException, OSError):
+            # Let each email open its own connection, so that failures
+            # are retried per email by retry_send_email_failures.
+            self.connection = None
+        try:
+            super().consume_batch(events)
+        finally:
+            self.close_connection()
+
+    def close_connection(self) -> None:
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
     @retry_send_email_failures
     def consume(self, event: Dict[str, Any]) -> None:
         # Copy the event, so that we don't pass the `failed_tries'
@@ -514,7 +670,12 @@ class EmailSendingWorker(QueueProcessingWorker):
         if 'failed_tries' in copied_event:
             del copied_event['failed_tries']
         handle_send_email_format_changes(copied_event)
-        send_email_from_dict(copied_event)
+        try:
+            send_email_from_dict(copied_event, connection=self.connection)
+        except smtplib.SMTPServerDisconnected:
+            # Don't reuse the dead connection for the rest of the batch.
+            self.close_connection()
+            raise
 
 @assign_queue('missedmessage_mobile_notifications')
 class PushNotificationsWorker(QueueProcessingWorker):  # nocoverage
@@ -525,6 +686,30 @@ class PushNotificationsWorker(QueueProcessingWorker):  # nocoverage
         initialize_push_notifications()
         super().start()
 
+    batch_size = 100
+
+    def consume_batch(self, events: List[Dict[str, Any]]) -> None:
+        # Fetch every recipient with one query, and merge the
+        # multi-message removals for each user into a single removal
+        # notification.  Single-message removals are left alone, since
+        # do_clear_mobile_push_notifications_for_ids deliberately sends
+        # a few of those separately for the benefit of older clients.
+        prefetch_user_profiles_by_id(list({event['user_profile_id'] for event in events}))
+        removals: Dict[int, Dict[str, Any]] = {}
+        for event in events:
+            message_ids = event.get('message_ids')
+            if event.get("type", "add") != "remove" or message_ids is None or len(message_ids) <= 1:
+                self.consume_batch_event(event)
+                continue
+            user_profile_id = event['user_profile_id']
+            if user_profile_id not in removals:
+                removals[user_profile_id] = dict(event, message_ids=list(message_ids))
+            else:
+                removals[user_profile_id]['message_ids'].extend(message_ids)
+        for event in removals.values():
+            event['message_ids'] = sorted(set(event['message_ids']))
+            self.consume_batch_event(event)
+
     def consume(self, event: Dict[str, Any]) -> None:
         try:
             if event.get("type", "add") == "remove":
@@ -678,6 +863,16 @@ class EmbeddedBotWorker(QueueProcessingWorker):
             except EmbeddedBotQuitException as e:
                 logging.warning(str(e))
 
+@assign_queue('deferred_message_work')
+class DeferredMessageWorker(QueueProcessingWorker):
+    # The work do_send_messages defers with DEFER_MESSAGE_SIDE_EFFECTS
+    # has its own queue, so that it isn't stuck behind slow jobs like
+    # realm exports.  We process each event (the messages from one
+    # do_send_messages call) on its own: the work isn't idempotent
+    # (e.g. outgoing webhooks), so we can't retry parts of a batch.
+    def consume(self, event: Mapping[str, Any]) -> None:
+        do_deferred_message_work(event['messages'])
+
 @assign_queue('deferred_work')
 class DeferredWorker(QueueProcessingWorker):
     def consume(self, event: Dict[str, Any]) -> None:
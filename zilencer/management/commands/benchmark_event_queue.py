@@ -0,0 +1,52 @@
+import timeit
+from typing import Any
+
+from django.core.management.base import BaseCommand, CommandParser
+
+from zerver.tornado.event_queue import EventQueue
+
+
+def build_queue(depth: int) -> EventQueue:
+    queue = EventQueue('benchmark')
+    for i in range(depth):
+        queue.push({"type": "message", "message": {"id": i}, "flags": []})
+        if i % 100 == 0:
+            queue.push({"type": "pointer", "pointer": i})
+    return queue
+
+class Command(BaseCommand):
+    help = """Microbenchmark for EventQueue, showing how the cost of the
+get_events fetch path (prune through the last event seen, then read
+the contents) varies with queue depth, for a slowly polling client."""
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument('--depths', default='100,1000,10000,100000',
+                            help="Comma-separated list of queue depths to measure")
+        parser.add_argument('--fetch-size', type=int, default=10,
+                            help="Number of events the client fetches per request")
+        parser.add_argument('--iterations', type=int, default=1000)
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        fetch_size = options['fetch_size']
+        iterations = options['iterations']
+        for depth in [int(depth) for depth in options['depths'].split(',')]:
+            queue = build_queue(depth + fetch_size * iterations)
+            last_event_id = -1
+
+            def fetch() -> None:
+                nonlocal last_event_id
+                queue.prune(last_event_id)
+                contents = queue.contents()
+                last_event_id = contents[min(fetch_size, len(contents)) - 1]['id']
+
+            def prune() -> None:
+                nonlocal last_event_id
+                last_event_id += fetch_size
+                queue.prune(last_event_id)
+
+            fetch_time = timeit.timeit(fetch, number=iterations)
+            queue = build_queue(depth + fetch_size * iterations)
+            last_event_id = -1
+            prune_time = timeit.timeit(prune, number=iterations)
+            print(f"depth {depth:>8}: fetch {1000000 * fetch_time / iterations:10.1f}us, "
+                  f"prune {1000000 * prune_time / iterations:8.2f}us")
@@ -0,0 +1,61 @@
+import timeit
+from typing import Any, Callable, Dict, List
+
+from django.core.management.base import BaseCommand, CommandParser
+
+from zerver.lib.message import MessageDict, extract_message_dict, stringify_message_dict
+from zerver.models import Message
+
+
+class Command(BaseCommand):
+    help = """Benchmark for hydrating the message dictionaries for a fetch of
+many messages (as in messages_for_ids), comparing the bulk
+MessageDict.post_process_dicts with hydrating and finalizing each
+dictionary individually, as we do for message events.
+
+Uses the newest messages in the database; both code paths start
+from the cached (encoded) message dictionaries."""
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument('--num-messages', type=int, default=1000,
+                            help="Number of messages to hydrate per iteration")
+        parser.add_argument('--iterations', type=int, default=20)
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        message_ids = list(Message.objects.order_by('-id').values_list(
+            'id', flat=True)[:options['num_messages']])
+        rows = MessageDict.get_raw_db_rows(message_ids)
+        encoded = [stringify_message_dict(MessageDict.build_dict_from_raw_db_row(row))
+                   for row in rows]
+        num_messages = len(encoded)
+        iterations = options['iterations']
+
+        def decode() -> List[Dict[str, Any]]:
+            return [extract_message_dict(blob) for blob in encoded]
+
+        for apply_markdown in [True, False]:
+            for client_gravatar in [True, False]:
+                def per_dict() -> List[Dict[str, Any]]:
+                    objs = decode()
+                    MessageDict.bulk_hydrate_sender_info(objs)
+                    MessageDict.bulk_hydrate_recipient_info(objs)
+                    for obj in objs:
+                        MessageDict._finalize_payload(obj, apply_markdown, client_gravatar)
+                    return objs
+
+                def bulk() -> List[Dict[str, Any]]:
+                    objs = decode()
+                    MessageDict.post_process_dicts(objs, apply_markdown, client_gravatar)
+                    return objs
+
+                assert per_dict() == bulk()
+
+                def time_per_message(f: Callable[[], object]) -> float:
+                    return 1000000 * timeit.timeit(f, number=iterations) / iterations / num_messages
+
+                decode_time = time_per_message(decode)
+                per_dict_time = time_per_message(per_dict) - decode_time
+                bulk_time = time_per_message(bulk) - decode_time
+                print(f"apply_markdown={apply_markdown!s:5} client_gravatar={client_gravatar!s:5}: "
+                      f"per-dict {per_dict_time:6.2f}us, bulk {bulk_time:6.2f}us per message "
+                      f"(plus {decode_time:.2f}us to decode)")
@@ -0,0 +1,79 @@
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from unittest import mock
+
+import ujson
+from django.core.management.base import BaseCommand, CommandParser
+from django.db import transaction
+from django.test import override_settings
+
+from zerver.lib.actions import internal_send_stream_message
+from zerver.lib.upload import create_attachment
+from zerver.models import get_realm, get_stream, get_user_by_delivery_email
+from zerver.worker.queue_processors import DeferredMessageWorker
+
+
+class Command(BaseCommand):
+    help = """Benchmark for the latency of sending a message, with and
+without DEFER_MESSAGE_SIDE_EFFECTS, and the time the
+deferred_message_work queue processor then spends per message on the
+work which was deferred.
+
+Sends stream messages with an uploaded file and a link, one at a time.
+Events for RabbitMQ are encoded but not published, and each run is
+rolled back, so this doesn't modify the database or notify Tornado."""
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument('--realm', default='zulip')
+        parser.add_argument('--sender', default='iago@zulip.com')
+        parser.add_argument('--stream', default='Verona')
+        parser.add_argument('--num-messages', type=int, default=200)
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        realm = get_realm(options['realm'])
+        sender = get_user_by_delivery_email(options['sender'], realm)
+        stream = get_stream(options['stream'], realm)
+        num_messages = options['num_messages']
+        published: List[Tuple[str, str]] = []
+
+        def record_publish(queue_name: str, event: Dict[str, Any],
+                           processor: Optional[Callable[[Any], None]]=None) -> None:
+            # Encoding the event is the part of publishing it which
+            # we can measure without a RabbitMQ round trip.
+            published.append((queue_name, ujson.dumps(event)))
+
+        def run(defer: bool) -> Tuple[List[float], float]:
+            del published[:]
+            with override_settings(DEFER_MESSAGE_SIDE_EFFECTS=defer), \
+                    mock.patch('zerver.lib.actions.queue_json_publish', record_publish), \
+                    mock.patch('zerver.tornado.event_queue.queue_json_publish', record_publish), \
+                    mock.patch('django.db.transaction.on_commit', lambda f: f()), \
+                    transaction.atomic():
+                path_id = f'{realm.id}/benchmark/benchmark.txt'
+                create_attachment('benchmark.txt', path_id, sender, 10)
+                latencies = []
+                for i in range(num_messages):
+                    content = (f'Message {i}, with [a file](/user_uploads/{path_id}) '
+                               'and a link: https://zulip.com/')
+                    start = time.time()
+                    internal_send_stream_message(realm, sender, stream, 'benchmark', content)
+                    latencies.append(time.time() - start)
+
+                events = [ujson.loads(event) for (queue_name, event) in published
+                          if queue_name == 'deferred_message_work']
+                worker = DeferredMessageWorker()
+                start = time.time()
+                for event in events:
+                    worker.consume(event)
+                deferred_time = time.time() - start
+                transaction.set_rollback(True)
+            return latencies, deferred_time
+
+        for defer in [False, True]:
+            latencies, deferred_time = run(defer)
+            latencies.sort()
+            mean = 1000 * sum(latencies) / len(latencies)
+            p95 = 1000 * latencies[int(0.95 * (len(latencies) - 1))]
+            print(f"DEFER_MESSAGE_SIDE_EFFECTS={defer!s:5}: send {mean:6.2f}ms mean, "
+                  f"{p95:6.2f}ms p95; deferred work {1000 * deferred_time / num_messages:6.2f}ms "
+                  "per message")
@@ -0,0 +1,98 @@
+import random
+import time
+from typing import Any, Callable, Dict, List, Tuple
+
+from django.core.management.base import BaseCommand, CommandParser
+from django.db import transaction
+
+from zerver.lib.actions import (
+    do_update_user_activity,
+    do_update_user_activity_interval,
+    do_update_user_activity_intervals,
+)
+from zerver.lib.timestamp import timestamp_to_datetime
+from zerver.models import Client, UserProfile, get_user_profile_by_id
+from zerver.worker.queue_processors import UserActivityIntervalWorker, UserActivityWorker
+
+
+class Command(BaseCommand):
+    help = """Benchmark for draining a backlog of the user_activity and
+user_activity_interval queues, comparing the workers' bulk writes
+with a round trip to the database for each deduplicated activity
+(or each interval event), as the workers used to do.
+
+Builds a synthetic backlog for the users and clients in the database;
+each run is rolled back, so this doesn't modify the database."""
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument('--num-events', type=int, default=100000,
+                            help="Number of events in the backlog")
+        parser.add_argument('--num-queries', type=int, default=50,
+                            help="Number of distinct endpoints in the backlog")
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        num_events = options['num_events']
+        user_ids = list(UserProfile.objects.values_list('id', flat=True))
+        client_ids = list(Client.objects.values_list('id', flat=True))
+        queries = [f'/json/benchmark/{i}' for i in range(options['num_queries'])]
+        now = time.time()
+        activity_events = [
+            dict(user_profile_id=random.choice(user_ids),
+                 client_id=random.choice(client_ids),
+                 query=random.choice(queries),
+                 time=now - random.uniform(0, 3600))
+            for i in range(num_events)
+        ]
+        interval_events = sorted(
+            (dict(user_profile_id=random.choice(user_ids),
+                  time=now - random.uniform(0, 24 * 3600))
+             for i in range(num_events)),
+            key=lambda event: event['time'],
+        )
+
+        def time_rolled_back(f: Callable[[], None]) -> float:
+            with transaction.atomic():
+                start = time.time()
+                f()
+                elapsed = time.time() - start
+                transaction.set_rollback(True)
+            return elapsed
+
+        def deduplicated_activities() -> Dict[Tuple[int, int, str], Tuple[int, float]]:
+            activities: Dict[Tuple[int, int, str], Tuple[int, float]] = {}
+            for event in activity_events:
+                key = (event['user_profile_id'], event['client_id'], event['query'])
+                count, last_time = activities.get(key, (0, 0.0))
+                activities[key] = (count + 1, max(last_time, event['time']))
+            return activities
+
+        def activity_per_row() -> None:
+            for (user_profile_id, client_id, query), (count, last_time) in deduplicated_activities().items():
+                do_update_user_activity(user_profile_id, client_id, query, count,
+                                        timestamp_to_datetime(last_time))
+
+        def activity_bulk() -> None:
+            UserActivityWorker().consume_batch(activity_events)
+
+        def interval_per_event() -> None:
+            for event in interval_events:
+                do_update_user_activity_interval(get_user_profile_by_id(event['user_profile_id']),
+                                                 timestamp_to_datetime(event['time']))
+
+        def interval_bulk() -> None:
+            # The worker processes the backlog in batches of this size.
+            batch_size = UserActivityIntervalWorker.batch_size
+            assert batch_size is not None
+            for i in range(0, len(interval_events), batch_size):
+                batch: List[Dict[str, Any]] = interval_events[i:i + batch_size]
+                do_update_user_activity_intervals([
+                    (event['user_profile_id'], timestamp_to_datetime(event['time']))
+                    for event in batch
+                ])
+
+        print(f"{num_events} user_activity events, {len(deduplicated_activities())} distinct rows:")
+        print(f"  per-row {time_rolled_back(activity_per_row):.2f}s, "
+              f"bulk upsert {time_rolled_back(activity_bulk):.2f}s")
+        print(f"{num_events} user_activity_interval events:")
+        print(f"  per-event {time_rolled_back(interval_per_event):.2f}s, "
+              f"batched {time_rolled_back(interval_bulk):.2f}s")
@@ -669,6 +669,8 @@ MANAGEMENT_LOG_PATH = zulip_path("/var/log/zulip/manage.log")
 WORKER_LOG_PATH = zulip_path("/var/log/zulip/workers.log")
 SLOW_QUERIES_LOG_PATH = zulip_path("/var/log/zulip/slow_queries.log")
 JSON_PERSISTENT_QUEUE_FILENAME_PATTERN = zulip_path("/home/zulip/tornado/event_queues%s.json")
+PERSISTENT_QUEUE_SNAPSHOT_FILENAME_PATTERN = zulip_path("/home/zulip/tornado/event_queues%s.snapshot")
+PERSISTENT_QUEUE_CHECKPOINT_FILENAME_PATTERN = zulip_path("/home/zulip/tornado/event_queues%s.checkpoint")
 EMAIL_LOG_PATH = zulip_path("/var/log/zulip/send_email.log")
 EMAIL_MIRROR_LOG_PATH = zulip_path("/var/log/zulip/email_mirror.log")
 EMAIL_DELIVERER_LOG_PATH = zulip_path("/var/log/zulip/email-deliverer.log")
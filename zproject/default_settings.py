@@ -160,6 +160,9 @@ PUSH_NOTIFICATION_REDACT_CONTENT = False
 SUBMIT_USAGE_STATISTICS = True
 RATE_LIMITING = True
 RATE_LIMITING_AUTHENTICATE = True
+RATE_LIMITING_BACKEND = 'redis'
+RATE_LIMITING_LEASE_SIZE = 1
+RATE_LIMITING_LEASE_SECONDS = 1.0
 SEND_LOGIN_EMAILS = True
 EMBEDDED_BOTS_ENABLED = False
 
@@ -424,3 +427,30 @@ LDAP_DEACTIVATE_NON_MATCHING_USERS: Optional[bool] = None
 
 # Use half of the available CPUs for data import purposes.
 DEFAULT_DATA_EXPORT_IMPORT_PARALLELISM = (len(os.sched_getaffinity(0)) // 2) or 1
+
+# Cache the results of rendering message content; see do_convert in
+# zerver/lib/bugdown/__init__.py.
+BUGDOWN_RENDER_CACHE = False
+
+# Share the realm-wide parts of the /register response between users;
+# see zerver/lib/realm_snapshot.py.
+REALM_SNAPSHOT_CACHE = False
+
+# Keep an index of each user's unread messages in memcached; see
+# zerver/lib/unread_index.py.
+UNREAD_INDEX = False
+
+# Cache the newest page of results of each user's recent narrows; see
+# zerver/lib/narrow_result_cache.py.
+NARROW_RESULT_CACHE = False
+
+# Serve fetched messages from cached JSON encodings of each message's
+# payload; see encoded_messages_for_ids in zerver/lib/message.py.
+MESSAGE_FRAGMENT_CACHE = False
+
+# Leave only the database writes and the events for Tornado on the
+# request path when sending messages, and do the rest (claiming
+# attachments, queueing link previews and service bot events, and
+# the Welcome Bot's replies) in the deferred_message_work queue
+# processor; see do_send_messages.
+DEFER_MESSAGE_SIDE_EFFECTS = False
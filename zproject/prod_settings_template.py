@@ -636,6 +636,15 @@ CAMO_URI = '/external_content/'
 
 # Controls whether Zulip will rate-limit user requests.
 # RATE_LIMITING = True
+#
+# Selects how rate limits are tracked in Redis: 'redis' logs each
+# request, while 'redis_token_bucket' keeps a token bucket per rule
+# and checks it with a single Lua script.  With the token bucket,
+# RATE_LIMITING_LEASE_SIZE > 1 lets each server process take that
+# many tokens from Redis at once, so most requests don't contact
+# Redis at all, at the cost of some precision.
+# RATE_LIMITING_BACKEND = 'redis'
+# RATE_LIMITING_LEASE_SIZE = 1
 
 # By default, Zulip connects to the thumbor (the thumbnailing software
 # we use) service running locally on the machine.  If you're running
@@ -727,6 +727,7 @@ urls += [
     path('notify_tornado', zerver.tornado.views.notify,
          name='zerver.tornado.views.notify'),
     path('api/v1/events/internal', zerver.tornado.views.get_events_internal),
+    path('api/v1/events/internal/cleanup', zerver.tornado.views.cleanup_event_queue_internal),
 ]
 
 # Python Social Auth